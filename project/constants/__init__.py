@@ -15,6 +15,7 @@ from .retinal_screening_results import *
 from .sex_types import *
 from .smoking_status import *
 from .thyroid_treatment_status import *
+from .upload_job_states import *
 from .user import *
 from .visit_categories import *
 from .yes_no_unknown import *
@@ -1,8 +1,9 @@
 # Object types
 from dataclasses import dataclass
 from datetime import date, datetime
-from typing import Dict, Optional, Union
+from typing import Dict, Iterable, Union
 
+import numpy as np
 from django.db.models import QuerySet
 
 from project.npda.models import Patient
@@ -33,7 +34,21 @@ class KPIResult:
             'ineligible': <QuerySet[Patient]>,
             'passed': <QuerySet[Patient]>,
             'failed': <QuerySet[Patient]>,
-        }
+        },
+    }
+
+    `patient_querysets` are returned by the individual `calculate_kpi_*`
+    methods. The KPICalculationsObject instead holds `patient_ids`,
+    materialised once as sorted arrays of patient pks:
+    {
+        ...
+        'patient_querysets': None,
+        'patient_ids': {
+            'eligible': array([1, 2, 5, ...]),
+            'ineligible': array([3, 4, ...]),
+            'passed': array([1, 5, ...]),
+            'failed': array([2, ...]),
+        },
     }
     """
 
@@ -43,6 +58,7 @@ class KPIResult:
     total_failed: Union[int | None]  # E.g. KPIs 1-12 would be None as counts
     kpi_label: str = "KPI Name not found"
     patient_querysets: Union[Dict[str, QuerySet[Patient]], None] = None
+    patient_ids: Union[Dict[str, np.ndarray], None] = None
 
 
 @dataclass
@@ -77,211 +93,271 @@ KPIS
     - care at diagnosis
 44-49
     - outcomes
+
+`depends_on` lists the KPIs whose eligible patients are the base cohort
+(denominator) of a KPI, so have to be calculated first:
+    - 1: eligible patients
+    - 2: new diagnoses
+    - 5: T1DM with a complete year of care
+    - 6: T1DM with a complete year of care, aged 12+
+    - 7: new T1DM diagnoses (41-43 use those diagnosed at least 90 days
+    before the audit end date)
 """
 KPI_ATTRIBUTE_LABEL_MAP = {
     1: {
         "attribute_name": "kpi_1_total_eligible",
         "rendered_label": "Total number of eligible patients",
+        "depends_on": [],
     },
     2: {
         "attribute_name": "kpi_2_total_new_diagnoses",
         "rendered_label": "Total number of new diagnoses within the audit period",
+        "depends_on": [1],
     },
     3: {
         "attribute_name": "kpi_3_total_t1dm",
         "rendered_label": "Total number of eligible patients with Type 1 diabetes",
+        "depends_on": [1],
     },
     4: {
         "attribute_name": "kpi_4_total_t1dm_gte_12yo",
         "rendered_label": "Number of patients aged 12+ with Type 1 diabetes",
+        "depends_on": [1],
     },
     5: {
         "attribute_name": "kpi_5_total_t1dm_complete_year",
         "rendered_label": "Total number of patients with T1DM who have completed a year of care",
+        "depends_on": [1],
     },
     6: {
         "attribute_name": "kpi_6_total_t1dm_complete_year_gte_12yo",
         "rendered_label": "Total number of patients with T1DM who have completed a year of care and are aged 12 or older",
+        "depends_on": [],
     },
     7: {
         "attribute_name": "kpi_7_total_new_diagnoses_t1dm",
         "rendered_label": "Total number of new diagnoses of T1DM",
+        "depends_on": [],
     },
     8: {
         "attribute_name": "kpi_8_total_deaths",
         "rendered_label": "Number of patients who died within audit period",
+        "depends_on": [1],
     },
     9: {
         "attribute_name": "kpi_9_total_service_transitions",
         "rendered_label": "Number of patients who transitioned/left service within audit period",
+        "depends_on": [1],
     },
     10: {
         "attribute_name": "kpi_10_total_coeliacs",
         "rendered_label": "Total number of coeliacs",
+        "depends_on": [1],
     },
     11: {
         "attribute_name": "kpi_11_total_thyroids",
         "rendered_label": "Number of patients with thyroid disease",
+        "depends_on": [1],
     },
     12: {
         "attribute_name": "kpi_12_total_ketone_test_equipment",
         "rendered_label": "Number of patients with ketone test equipment",
+        "depends_on": [1],
     },
     13: {
         "attribute_name": "kpi_13_one_to_three_injections_per_day",
         "rendered_label": "Number of patients on one to three injections per day",
+        "depends_on": [1],
     },
     14: {
         "attribute_name": "kpi_14_four_or_more_injections_per_day",
         "rendered_label": "Number of patients on four or more injections per day",
+        "depends_on": [1],
     },
     15: {
         "attribute_name": "kpi_15_insulin_pump",
         "rendered_label": "Number of patients on insulin pump",
+        "depends_on": [1],
     },
     16: {
         "attribute_name": "kpi_16_one_to_three_injections_plus_other_medication",
         "rendered_label": "Number of patients on one to three injections plus other medication",
+        "depends_on": [1],
     },
     17: {
         "attribute_name": "kpi_17_four_or_more_injections_plus_other_medication",
         "rendered_label": "Number of patients on four or more injections plus other medication",
+        "depends_on": [1],
     },
     18: {
         "attribute_name": "kpi_18_insulin_pump_plus_other_medication",
         "rendered_label": "Number of patients on insulin pump plus other medication",
+        "depends_on": [1],
     },
     19: {
         "attribute_name": "kpi_19_dietary_management_alone",
         "rendered_label": "Number of patients on dietary management alone",
+        "depends_on": [1],
     },
     20: {
         "attribute_name": "kpi_20_dietary_management_plus_other_medication",
         "rendered_label": "Number of patients on dietary management plus other medication",
+        "depends_on": [1],
     },
     21: {
         "attribute_name": "kpi_21_flash_glucose_monitor",
         "rendered_label": "Number of patients on flash glucose monitor",
+        "depends_on": [1],
     },
     22: {
         "attribute_name": "kpi_22_real_time_cgm_with_alarms",
         "rendered_label": "Number of patients on real-time CGM with alarms",
+        "depends_on": [1],
     },
     23: {
         "attribute_name": "kpi_23_type1_real_time_cgm_with_alarms",
         "rendered_label": "Number of patients on Type 1 real-time CGM with alarms",
+        "depends_on": [2],
     },
     24: {
         "attribute_name": "kpi_24_hybrid_closed_loop_system",
         "rendered_label": "Number of patients on hybrid closed loop system",
+        "depends_on": [1],
     },
     25: {
         "attribute_name": "kpi_25_hba1c",
         "rendered_label": "Number of patients with HbA1c",
+        "depends_on": [5],
     },
     26: {
         "attribute_name": "kpi_26_bmi",
         "rendered_label": "Number of patients with BMI",
+        "depends_on": [5],
     },
     27: {
         "attribute_name": "kpi_27_thyroid_screen",
         "rendered_label": "Number of patients with thyroid screen",
+        "depends_on": [5],
     },
     28: {
         "attribute_name": "kpi_28_blood_pressure",
         "rendered_label": "Number of patients with blood pressure",
+        "depends_on": [6],
     },
     29: {
         "attribute_name": "kpi_29_urinary_albumin",
         "rendered_label": "Number of patients with urinary albumin",
+        "depends_on": [6],
     },
     30: {
         "attribute_name": "kpi_30_retinal_screening",
         "rendered_label": "Number of patients with retinal screening",
+        "depends_on": [6],
     },
     31: {
         "attribute_name": "kpi_31_foot_examination",
         "rendered_label": "Number of patients with foot examination",
+        "depends_on": [6],
     },
     321: {
         "attribute_name": "kpi_32_1_health_check_completion_rate",
         "rendered_label": "Care processes completion rate",
+        "depends_on": [5],
     },
     322: {
         "attribute_name": "kpi_32_2_health_check_lt_12yo",
         "rendered_label": "Care processes in patients < 12 years old",
+        "depends_on": [5],
     },
     323: {
         "attribute_name": "kpi_32_3_health_check_gte_12yo",
         "rendered_label": "Care processes in patients ≥ 12 years old",
+        "depends_on": [5],
     },
     33: {
         "attribute_name": "kpi_33_hba1c_4plus",
         "rendered_label": "Number of patients with 4 or more HbA1c measurements",
+        "depends_on": [5],
     },
     34: {
         "attribute_name": "kpi_34_psychological_assessment",
         "rendered_label": "Number of patients offered a psychological assessment",
+        "depends_on": [5],
     },
     35: {
         "attribute_name": "kpi_35_smoking_status_screened",
         "rendered_label": "Number of patients asked about smoking status",
+        "depends_on": [6],
     },
     36: {
         "attribute_name": "kpi_36_referral_to_smoking_cessation_service",
         "rendered_label": "Number of patients referred to a smoking cessation service",
+        "depends_on": [6],
     },
     37: {
         "attribute_name": "kpi_37_additional_dietetic_appointment_offered",
         "rendered_label": "Number of patients offered an additional dietetic appointment",
+        "depends_on": [5],
     },
     38: {
         "attribute_name": "kpi_38_patients_attending_additional_dietetic_appointment",
         "rendered_label": "Number of patients attending an additional dietetic appointment",
+        "depends_on": [5],
     },
     39: {
         "attribute_name": "kpi_39_influenza_immunisation_recommended",
         "rendered_label": "Number of patients recommended influenza immunisation",
+        "depends_on": [5],
     },
     40: {
         "attribute_name": "kpi_40_sick_day_rules_advice",
         "rendered_label": "Number of patients given sick day rules advice",
+        "depends_on": [1],
     },
     41: {
         "attribute_name": "kpi_41_coeliac_disease_screening",
         "rendered_label": "Number of patients with coeliac disease screening",
+        "depends_on": [7],
     },
     42: {
         "attribute_name": "kpi_42_thyroid_disease_screening",
         "rendered_label": "Number of patients with thyroid disease screening",
+        "depends_on": [7],
     },
     43: {
         "attribute_name": "kpi_43_carbohydrate_counting_education",
         "rendered_label": "Number of patients with carbohydrate counting education",
+        "depends_on": [7],
     },
     44: {
         "attribute_name": "kpi_44_mean_hba1c",
         "rendered_label": "Mean HbA1c",
+        "depends_on": [1],
     },
     45: {
         "attribute_name": "kpi_45_median_hba1c",
         "rendered_label": "Median HbA1c",
+        "depends_on": [1],
     },
     46: {
         "attribute_name": "kpi_46_number_of_admissions",
         "rendered_label": "Number of admissions",
+        "depends_on": [1],
     },
     47: {
         "attribute_name": "kpi_47_number_of_dka_admissions",
         "rendered_label": "Number of DKA admissions",
+        "depends_on": [1],
     },
     48: {
         "attribute_name": "kpi_48_required_additional_psychological_support",
         "rendered_label": "Number of patients requiring additional psychological support",
+        "depends_on": [1],
     },
     49: {
         "attribute_name": "kpi_49_albuminuria_present",
         "rendered_label": "Number of patients with albuminuria",
+        "depends_on": [1],
     },
 }
 
@@ -290,6 +366,7 @@ KPI_ATTRIBUTE_LABEL_MAP = {
 class KPINames:
     attribute_name: str  # e.g. kpi_32_1_health_check_completion_rate
     rendered_label: str  # e.g. Care Processes Completion Rate
+    depends_on: list[int]  # e.g. [5]
 
 
 class KPIRegistry:
@@ -309,11 +386,16 @@ class KPIRegistry:
 
     kpi_registry.get_rendered_label(323)
         -> 'Care processes in patients ≥ 12 years old'
+
+    kpi_registry.get_calculation_order([25, 44])
+        -> [1, 5, 25, 44]
     """
 
-    def __init__(self, kpi_data: Dict[int, Dict[str, str]]):
+    def __init__(self, kpi_data: Dict[int, Dict[str, Union[str, list[int]]]]):
         self.kpi_map = {
-            number: KPINames(data["attribute_name"], data["rendered_label"])
+            number: KPINames(
+                data["attribute_name"], data["rendered_label"], data["depends_on"]
+            )
             for number, data in kpi_data.items()
         }
 
@@ -328,6 +410,33 @@ class KPIRegistry:
         kpi = self.get_kpi(number)
         return kpi.rendered_label if kpi else None
 
+    def get_kpi_numbers(self) -> list[int]:
+        """All KPI numbers, in calculation order"""
+        return list(self.kpi_map)
+
+    def get_calculation_order(self, numbers: Iterable[int]) -> list[int]:
+        """Returns the given KPIs and everything they depend on (the
+        transitive closure of `depends_on`), with dependencies first.
+
+        Raises ValueError for an unknown KPI number.
+        """
+
+        required = set()
+
+        def require(number: int):
+            if number not in self.kpi_map:
+                raise ValueError(f"Unknown KPI number: {number}")
+            if number not in required:
+                required.add(number)
+                for dependency in self.kpi_map[number].depends_on:
+                    require(dependency)
+
+        for number in numbers:
+            require(number)
+
+        # Dependencies always come before their dependents in kpi_map
+        return [number for number in self.kpi_map if number in required]
+
 
 # Initialise registry
 kpi_registry = KPIRegistry(KPI_ATTRIBUTE_LABEL_MAP)
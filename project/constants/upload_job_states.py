@@ -0,0 +1,15 @@
+UPLOAD_JOB_QUEUED = 1
+UPLOAD_JOB_RUNNING = 2
+UPLOAD_JOB_COMPLETE = 3
+UPLOAD_JOB_COMPLETE_WITH_ERRORS = 4
+UPLOAD_JOB_FAILED = 5
+
+UPLOAD_JOB_STATES = (
+    (UPLOAD_JOB_QUEUED, "Queued"),
+    (UPLOAD_JOB_RUNNING, "Running"),
+    (UPLOAD_JOB_COMPLETE, "Complete"),
+    (UPLOAD_JOB_COMPLETE_WITH_ERRORS, "Complete with errors"),
+    (UPLOAD_JOB_FAILED, "Failed"),
+)
+
+UNFINISHED_UPLOAD_JOB_STATES = (UPLOAD_JOB_QUEUED, UPLOAD_JOB_RUNNING)
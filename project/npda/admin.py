@@ -4,11 +4,16 @@ from django.contrib import admin
 from .models import (
     NPDAUser,
     OrganisationEmployer,
+    KPISnapshot,
     Patient,
+    PatientKPIStatus,
+    PDUKPICount,
+    PostcodeDeprivation,
     Visit,
     Transfer,
     VisitActivity,
     Submission,
+    UploadJob,
 )
 from django.contrib.sessions.models import Session
 
@@ -31,6 +36,55 @@ class PatientAdmin(admin.ModelAdmin):
     search_fields = ("nhs_number_icontains", "pk")
 
 
+@admin.register(PatientKPIStatus)
+class PatientKPIStatusAdmin(admin.ModelAdmin):
+    search_fields = ("patient__nhs_number", "kpi_number", "pk")
+    list_display = (
+        "patient",
+        "audit_start_date",
+        "kpi_number",
+        "eligible",
+        "passed",
+        "value",
+    )
+    list_filter = ("audit_start_date", "kpi_number")
+
+
+@admin.register(PDUKPICount)
+class PDUKPICountAdmin(admin.ModelAdmin):
+    search_fields = ("pz_code", "kpi_number", "pk")
+    list_display = (
+        "pz_code",
+        "audit_start_date",
+        "kpi_number",
+        "total_eligible",
+        "total_passed",
+        "value_sum",
+    )
+    list_filter = ("audit_start_date", "kpi_number")
+
+
+@admin.register(PostcodeDeprivation)
+class PostcodeDeprivationAdmin(admin.ModelAdmin):
+    search_fields = ("postcode", "lsoa_code")
+    list_display = ("postcode", "lsoa_code", "imd_quintile")
+    list_filter = ("imd_quintile",)
+
+
+@admin.register(KPISnapshot)
+class KPISnapshotAdmin(admin.ModelAdmin):
+    search_fields = ("pz_code", "kpi_number", "pk")
+    list_display = (
+        "pz_code",
+        "audit_start_date",
+        "kpi_number",
+        "calculation_datetime",
+        "total_eligible",
+        "total_passed",
+    )
+    list_filter = ("audit_start_date", "kpi_number")
+
+
 @admin.register(PaediatricDiabetesUnit)
 class PaediatricDiabetesUnitAdmin(admin.ModelAdmin):
     search_fields = ("pk", "pz_code")
@@ -62,6 +116,21 @@ class SubmissionAdmin(admin.ModelAdmin):
     search_fields = ["pk"]
 
 
+@admin.register(UploadJob)
+class UploadJobAdmin(admin.ModelAdmin):
+    search_fields = ("paediatric_diabetes_unit__pz_code", "pk")
+    list_display = (
+        "paediatric_diabetes_unit",
+        "uploaded_by",
+        "state",
+        "rows_processed",
+        "total_rows",
+        "error_count",
+        "created_at",
+    )
+    list_filter = ("state",)
+
+
 @admin.register(Session)
 class SessionAdmin(admin.ModelAdmin):
 
@@ -15,7 +15,7 @@ from requests import RequestException
 from ...constants.styles.form_styles import *
 from ..general_functions import (gp_details_for_ods_code,
                                  gp_ods_code_for_postcode, imd_for_postcode,
-                                 validate_postcode)
+                                 postcode_lookup_key, validate_postcode)
 from ..models import Patient
 from ..validators import not_in_the_future_validator
 
@@ -44,7 +44,7 @@ class PostcodeField(forms.CharField):
         postcode = super().to_python(value)
 
         if postcode:
-            return postcode.upper().replace(" ", "").replace("-", "")
+            return postcode_lookup_key(postcode)
 
 class PatientForm(forms.ModelForm):
 
@@ -82,6 +82,17 @@ class PatientForm(forms.ModelForm):
             "gp_practice_postcode": forms.TextInput(attrs={"class": TEXT_INPUT}),
         }
 
+    def __init__(self, *args, postcode_lookup=None, **kwargs):
+        # Postcodes already validated in bulk, by postcode_lookup_key (see validate_postcodes)
+        self.postcode_lookup = postcode_lookup or {}
+        super().__init__(*args, **kwargs)
+
+    def lookup_postcode(self, postcode):
+        if postcode and postcode_lookup_key(postcode) in self.postcode_lookup:
+            return self.postcode_lookup[postcode_lookup_key(postcode)]
+
+        return validate_postcode(postcode)
+
     def clean_date_of_birth(self):
         date_of_birth = self.cleaned_data["date_of_birth"]
 
@@ -103,7 +114,7 @@ class PatientForm(forms.ModelForm):
         postcode = self.cleaned_data["postcode"]
 
         try:
-            result = validate_postcode(postcode)
+            result = self.lookup_postcode(postcode)
 
             if not result:
                 self.add_error(
@@ -169,7 +180,7 @@ class PatientForm(forms.ModelForm):
 
         if gp_practice_postcode:
             try:
-                validation_result = validate_postcode(gp_practice_postcode)
+                validation_result = self.lookup_postcode(gp_practice_postcode)
                 normalised_postcode = validation_result["normalised_postcode"]
 
                 ods_code = gp_ods_code_for_postcode(normalised_postcode)
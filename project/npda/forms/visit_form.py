@@ -363,7 +363,7 @@ class VisitForm(forms.ModelForm):
         return data
 
     def clean_weight(self):
-        data = self.cleaned_data["height"]
+        data = self.cleaned_data["weight"]
         if data is not None:
             if data < 1:
                 raise ValidationError(
@@ -388,6 +388,8 @@ class VisitForm(forms.ModelForm):
                     "Systolic Blood Pressure out of range. Cannot be above 240"
                 )
 
+        return systolic_blood_pressure
+
     def clean_diastolic_blood_pressure(self):
         diastolic_blood_pressure = self.cleaned_data["diastolic_blood_pressure"]
 
@@ -401,6 +403,8 @@ class VisitForm(forms.ModelForm):
                     "Diastolic Blood pressure out of range. Cannot be above 120"
                 )
 
+        return diastolic_blood_pressure
+
     def clean_albumin_creatinine_ratio(self):
         albumin_creatinine_ratio = self.cleaned_data["albumin_creatinine_ratio"]
 
@@ -414,6 +418,8 @@ class VisitForm(forms.ModelForm):
                     "Urinary Albumin Level (ACR) out of range. Cannot be above 50"
                 )
 
+        return albumin_creatinine_ratio
+
     def clean_total_cholesterol(self):
         total_cholesterol = self.cleaned_data["total_cholesterol"]
 
@@ -427,6 +433,8 @@ class VisitForm(forms.ModelForm):
                     "Total Cholesterol Level (mmol/l) out of range. Cannot be above 12"
                 )
 
+        return total_cholesterol
+
     """
     Custom clean methods for all fields requiring dates
     """
@@ -0,0 +1,148 @@
+# python imports
+from datetime import date
+
+# django imports
+from django.apps import apps
+from django.db import models
+
+# third part imports
+import pandas as pd
+import numpy as np
+
+# Valid ranges of numeric visit fields, as checked by VisitForm's clean_<field> methods
+VISIT_FIELD_RANGES = {
+    "height": (40, 240),
+    "weight": (1, 200),
+    "systolic_blood_pressure": (80, 240),
+    "diastolic_blood_pressure": (20, 120),
+    "albumin_creatinine_ratio": (20, 50),
+    "total_cholesterol": (2, 12),
+}
+
+# Largest value Django's (and Postgres') IntegerField accepts
+MAX_INTEGER = 2**31 - 1
+
+
+def prevalidate_visit_rows(visit_fields, date_of_birth, diagnosis_date, death_date):
+    """
+    Checks csv visit values a whole column at a time, before any VisitForm is built
+
+    visit_fields is a DataFrame of csv values, one column per Visit field (named as
+    the model field), and date_of_birth, diagnosis_date and death_date are the
+    dates of each row's patient, with the same index.
+
+    Checks date parsing, dates in the future and ordering against the patient's
+    dates, numeric types, ranges and decimal places, choice membership and free
+    text, as VisitForm does.
+
+    Returns a boolean DataFrame, the same shape as visit_fields, that is True where
+    a value may be invalid. Rows with any True value need validating with VisitForm,
+    which gives the error messages. The rest are valid as they are.
+    """
+    Visit = apps.get_model("npda", "Visit")
+
+    patient_dates = [
+        pd.to_datetime(dates.astype(object))
+        for dates in (date_of_birth, diagnosis_date)
+    ]
+    death_date = pd.to_datetime(death_date.astype(object))
+
+    needs_form = pd.DataFrame(
+        False, index=visit_fields.index, columns=visit_fields.columns
+    )
+
+    for field_name, column in visit_fields.items():
+        model_field = Visit._meta.get_field(field_name)
+
+        if isinstance(model_field, models.DateField):
+            invalid = invalid_dates(column, patient_dates, death_date)
+        elif model_field.choices:
+            invalid = ~numbers(column).isin([key for key, _ in model_field.choices])
+        elif isinstance(model_field, models.DecimalField):
+            invalid = invalid_decimals(column, model_field)
+        elif isinstance(model_field, models.IntegerField):
+            invalid = invalid_integers(column, model_field)
+        elif isinstance(model_field, models.CharField):
+            invalid = invalid_text(column, model_field)
+        else:
+            invalid = pd.Series(True, index=column.index)
+
+        needs_form[field_name] = ~is_empty(column) & invalid
+
+    return needs_form
+
+
+def is_empty(column):
+    # csv_value_to_model_value treats missing values and 0 as empty
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.isna()
+
+    return column.isna() | column.eq(0)
+
+
+def numbers(column):
+    # Only numeric columns hold values that are numbers as they are.
+    # Anything else (e.g. text in a number column) is left to the form
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        return column.astype(float)
+
+    return pd.Series(np.nan, index=column.index)
+
+
+def invalid_dates(column, patient_dates, death_date):
+    # Dates that failed to parse are left as text by read_csv
+    if not pd.api.types.is_datetime64_any_dtype(column):
+        return pd.Series(True, index=column.index)
+
+    # As validate_date: not in the future, before date of birth or diagnosis, nor
+    # after death
+    invalid = (column > pd.Timestamp(date.today())) | (column > death_date)
+    for patient_date in patient_dates:
+        invalid |= column < patient_date
+
+    return invalid
+
+
+def invalid_decimals(column, model_field):
+    values = numbers(column)
+
+    valid = (
+        np.isfinite(values)
+        & (values.round(model_field.decimal_places) == values)
+        & (values.abs() < 10 ** (model_field.max_digits - model_field.decimal_places))
+    )
+
+    return ~valid | ~in_range(values, model_field.name)
+
+
+def invalid_integers(column, model_field):
+    values = numbers(column)
+
+    valid = (
+        np.isfinite(values)
+        & (np.floor(values) == values)
+        & (values.abs() <= MAX_INTEGER)
+    )
+
+    return ~valid | ~in_range(values, model_field.name)
+
+
+def in_range(values, field_name):
+    if field_name not in VISIT_FIELD_RANGES:
+        return pd.Series(True, index=values.index)
+
+    minimum, maximum = VISIT_FIELD_RANGES[field_name]
+    return values.between(minimum, maximum)
+
+
+def invalid_text(column, model_field):
+    if not (
+        pd.api.types.is_string_dtype(column) or pd.api.types.is_object_dtype(column)
+    ):
+        return pd.Series(True, index=column.index)
+
+    # Non-text values strip to NaN, so are invalid too
+    stripped = column.str.strip()
+    valid = stripped.eq(column) & column.str.len().between(1, model_field.max_length)
+
+    return ~valid.fillna(False).astype(bool)
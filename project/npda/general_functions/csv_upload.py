@@ -4,6 +4,7 @@ import logging
 
 # django imports
 from django.apps import apps
+from django.db import transaction
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
@@ -20,6 +21,59 @@ from ...constants import (
 logger = logging.getLogger(__name__)
 from ..forms.patient_form import PatientForm
 from ..forms.visit_form import VisitForm
+from .csv_prevalidate import prevalidate_visit_rows
+from .validate_postcode import validate_postcodes
+from ..kpi_class.patient_kpi_status import (
+    deferred_patient_kpi_status_updates,
+    schedule_patient_kpi_status_update,
+    schedule_pdu_kpi_counts_drop,
+)
+
+# Rows per INSERT when bulk creating patients, transfers and visits
+CSV_UPLOAD_BATCH_SIZE = 1_000
+
+# Visit model field: csv column
+VISIT_CSV_FIELDS = {
+    "visit_date": "Visit/Appointment Date",
+    "height": "Patient Height (cm)",
+    "weight": "Patient Weight (kg)",
+    "height_weight_observation_date": "Observation Date (Height and weight)",
+    "hba1c_format": "HbA1c result format",
+    "hba1c_date": "Observation Date: Hba1c Value",
+    "treatment": "Diabetes Treatment at time of Hba1c measurement",
+    "closed_loop_system": "If treatment included insulin pump therapy (i.e. option 3 or 6 selected), was this part of a closed loop system?",
+    "glucose_monitoring": "At the time of HbA1c measurement, in addition to standard blood glucose monitoring (SBGM), was the patient using any other method of glucose monitoring?",
+    "systolic_blood_pressure": "Systolic Blood Pressure",
+    "diastolic_blood_pressure": "Diastolic Blood pressure",
+    "blood_pressure_observation_date": "Observation Date (Blood Pressure)",
+    "foot_examination_observation_date": "Foot Assessment / Examination Date",
+    "retinal_screening_observation_date": "Retinal Screening date",
+    "retinal_screening_result": "Retinal Screening Result",
+    "albumin_creatinine_ratio": "Urinary Albumin Level (ACR)",
+    "albumin_creatinine_ratio_date": "Observation Date: Urinary Albumin Level",
+    "albuminuria_stage": "Albuminuria Stage",
+    "total_cholesterol": "Total Cholesterol Level (mmol/l)",
+    "total_cholesterol_date": "Observation Date: Total Cholesterol Level",
+    "thyroid_function_date": "Observation Date: Thyroid Function",
+    "thyroid_treatment_status": "At time of, or following measurement of thyroid function, was the patient prescribed any thyroid treatment?",
+    "coeliac_screen_date": "Observation Date: Coeliac Disease Screening",
+    "gluten_free_diet": "Has the patient been recommended a Gluten-free diet?",
+    "psychological_screening_assessment_date": "Observation Date - Psychological Screening Assessment",
+    "psychological_additional_support_status": "Was the patient assessed as requiring additional psychological/CAMHS support outside of MDT clinics?",
+    "smoking_status": "Does the patient smoke?",
+    "smoking_cessation_referral_date": "Date of offer of referral to smoking cessation service (if patient is a current smoker)",
+    "carbohydrate_counting_level_three_education_date": "Date of Level 3 carbohydrate counting education received",
+    "dietician_additional_appointment_offered": "Was the patient offered an additional appointment with a paediatric dietitian?",
+    "dietician_additional_appointment_date": "Date of additional appointment with dietitian",
+    "ketone_meter_training": "Was the patient using (or trained to use) blood ketone testing equipment at time of visit?",
+    "flu_immunisation_recommended_date": "Date that influenza immunisation was recommended",
+    "sick_day_rules_training_date": "Date of provision of advice ('sick-day rules') about managing diabetes during intercurrent illness or episodes of hyperglycaemia",
+    "hospital_admission_date": "Start date (Hospital Provider Spell)",
+    "hospital_discharge_date": "Discharge date (Hospital provider spell)",
+    "hospital_admission_reason": "Reason for admission",
+    "dka_additional_therapies": "Only complete if DKA selected in previous question: During this DKA admission did the patient receive any of the following therapies?",
+    "hospital_admission_other": "Only complete if OTHER selected: Reason for admission (free text)",
+}
 
 
 def read_csv(csv_file):
@@ -27,91 +81,48 @@ def read_csv(csv_file):
         csv_file, parse_dates=ALL_DATES, dayfirst=True, date_format="%d/%m/%Y"
     )
 
-def csv_upload(user, dataframe, csv_file, pdu_pz_code):
+def csv_upload(
+    user,
+    dataframe,
+    csv_file,
+    pdu_pz_code,
+    batch_size=CSV_UPLOAD_BATCH_SIZE,
+    on_progress=None,
+    on_heartbeat=None,
+):
     """
     Processes standardised NPDA csv file and persists results in NPDA tables
 
     accepts CSV file with standardised column names
 
+    Visit values are checked a whole column at a time first, and only rows that may
+    be invalid are validated with VisitForm.
+
+    Every row is validated first, then the new submission, its patients,
+    transfers and visits are bulk inserted (`batch_size` rows per INSERT) in
+    a single transaction, replacing the previous active submission.
+
+    on_progress, if given, is called with the number of rows validated so far and
+    the errors found so far ({field: [ValidationError]}) after each patient's rows.
+
+    on_heartbeat, if given, is called during the steps that don't report progress:
+    after each patient is validated with PatientForm, either side of the bulk
+    postcode lookup, at the start and end of the write transaction (so within it),
+    and once the KPI status updates that run as it commits are done.
+
     return True if successful, False with error message if not
     """
     Patient = apps.get_model("npda", "Patient")
     Transfer = apps.get_model("npda", "Transfer")
     Visit = apps.get_model("npda", "Visit")
     Submission = apps.get_model("npda", "Submission")
+    PatientSubmission = apps.get_model("npda", "PatientSubmission")
     PaediatricDiabetesUnit = apps.get_model("npda", "PaediatricDiabetesUnit")
 
     # get the PDU object
     # TODO #249 MRB: handle case where PDU does not exist
     pdu = PaediatricDiabetesUnit.objects.get(pz_code=pdu_pz_code)
 
-    # Set previous submission to inactive
-    if Submission.objects.filter(
-        paediatric_diabetes_unit__pz_code=pdu.pz_code,
-        audit_year=date.today().year,
-        submission_active=True,
-    ).exists():
-        original_submission = Submission.objects.filter(
-            submission_active=True,
-            paediatric_diabetes_unit__pz_code=pdu.pz_code,
-            audit_year=date.today().year,
-        ).get()  # there can be only one of these - store it in a variable in case we need to revert
-    else:
-        original_submission = None
-
-    print(f"Original submission: {original_submission}")
-
-    # Create new submission for the audit year
-    # It is not possble to create submissions in years other than the current year
-    try:
-        new_submission = Submission.objects.create(
-            paediatric_diabetes_unit=pdu,
-            audit_year=date.today().year,
-            submission_date=timezone.now(),
-            submission_by=user,  # user is the user who is logged in. Passed in as a parameter
-            submission_active=True,
-        )
-
-        if csv_file:
-            # save the csv file with a custom name
-            new_filename = f"{pdu.pz_code}_{timezone.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            new_submission.csv_file.save(new_filename, csv_file)
-        
-        new_submission.save()
-
-    except Exception as e:
-        logger.error(f"Error creating new submission: {e}")
-        # the new submission was not created  - no action required as the previous submission is still active
-        raise ValidationError(
-            {
-                "csv_upload": "Error creating new submission. The old submission has been restored."
-            }
-        )
-
-    # now can delete all patients and visits from the previous active submission
-    if original_submission:
-        try:
-            print(
-                f"Deleting patients from previous submission: {Patient.objects.filter(submissions=original_submission).count()}"
-            )
-            Patient.objects.filter(submissions=original_submission).delete()
-        except Exception as e:
-            raise ValidationError(
-                {"csv_upload": "Error deleting patients from previous submission"}
-            )
-
-    # now can delete the any previous active submission's csv file (if it exists)
-    # and remove the path from the field by setting it to None
-    # the rest of the submission will be retained
-    if original_submission:
-        original_submission.submission_active = False
-        try:
-            original_submission.save()  # this action will delete the csv file also as per the save method in the model
-        except Exception as e:
-            raise ValidationError(
-                {"csv_upload": "Error deactivating previous submission"}
-            )
-
     def csv_value_to_model_value(model_field, value):
         if pd.isnull(value):
             return None
@@ -170,57 +181,13 @@ def csv_upload(user, dataframe, csv_file, pdu_pz_code):
                 "death_date": "Death Date",
             },
         )
-        form = PatientForm(fields)
+        form = PatientForm(fields, postcode_lookup=postcode_lookup)
         assign_original_row_indices_to_errors(form, row)
         return form
 
     def validate_visit_using_form(patient, row):
 
-        fields = row_to_dict(
-            row,
-            Visit,
-            {
-                "visit_date": "Visit/Appointment Date",
-                "height": "Patient Height (cm)",
-                "weight": "Patient Weight (kg)",
-                "height_weight_observation_date": "Observation Date (Height and weight)",
-                "hba1c_format": "HbA1c result format",
-                "hba1c_date": "Observation Date: Hba1c Value",
-                "treatment": "Diabetes Treatment at time of Hba1c measurement",
-                "closed_loop_system": "If treatment included insulin pump therapy (i.e. option 3 or 6 selected), was this part of a closed loop system?",
-                "glucose_monitoring": "At the time of HbA1c measurement, in addition to standard blood glucose monitoring (SBGM), was the patient using any other method of glucose monitoring?",
-                "systolic_blood_pressure": "Systolic Blood Pressure",
-                "diastolic_blood_pressure": "Diastolic Blood pressure",
-                "blood_pressure_observation_date": "Observation Date (Blood Pressure)",
-                "foot_examination_observation_date": "Foot Assessment / Examination Date",
-                "retinal_screening_observation_date": "Retinal Screening date",
-                "retinal_screening_result": "Retinal Screening Result",
-                "albumin_creatinine_ratio": "Urinary Albumin Level (ACR)",
-                "albumin_creatinine_ratio_date": "Observation Date: Urinary Albumin Level",
-                "albuminuria_stage": "Albuminuria Stage",
-                "total_cholesterol": "Total Cholesterol Level (mmol/l)",
-                "total_cholesterol_date": "Observation Date: Total Cholesterol Level",
-                "thyroid_function_date": "Observation Date: Thyroid Function",
-                "thyroid_treatment_status": "At time of, or following measurement of thyroid function, was the patient prescribed any thyroid treatment?",
-                "coeliac_screen_date": "Observation Date: Coeliac Disease Screening",
-                "gluten_free_diet": "Has the patient been recommended a Gluten-free diet?",
-                "psychological_screening_assessment_date": "Observation Date - Psychological Screening Assessment",
-                "psychological_additional_support_status": "Was the patient assessed as requiring additional psychological/CAMHS support outside of MDT clinics?",
-                "smoking_status": "Does the patient smoke?",
-                "smoking_cessation_referral_date": "Date of offer of referral to smoking cessation service (if patient is a current smoker)",
-                "carbohydrate_counting_level_three_education_date": "Date of Level 3 carbohydrate counting education received",
-                "dietician_additional_appointment_offered": "Was the patient offered an additional appointment with a paediatric dietitian?",
-                "dietician_additional_appointment_date": "Date of additional appointment with dietitian",
-                "ketone_meter_training": "Was the patient using (or trained to use) blood ketone testing equipment at time of visit?",
-                "flu_immunisation_recommended_date": "Date that influenza immunisation was recommended",
-                "sick_day_rules_training_date": "Date of provision of advice ('sick-day rules') about managing diabetes during intercurrent illness or episodes of hyperglycaemia",
-                "hospital_admission_date": "Start date (Hospital Provider Spell)",
-                "hospital_discharge_date": "Discharge date (Hospital provider spell)",
-                "hospital_admission_reason": "Reason for admission",
-                "dka_additional_therapies": "Only complete if DKA selected in previous question: During this DKA admission did the patient receive any of the following therapies?",
-                "hospital_admission_other": "Only complete if OTHER selected: Reason for admission (free text)",
-            },
-        )
+        fields = row_to_dict(row, Visit, VISIT_CSV_FIELDS)
 
         form = VisitForm(data=fields, initial={"patient": patient})
         assign_original_row_indices_to_errors(form, row)
@@ -231,19 +198,24 @@ def csv_upload(user, dataframe, csv_file, pdu_pz_code):
             for error in errors:
                 error.original_row_index = row["row_index"]
 
-    def validate_rows(rows):
-        first_row = rows.iloc[0]
+    def validate_visit(patient, row, needs_form):
+        # Visits whose values all passed prevalidation are valid as they are
+        if not needs_form:
+            return Visit(
+                **row_to_dict(row, Visit, VISIT_CSV_FIELDS), is_valid=True, errors=None
+            )
 
-        transfer_fields = validate_transfer(first_row)
-        patient_form = validate_patient_using_form(first_row)
+        return validate_visit_using_form(patient, row)
 
-        visits = rows.apply(
-            lambda row: validate_visit_using_form(patient_form.instance, row),
+    def validate_rows(rows, patient_form, visits_need_form):
+        # VisitForm for rows that need it, otherwise a valid Visit
+        return rows.apply(
+            lambda row: validate_visit(
+                patient_form.instance, row, visits_need_form[row.name]
+            ),
             axis=1,
         )
 
-        return (patient_form, transfer_fields, visits)
-
     def gather_errors(form):
         ret = {}
 
@@ -281,6 +253,10 @@ def csv_upload(user, dataframe, csv_file, pdu_pz_code):
 
         return instance
 
+    def heartbeat():
+        if on_heartbeat:
+            on_heartbeat()
+
     # We only one to create one patient per NHS number
     # Remember the original row number to help users find where the problem was in the CSV
     dataframe["row_index"] = np.arange(dataframe.shape[0])
@@ -289,29 +265,181 @@ def csv_upload(user, dataframe, csv_file, pdu_pz_code):
 
     errors_to_return = {}
 
+    # Validate every row before writing anything, collecting the instances
+    # to bulk insert
+    patients = []
+    transfers = []
+    visits_to_create = []
+
+    # Each distinct postcode in the file is looked up once, in bulk, rather than with
+    # a request per patient
+    heartbeat()
+    postcode_lookup = validate_postcodes(dataframe["Postcode of usual address"])
+    heartbeat()
+
+    # Patients are validated first, as their visits' dates are checked against theirs
+    validated_patients = []
     for _, rows in visits_by_patient:
-        (patient_form, transfer_fields, visits) = validate_rows(rows)
+        first_row = rows.iloc[0]
+        validated_patients.append(
+            (rows, validate_patient_using_form(first_row), validate_transfer(first_row))
+        )
+        heartbeat()
+
+    def patient_date_by_row(field_name):
+        return pd.Series(
+            {
+                row_label: getattr(patient_form.instance, field_name)
+                for rows, patient_form, _ in validated_patients
+                for row_label in rows.index
+            },
+            index=dataframe.index,
+            dtype=object,
+        )
+
+    # Check visit values a whole column at a time, so only rows with a value that
+    # may be invalid are validated with VisitForm
+    visits_need_form = prevalidate_visit_rows(
+        dataframe[list(VISIT_CSV_FIELDS.values())].set_axis(
+            list(VISIT_CSV_FIELDS), axis=1
+        ),
+        date_of_birth=patient_date_by_row("date_of_birth"),
+        diagnosis_date=patient_date_by_row("diagnosis_date"),
+        death_date=patient_date_by_row("death_date"),
+    ).any(axis=1)
+
+    rows_validated = 0
+
+    for rows, patient_form, transfer_fields in validated_patients:
+        visits = validate_rows(rows, patient_form, visits_need_form)
 
         errors_to_return = errors_to_return | gather_errors(patient_form)
 
-        for visit_form in visits:
-            errors_to_return = errors_to_return | gather_errors(visit_form)
+        for visit in visits:
+            if isinstance(visit, VisitForm):
+                errors_to_return = errors_to_return | gather_errors(visit)
+
+        rows_validated += len(rows)
+        if on_progress:
+            on_progress(rows_validated, errors_to_return)
 
         if not has_error_that_would_fail_save(errors_to_return):
             patient = create_instance(Patient, patient_form)
-            patient.save()
+            # bulk_create skips Patient.save
+            patient.set_index_of_multiple_deprivation_quintile()
+            patients.append(patient)
 
             # add the patient to a new Transfer instance
             transfer_fields["paediatric_diabetes_unit"] = pdu
             transfer_fields["patient"] = patient
-            Transfer.objects.create(**transfer_fields)
+            transfers.append(Transfer(**transfer_fields))
 
-            new_submission.patients.add(patient)
-
-            for visit_form in visits:
-                visit = create_instance(Visit, visit_form)
+            for visit in visits:
+                if isinstance(visit, VisitForm):
+                    visit = create_instance(Visit, visit)
                 visit.patient = patient
-                visit.save()
+                visits_to_create.append(visit)
+
+    # All writes happen in one transaction, so if any fails the previous
+    # active submission and its patients are left as they were
+    with transaction.atomic():
+        heartbeat()
+
+        # Set previous submission to inactive
+        if Submission.objects.filter(
+            paediatric_diabetes_unit__pz_code=pdu.pz_code,
+            audit_year=date.today().year,
+            submission_active=True,
+        ).exists():
+            original_submission = Submission.objects.filter(
+                submission_active=True,
+                paediatric_diabetes_unit__pz_code=pdu.pz_code,
+                audit_year=date.today().year,
+            ).get()  # there can be only one of these - store it in a variable in case we need to revert
+        else:
+            original_submission = None
+
+        logger.debug(f"Original submission: {original_submission}")
+
+        # Create new submission for the audit year
+        # It is not possble to create submissions in years other than the current year
+        try:
+            new_submission = Submission.objects.create(
+                paediatric_diabetes_unit=pdu,
+                audit_year=date.today().year,
+                submission_date=timezone.now(),
+                submission_by=user,  # user is the user who is logged in. Passed in as a parameter
+                submission_active=True,
+            )
+
+            if csv_file:
+                # save the csv file with a custom name
+                new_filename = f"{pdu.pz_code}_{timezone.now().strftime('%Y%m%d_%H%M%S')}.csv"
+                new_submission.csv_file.save(new_filename, csv_file)
+        
+            new_submission.save()
+
+        except Exception as e:
+            logger.error(f"Error creating new submission: {e}")
+            # the new submission was not created  - no action required as the previous submission is still active
+            raise ValidationError(
+                {
+                    "csv_upload": "Error creating new submission. The old submission has been restored."
+                }
+            )
+
+        # Deleting the previous submission's patients (and so their visits and
+        # transfers) and creating the new ones each change KPI statuses, which
+        # are all updated once the transaction commits
+        with deferred_patient_kpi_status_updates():
+            # now can delete all patients and visits from the previous active submission
+            if original_submission:
+                try:
+                    logger.debug(
+                        f"Deleting patients from previous submission: {original_submission}"
+                    )
+                    Patient.objects.filter(submissions=original_submission).delete()
+                except Exception as e:
+                    raise ValidationError(
+                        {"csv_upload": "Error deleting patients from previous submission"}
+                    )
+
+            Patient.objects.bulk_create(patients, batch_size=batch_size)
+            Transfer.objects.bulk_create(transfers, batch_size=batch_size)
+            PatientSubmission.objects.bulk_create(
+                [
+                    PatientSubmission(patient=patient, submission=new_submission)
+                    for patient in patients
+                ],
+                batch_size=batch_size,
+            )
+            Visit.objects.bulk_create(visits_to_create, batch_size=batch_size)
+
+            # bulk_create sends no post_save signals, so do what their
+            # receivers would: recompute the new patients' KPI statuses (which
+            # also invalidates the PDU's cached KPI results) and drop the
+            # PDU's running KPI counts, as its patients have changed
+            for patient in patients:
+                schedule_patient_kpi_status_update(patient.pk)
+            schedule_pdu_kpi_counts_drop(pz_codes=[pdu.pz_code])
+
+        # now can delete the any previous active submission's csv file (if it exists)
+        # and remove the path from the field by setting it to None
+        # the rest of the submission will be retained
+        # Deleting the file can't be rolled back, so this is done last
+        if original_submission:
+            original_submission.submission_active = False
+            try:
+                original_submission.save()  # this action will delete the csv file also as per the save method in the model
+            except Exception as e:
+                raise ValidationError(
+                    {"csv_upload": "Error deactivating previous submission"}
+                )
+
+        heartbeat()
+
+    # After the KPI status updates run on commit
+    heartbeat()
 
     if errors_to_return:
         raise ValidationError(errors_to_return)
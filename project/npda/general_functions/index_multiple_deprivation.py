@@ -4,18 +4,68 @@ Calculates the index of multiple deprivation for a given postcode
 
 # Standard imports
 import logging
+from functools import lru_cache
+
 import requests
 
 # Third party imports
+from django.apps import apps
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 
 # RCPCH imports
+from .validate_postcode import postcode_lookup_key
 
 # Logging setup
 logger = logging.getLogger(__name__)
 
+# Postcodes found in the local PostcodeDeprivation table whose quintile is kept in
+# memory, so patients sharing a postcode (or saved more than once) aren't looked up
+# again. Each process has its own, so processes running when the table is reloaded
+# keep their cached quintiles until restarted
+IMD_FOR_POSTCODE_CACHE_SIZE = 10_000
+
+
+class CensusPlatformError(Exception):
+    """
+    The RCPCH Census Platform didn't return a deprivation quintile
+    """
+
 
 def imd_for_postcode(user_postcode: str) -> int:
+    """
+    Returns the index of multiple deprivation quintile of a postcode, or None if it can't be found
+    Postcode - can have spaces or not
+    Looks the postcode up in the local PostcodeDeprivation table first, then the RCPCH Census Platform
+    """
+    postcode = postcode_lookup_key(user_postcode)
+
+    try:
+        return cached_imd_for_postcode(postcode)
+    except ObjectDoesNotExist:
+        pass
+
+    try:
+        return census_platform_imd_for_postcode(postcode)
+    except CensusPlatformError as error:
+        logger.error(f"Could not get deprivation score. {error}")
+        return None
+
+
+@lru_cache(maxsize=IMD_FOR_POSTCODE_CACHE_SIZE)
+def cached_imd_for_postcode(postcode: str) -> int:
+    """
+    The local PostcodeDeprivation table's quintile for a postcode_lookup_key
+    Postcodes not in the table raise PostcodeDeprivation.DoesNotExist, so aren't cached
+    """
+    PostcodeDeprivation = apps.get_model("npda", "PostcodeDeprivation")
+
+    return PostcodeDeprivation.objects.values_list("imd_quintile", flat=True).get(
+        postcode=postcode
+    )
+
+
+def census_platform_imd_for_postcode(user_postcode: str) -> int:
     """
     Makes an API call to the RCPCH Census Platform with postcode and quantile_type
     Postcode - can have spaces or not - this is processed by the API
@@ -29,9 +79,6 @@ def imd_for_postcode(user_postcode: str) -> int:
     )
 
     if response.status_code != 200:
-        logger.error(
-            "Could not get deprivation score. Response status %s", response.status_code
-        )
-        return None
+        raise CensusPlatformError(f"Response status {response.status_code}")
 
     return response.json()["result"]["data_quantile"]
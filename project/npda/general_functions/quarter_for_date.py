@@ -1,5 +1,7 @@
 from datetime import date
 
+from dateutil.relativedelta import relativedelta
+
 
 def retrieve_quarter_for_date(date_instance: date) -> int:
     """
@@ -35,3 +37,14 @@ def retrieve_quarter_for_date(date_instance: date) -> int:
         return 3
     else:
         return 4
+
+
+def get_quarter_end_dates(audit_start_date: date) -> list[date]:
+    """
+    Returns the last day of each quarter of the audit year starting on audit_start_date
+    (see retrieve_quarter_for_date): 30th June, 30th September, 31st December and 31st March
+    """
+    return [
+        audit_start_date + relativedelta(months=3 * quarter) - relativedelta(days=1)
+        for quarter in range(1, 5)
+    ]
@@ -0,0 +1,238 @@
+# python imports
+import logging
+import time
+from datetime import timedelta
+
+# django imports
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+# RCPCH imports
+from ...constants import (
+    UPLOAD_JOB_COMPLETE,
+    UPLOAD_JOB_COMPLETE_WITH_ERRORS,
+    UPLOAD_JOB_FAILED,
+    UPLOAD_JOB_QUEUED,
+    UPLOAD_JOB_RUNNING,
+)
+from ..kpi_class.kpi_snapshots import snapshot_kpis_for_pdu
+from .csv_upload import csv_upload, read_csv
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+# Seconds between saving a running job's progress
+UPLOAD_JOB_PROGRESS_INTERVAL = 1
+
+# Upload jobs shown on the submissions page
+RECENT_UPLOAD_JOBS_COUNT = 5
+
+# A running job whose progress or heartbeat hasn't been saved for this long is
+# taken to have lost its worker, and is failed
+UPLOAD_JOB_STALE_AFTER = timedelta(minutes=30)
+
+
+def error_list(errors):
+    """
+    Flattens csv_upload's errors ({field: [ValidationError]}) to a list of
+    {"field", "message", "original_row_index"}
+    """
+    ret = []
+
+    for field, field_errors in errors.items():
+        for error in field_errors:
+            ret.append(
+                {
+                    "field": field,
+                    # With any params filled in, as text so it can be stored
+                    "message": " ".join(error.messages),
+                    # Errors creating the submission aren't from a row
+                    "original_row_index": getattr(error, "original_row_index", None),
+                }
+            )
+
+    return ret
+
+
+def enqueue_upload_job(user, csv_file, pdu_pz_code):
+    """
+    Queues a csv file for upload to a PDU, for the process_upload_jobs command
+    """
+    PaediatricDiabetesUnit = apps.get_model("npda", "PaediatricDiabetesUnit")
+    UploadJob = apps.get_model("npda", "UploadJob")
+
+    return UploadJob.objects.create(
+        paediatric_diabetes_unit=PaediatricDiabetesUnit.objects.get(
+            pz_code=pdu_pz_code
+        ),
+        uploaded_by=user,
+        csv_file=csv_file,
+    )
+
+
+def fail_stale_upload_jobs():
+    """
+    Fails running jobs whose worker has stopped saving their progress (see
+    UPLOAD_JOB_STALE_AFTER), so they aren't shown as running forever. Their
+    files are kept, as with any failed job.
+    Jobs whose worker is writing their upload are skipped: its transaction has
+    their row locked, and its heartbeats aren't seen until it commits.
+    """
+    UploadJob = apps.get_model("npda", "UploadJob")
+
+    with transaction.atomic():
+        stale_jobs = UploadJob.objects.select_for_update(skip_locked=True).filter(
+            state=UPLOAD_JOB_RUNNING,
+            heartbeat_at__lt=timezone.now() - UPLOAD_JOB_STALE_AFTER,
+        )
+
+        for job in stale_jobs:
+            logger.warning(f"Upload job {job.pk} stopped running, marking it failed")
+            job.state = UPLOAD_JOB_FAILED
+            job.errors = job.errors + [
+                {
+                    "field": None,
+                    "message": "The upload stopped before it finished. Please upload the file again.",
+                    "original_row_index": None,
+                }
+            ]
+            job.error_count = len(job.errors)
+            job.finished_at = timezone.now()
+            job.save(update_fields=["state", "errors", "error_count", "finished_at"])
+
+
+def claim_next_upload_job():
+    """
+    Marks the oldest queued job as running and returns it, or None if there are none.
+    Jobs locked by another worker are skipped, so each job is only run once.
+    Running jobs whose worker has stopped are failed first.
+    """
+    UploadJob = apps.get_model("npda", "UploadJob")
+
+    fail_stale_upload_jobs()
+
+    with transaction.atomic():
+        job = (
+            UploadJob.objects.select_for_update(skip_locked=True)
+            .filter(state=UPLOAD_JOB_QUEUED)
+            .order_by("created_at", "pk")
+            .first()
+        )
+
+        if job is None:
+            return None
+
+        job.state = UPLOAD_JOB_RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.save(update_fields=["state", "started_at", "heartbeat_at"])
+
+    return job
+
+
+def process_upload_job(job):
+    """
+    Runs csv_upload on a claimed job's file, saving the rows processed and errors
+    found as it goes, then its final state. Its heartbeat is also saved through the
+    steps that don't report progress, so it isn't taken to have stopped
+    """
+    pz_code = job.paediatric_diabetes_unit.pz_code
+    last_saved = time.monotonic()
+
+    def record_progress(rows_processed, errors):
+        nonlocal last_saved
+
+        job.rows_processed = rows_processed
+        job.errors = error_list(errors)
+        job.error_count = len(job.errors)
+
+        if time.monotonic() - last_saved >= UPLOAD_JOB_PROGRESS_INTERVAL:
+            job.heartbeat_at = timezone.now()
+            job.save(
+                update_fields=[
+                    "rows_processed",
+                    "errors",
+                    "error_count",
+                    "heartbeat_at",
+                ]
+            )
+            last_saved = time.monotonic()
+
+    def save_heartbeat():
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=["heartbeat_at"])
+
+    try:
+        with job.csv_file.open("rb") as csv_file:
+            dataframe = read_csv(csv_file)
+            job.total_rows = len(dataframe)
+            job.heartbeat_at = timezone.now()
+            job.save(update_fields=["total_rows", "heartbeat_at"])
+
+            # You can't read the same file twice without resetting it
+            csv_file.seek(0)
+
+            csv_upload(
+                user=job.uploaded_by,
+                dataframe=dataframe,
+                csv_file=csv_file,
+                pdu_pz_code=pz_code,
+                on_progress=record_progress,
+                on_heartbeat=save_heartbeat,
+            )
+
+        job.state = UPLOAD_JOB_COMPLETE
+    except ValidationError as error:
+        job.errors = error_list(error.error_dict)
+        job.error_count = len(job.errors)
+        if "csv_upload" in error.error_dict:
+            # Creating the submission failed, so nothing was saved
+            job.state = UPLOAD_JOB_FAILED
+        else:
+            # Rows without errors are saved either way
+            job.state = UPLOAD_JOB_COMPLETE_WITH_ERRORS
+    except Exception as error:
+        logger.exception(f"Upload job {job.pk} for {pz_code} failed")
+        job.errors = job.errors + [
+            {"field": None, "message": str(error), "original_row_index": None}
+        ]
+        job.error_count = len(job.errors)
+        job.state = UPLOAD_JOB_FAILED
+
+    if job.state != UPLOAD_JOB_FAILED:
+        job.rows_processed = job.total_rows
+        save_heartbeat()
+        try:
+            snapshot_kpis_for_pdu(pz_code)
+        except Exception as e:
+            logger.error(f"Failed to snapshot KPIs for {pz_code}: {e}")
+        save_heartbeat()
+
+        # The submission keeps its own copy of the file. Failed jobs keep theirs,
+        # so they can be queued again
+        job.csv_file.delete(save=False)
+        job.csv_file = None
+
+    job.finished_at = timezone.now()
+    job.save()
+
+    return job
+
+
+def recent_upload_jobs(pdu_pz_code, count=RECENT_UPLOAD_JOBS_COUNT):
+    """
+    A PDU's most recent upload jobs, newest first, and whether any are unfinished
+    """
+    UploadJob = apps.get_model("npda", "UploadJob")
+
+    # Or the page would poll a job whose worker has stopped forever
+    fail_stale_upload_jobs()
+
+    upload_jobs = list(
+        UploadJob.objects.filter(paediatric_diabetes_unit__pz_code=pdu_pz_code)
+        .select_related("uploaded_by")
+        .order_by("-created_at", "-pk")[:count]
+    )
+
+    return upload_jobs, any(not job.is_finished for job in upload_jobs)
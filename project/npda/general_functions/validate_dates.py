@@ -19,6 +19,15 @@ def validate_date(
     if date_under_examination is None:
         return valid, None
 
+    if date_under_examination > date.today():
+        error = {
+            f"{date_under_examination_field_name}": [
+                f"'{date_under_examination_label_name}' cannot be in the future."
+            ]
+        }
+        errors.append(error)
+        valid = False
+
     if date_of_birth is not None:
         if date_under_examination < date_of_birth:
             error = {
@@ -1,11 +1,12 @@
 # python
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # django
 
 # third party libraries
 import requests
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 
 # npda imports
 from django.conf import settings
@@ -13,14 +14,25 @@ from django.conf import settings
 # Logging
 logger = logging.getLogger(__name__)
 
+# Most postcodes postcodes.io accepts in one bulk lookup
+POSTCODE_BULK_LOOKUP_BATCH_SIZE = 100
+
+# Most bulk lookups in flight at once
+POSTCODE_BULK_LOOKUP_MAX_CONCURRENCY = 4
+
 
 def validate_postcode(postcode):
     """
-    Tests if postcode is valid
-    Returns boolean
+    Tests if postcode is valid, with the postcodes.io lookup validate_postcodes uses in bulk,
+    or the provider at POSTCODE_API_BASE_URL (findthatpostcode) if that is set
+    Returns {"normalised_postcode"}, or None if invalid
+    Raises RequestException if the lookup failed, including with an unexpected response
     """
 
-    request_url = f"{settings.POSTCODE_API_BASE_URL}/postcodes/{postcode}.json"
+    if settings.POSTCODE_API_BASE_URL:
+        request_url = f"{settings.POSTCODE_API_BASE_URL.rstrip('/')}/postcodes/{postcode}.json"
+    else:
+        request_url = f"{settings.POSTCODES_IO_API_BASE_URL.rstrip('/')}/postcodes/{postcode}"
 
     try:
         response = requests.get(
@@ -28,12 +40,91 @@ def validate_postcode(postcode):
             timeout=10,  # times out after 10 seconds
         )
         response.raise_for_status()
-        
+
+        if settings.POSTCODE_API_BASE_URL:
+            normalised_postcode = response.json()["data"]["id"]
+        else:
+            normalised_postcode = response.json()["result"]["postcode"]
+
         return {
-            "normalised_postcode": response.json()["data"]["id"]
+            "normalised_postcode": normalised_postcode
         }
     except HTTPError as e:
         logger.error(e.response.text)
         return None
+    except (KeyError, TypeError, ValueError) as e:
+        raise RequestException(f"Unexpected response looking up postcode: {e!r}") from e
+
+
+def postcode_lookup_key(postcode):
+    """
+    Postcode in upper case without spaces or dashes, as PatientForm cleans it
+    """
+    return postcode.upper().replace(" ", "").replace("-", "")
+
+
+def validate_postcodes(
+    postcodes,
+    batch_size=POSTCODE_BULK_LOOKUP_BATCH_SIZE,
+    max_concurrency=POSTCODE_BULK_LOOKUP_MAX_CONCURRENCY,
+):
+    """
+    Tests many postcodes with bulk lookups, looking each distinct postcode up once
+    Returns a lookup table of postcode_lookup_key(postcode): the same result as
+    validate_postcode ({"normalised_postcode"}, or None if invalid)
+
+    Postcodes in a batch whose lookup failed are left out, so they can be validated
+    one at a time instead
+    """
+    lookup_keys = sorted(
+        {
+            postcode_lookup_key(postcode)
+            for postcode in postcodes
+            if isinstance(postcode, str) and postcode.strip()
+        }
+    )
+    batches = [
+        lookup_keys[start : start + batch_size]
+        for start in range(0, len(lookup_keys), batch_size)
+    ]
+
+    lookup = {}
+    if not batches:
+        return lookup
 
-    return True
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(batches))) as executor:
+        for batch_lookup in executor.map(lookup_postcode_batch, batches):
+            lookup.update(batch_lookup)
+
+    return lookup
+
+
+def lookup_postcode_batch(postcodes):
+    """
+    Looks up a batch of postcodes with the postcodes.io bulk lookup
+    Returns {postcode_lookup_key(postcode): {"normalised_postcode"} or None}, or {} if
+    the lookup failed or its response wasn't as expected
+    """
+
+    request_url = f"{settings.POSTCODES_IO_API_BASE_URL.rstrip('/')}/postcodes"
+
+    try:
+        response = requests.post(
+            url=request_url,
+            json={"postcodes": postcodes},
+            timeout=10,  # times out after 10 seconds
+        )
+        response.raise_for_status()
+
+        return {
+            postcode_lookup_key(lookup["query"]): (
+                {"normalised_postcode": lookup["result"]["postcode"]}
+                if lookup["result"]
+                else None
+            )
+            for lookup in response.json()["result"]
+        }
+    except (RequestException, KeyError, TypeError, ValueError) as e:
+        # Including responses in an unexpected format. These postcodes are unvalidated
+        logger.warning(f"Error looking up {len(postcodes)} postcodes in bulk: {e!r}")
+        return {}
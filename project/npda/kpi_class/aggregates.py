@@ -0,0 +1,16 @@
+"""Custom aggregates for the KPI calculations."""
+
+# Django imports
+from django.db.models import Aggregate, FloatField
+
+
+class Median(Aggregate):
+    """Median (PostgreSQL `percentile_cont`), e.g. per patient with
+    `.values("patient").annotate(median_hba1c=Median("hba1c"))`.
+
+    Django has no Median aggregate, as not every database supports one."""
+
+    function = "percentile_cont"
+    name = "Median"
+    template = "%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)"
+    output_field = FloatField()
@@ -0,0 +1,777 @@
+"""In-memory (pandas) KPI engine.
+
+Loads the patients set on a `CalculateKPIS` instance, together with their
+visits and transfers, once into columnar DataFrames. Every KPI is then
+evaluated as a vectorised boolean mask over the patients frame, rather than
+as its own set of SQL queries.
+
+The rules in here MUST mirror the `calculate_kpi_*` methods in
+`project.npda.kpi_class.kpis`. Parity between the two engines is asserted in
+`project/npda/tests/kpi_calculations/test_kpi_dataframe_engine.py`.
+"""
+
+# Python imports
+import logging
+from datetime import date, timedelta
+from typing import Hashable, Iterable, Optional
+
+# Third party imports
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+# Django imports
+from django.db.models import QuerySet
+
+# NPDA Imports
+from project.constants.albuminuria_stage import ALBUMINURIA_STAGES
+from project.constants.diabetes_types import DIABETES_TYPES
+from project.constants.hospital_admission_reasons import (
+    HOSPITAL_ADMISSION_REASONS,
+)
+from project.constants.retinal_screening_results import (
+    RETINAL_SCREENING_RESULTS,
+)
+from project.constants.smoking_status import SMOKING_STATUS
+from project.constants.types.kpi_types import KPIResult
+from project.constants.yes_no_unknown import YES_NO_UNKNOWN
+from project.npda.models import Patient, Transfer, Visit
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Patient fields used in calculations
+PATIENT_FIELDS = [
+    "pk",
+    "nhs_number",
+    "date_of_birth",
+    "diabetes_type",
+    "diagnosis_date",
+    "death_date",
+]
+
+# Visit date fields, converted to datetime64 once loaded
+VISIT_DATE_FIELDS = [
+    "visit_date",
+    "height_weight_observation_date",
+    "hba1c_date",
+    "blood_pressure_observation_date",
+    "foot_examination_observation_date",
+    "retinal_screening_observation_date",
+    "albumin_creatinine_ratio_date",
+    "total_cholesterol_date",
+    "thyroid_function_date",
+    "coeliac_screen_date",
+    "psychological_screening_assessment_date",
+    "smoking_cessation_referral_date",
+    "carbohydrate_counting_level_three_education_date",
+    "dietician_additional_appointment_date",
+    "flu_immunisation_recommended_date",
+    "sick_day_rules_training_date",
+    "hospital_admission_date",
+    "hospital_discharge_date",
+]
+
+# Visit value fields (measurements and choices)
+VISIT_VALUE_FIELDS = [
+    "height",
+    "weight",
+    "hba1c",
+    "treatment",
+    "closed_loop_system",
+    "glucose_monitoring",
+    "systolic_blood_pressure",
+    "retinal_screening_result",
+    "albumin_creatinine_ratio",
+    "albuminuria_stage",
+    "thyroid_treatment_status",
+    "gluten_free_diet",
+    "psychological_additional_support_status",
+    "smoking_status",
+    "dietician_additional_appointment_offered",
+    "ketone_meter_training",
+    "hospital_admission_reason",
+]
+
+VISIT_FIELDS = ["pk", "patient_id"] + VISIT_DATE_FIELDS + VISIT_VALUE_FIELDS
+
+# The observation dates used to define "an observation within the audit
+# period" (KPIs 6 and 7)
+OBSERVATION_DATE_FIELDS = [
+    "height_weight_observation_date",
+    "hba1c_date",
+    "blood_pressure_observation_date",
+    "foot_examination_observation_date",
+    "retinal_screening_observation_date",
+    "albumin_creatinine_ratio_date",
+    "total_cholesterol_date",
+    "thyroid_function_date",
+    "coeliac_screen_date",
+    "psychological_screening_assessment_date",
+]
+
+# Standard KPIs plus 32 which has 3 sub KPIs
+KPI_NUMBERS = list(range(1, 32)) + [321, 322, 323] + list(range(33, 50))
+
+# KPIs 1 - 12 are counts only, so pass / fail does not apply
+COUNT_ONLY_KPI_NUMBERS = list(range(1, 13))
+
+# KPIs 13 - 20: treatment regimen (item 20) value for each KPI
+TREATMENT_REGIMEN_KPIS = {kpi_number: kpi_number - 12 for kpi_number in range(13, 21)}
+
+
+class DataFrameKPIEngine:
+    """
+    Evaluates all KPIs for a set of patients in memory.
+
+    Usage:
+        engine = DataFrameKPIEngine(audit_start_date, audit_end_date)
+        engine.load(patients)
+        kpi_results = engine.calculate_kpi_results(total_patients_count)
+
+    After `load()`, the per-patient membership for every KPI is available
+    through the `eligible` and `passed` DataFrames (indexed by patient pk,
+    one boolean column per KPI number).
+    """
+
+    def __init__(self, audit_start_date: date, audit_end_date: date):
+        self.audit_start_date = audit_start_date
+        self.audit_end_date = audit_end_date
+
+        self._start = pd.Timestamp(audit_start_date)
+        self._end = pd.Timestamp(audit_end_date)
+
+    def load(self, patients: QuerySet[Patient]) -> None:
+        """Fetch patients, their visits and transfers in three queries, then
+        evaluate every KPI mask."""
+
+        patient_pks = patients.order_by().values("pk")
+
+        self.patients_df = self._records_to_frame(
+            Patient.objects.filter(pk__in=patient_pks)
+            .order_by()
+            .values(*PATIENT_FIELDS),
+            PATIENT_FIELDS,
+        ).set_index("pk")
+        for field in ["date_of_birth", "diagnosis_date", "death_date"]:
+            self.patients_df[field] = pd.to_datetime(self.patients_df[field])
+
+        self.visits_df = self._records_to_frame(
+            Visit.objects.filter(patient_id__in=patient_pks)
+            .order_by()
+            .values(*VISIT_FIELDS),
+            VISIT_FIELDS,
+        )
+        for field in VISIT_DATE_FIELDS:
+            self.visits_df[field] = pd.to_datetime(self.visits_df[field])
+        self.visits_df["hba1c"] = pd.to_numeric(
+            self.visits_df["hba1c"], errors="coerce"
+        )
+        # Each visit carries its patient's diagnosis date for the
+        # "within x days of diagnosis" rules
+        self.visits_df["diagnosis_date"] = (
+            self.patients_df["diagnosis_date"]
+            .reindex(self.visits_df["patient_id"])
+            .to_numpy()
+        )
+
+        # Only need to know who left the service during the audit period
+        self._service_leaving_dates = list(
+            Transfer.objects.filter(
+                patient_id__in=patient_pks,
+                date_leaving_service__range=(
+                    self.audit_start_date,
+                    self.audit_end_date,
+                ),
+            ).values_list("patient_id", "date_leaving_service")
+        )
+        self._loaded_audit_start_date = self.audit_start_date
+        self._loaded_audit_end_date = self.audit_end_date
+
+        self._evaluate()
+
+    def set_audit_period(self, audit_start_date: date, audit_end_date: date) -> None:
+        """Re-evaluates every KPI mask for another audit period within the
+        loaded one (e.g. one of several audit years loaded together),
+        without loading anything again. Results are the same as loading an
+        engine for that period.
+
+        Transfers are only loaded for the original audit period, so the new
+        period can't start before or end after it.
+        """
+
+        if (
+            audit_start_date < self._loaded_audit_start_date
+            or audit_end_date > self._loaded_audit_end_date
+        ):
+            raise ValueError(
+                f"Audit period {audit_start_date} - {audit_end_date} is outside "
+                f"the loaded audit period ({self._loaded_audit_start_date} - "
+                f"{self._loaded_audit_end_date})"
+            )
+
+        self.audit_start_date = audit_start_date
+        self.audit_end_date = audit_end_date
+        self._start = pd.Timestamp(audit_start_date)
+        self._end = pd.Timestamp(audit_end_date)
+        self._evaluate()
+
+    def set_audit_end_date(self, audit_end_date: date) -> None:
+        """Re-evaluates every KPI mask for the audit period ending on
+        `audit_end_date` instead (e.g. the end of a quarter), see
+        `set_audit_period`."""
+
+        self.set_audit_period(self.audit_start_date, audit_end_date)
+
+    def _evaluate(self) -> None:
+        """Builds the `eligible` / `passed` masks for every KPI, plus the
+        per-patient values used by KPIs 32.1, 44 and 45."""
+
+        self.left_service_pks = {
+            patient_id
+            for patient_id, date_leaving_service in self._service_leaving_dates
+            if self.audit_start_date <= date_leaving_service <= self.audit_end_date
+        }
+
+        self.eligible = pd.DataFrame(index=self.patients_df.index)
+        self.passed = pd.DataFrame(index=self.patients_df.index)
+
+        self._evaluate_kpis_1_12()
+        self._evaluate_kpis_13_24()
+        self._evaluate_kpis_25_32()
+        self._evaluate_kpis_33_43()
+        self._evaluate_kpis_44_49()
+
+    def calculate_kpi_results(
+        self, total_patients_count: int
+    ) -> dict[int, KPIResult]:
+        """Aggregates the per-patient masks into a KPIResult for each KPI
+        number. `patient_querysets` are left as None; the caller decides
+        whether to build them from `get_patient_pks`."""
+
+        return self.calculate_kpi_results_by_group(
+            patient_groups=pd.Series(0, index=self.patients_df.index),
+            total_patients_counts={0: total_patients_count},
+        )[0]
+
+    def calculate_kpi_results_by_group(
+        self,
+        patient_groups: pd.Series,
+        total_patients_counts: Optional[dict[Hashable, int]] = None,
+    ) -> dict[Hashable, dict[int, KPIResult]]:
+        """Aggregates the per-patient masks into KPIResults for each group of
+        patients (e.g. each PDU) in a single groupby.
+
+        Params:
+            * patient_groups (pd.Series) - group key, indexed by patient pk.
+            A patient may appear in more than one group.
+            * total_patients_counts (dict) - total patients for each group
+            key. Defaults to the number of patients in each group.
+        """
+
+        patient_pks = patient_groups.index
+        group_keys = patient_groups.to_numpy()
+
+        if total_patients_counts is None:
+            total_patients_counts = patient_groups.value_counts().to_dict()
+        groups = list(total_patients_counts)
+
+        def group_sums(frame):
+            return (
+                frame.loc[patient_pks]
+                .groupby(group_keys)
+                .sum()
+                .reindex(groups)
+                .fillna(0)
+            )
+
+        kpi_5_eligible = self.eligible[5]
+        eligible_counts = group_sums(self.eligible)
+        passed_counts = group_sums(self.passed)
+        expected_health_checks = group_sums(
+            self.expected_health_checks.where(kpi_5_eligible, 0)
+        )
+        completed_health_checks = group_sums(
+            self.completed_health_checks.where(kpi_5_eligible, 0)
+        )
+        # Mean (44) and median (45) of each eligible patient's median HbA1c
+        median_hba1c_by_group = (
+            self.median_hba1c.where(self.eligible[44])
+            .loc[patient_pks]
+            .groupby(group_keys)
+        )
+        aggregated_median_hba1c = {
+            44: median_hba1c_by_group.mean().reindex(groups).fillna(0),
+            45: median_hba1c_by_group.median().reindex(groups).fillna(0),
+        }
+
+        kpi_results_by_group = {}
+        for group in groups:
+            total_patients_count = total_patients_counts[group]
+            kpi_results = {}
+
+            for kpi_number in KPI_NUMBERS:
+                total_eligible = int(eligible_counts.at[group, kpi_number])
+                total_ineligible = total_patients_count - total_eligible
+
+                if kpi_number in COUNT_ONLY_KPI_NUMBERS:
+                    total_passed = None
+                    total_failed = None
+
+                elif kpi_number == 321:
+                    # Health checks rather than patients (see KPI 32.1 docstring)
+                    total_eligible = int(expected_health_checks[group])
+                    total_ineligible = total_patients_count - int(
+                        eligible_counts.at[group, 5]
+                    )
+                    total_passed = int(completed_health_checks[group])
+                    total_failed = total_eligible - total_passed
+
+                elif kpi_number in [44, 45]:
+                    total_passed = float(aggregated_median_hba1c[kpi_number][group])
+                    total_failed = -1
+
+                else:
+                    total_passed = int(passed_counts.at[group, kpi_number])
+                    total_failed = total_eligible - total_passed
+
+                kpi_results[kpi_number] = KPIResult(
+                    total_eligible=total_eligible,
+                    total_ineligible=total_ineligible,
+                    total_passed=total_passed,
+                    total_failed=total_failed,
+                )
+
+            kpi_results_by_group[group] = kpi_results
+
+        return kpi_results_by_group
+
+    def get_patient_pks(
+        self, kpi_number: int, patient_pks: Optional[Iterable[int]] = None
+    ) -> dict[str, list[int]]:
+        """Returns the eligible, ineligible, passed and failed patient pks for
+        a KPI, optionally only for a subset of the loaded patients.
+
+        Mirrors the patient querysets returned by the SQL engine, including
+        the count-only KPIs where passed / failed are just the eligible set.
+        """
+
+        def select(mask: pd.Series) -> pd.Series:
+            return mask if patient_pks is None else mask.loc[patient_pks]
+
+        eligible = select(self.eligible[kpi_number])
+
+        if kpi_number == 2:
+            # KPI 2 returns the KPI 1 cohort as passed / failed
+            passed = failed = select(self.eligible[1])
+        elif kpi_number in COUNT_ONLY_KPI_NUMBERS:
+            passed = failed = eligible
+        elif kpi_number == 321:
+            passed = select(self._measure_5_lt_12yo)
+            failed = eligible & ~passed
+        elif kpi_number in [322, 323, 44, 45]:
+            passed = eligible
+            failed = eligible & ~passed
+        else:
+            passed = select(self.passed[kpi_number])
+            failed = eligible & ~passed
+
+        return {
+            "eligible": self._mask_to_pks(eligible),
+            "ineligible": self._mask_to_pks(~eligible),
+            "passed": self._mask_to_pks(passed),
+            "failed": self._mask_to_pks(failed),
+        }
+
+    # ---------------------------------------------------------------------
+    # KPI definitions
+    # ---------------------------------------------------------------------
+
+    def _evaluate_kpis_1_12(self) -> None:
+        pts = self.patients_df
+        visits = self.visits_df
+        start = self.audit_start_date
+
+        valid_attributes = pts["nhs_number"].notna() & pts["date_of_birth"].notna()
+        below_25 = pts["date_of_birth"] > pd.Timestamp(start - relativedelta(years=25))
+        self._gte_12yo = pts["date_of_birth"] <= pd.Timestamp(
+            start - relativedelta(years=12)
+        )
+        is_t1dm = pts["diabetes_type"] == DIABETES_TYPES[0][0]
+        diagnosed_in_audit_period = self._in_audit_period(pts["diagnosis_date"])
+        died_in_audit_period = self._in_audit_period(pts["death_date"])
+        left_service = pd.Series(
+            pts.index.isin(list(self.left_service_pks)), index=pts.index
+        )
+        # Exclusions for a complete year of care (KPIs 5 and 6)
+        complete_year_exclusions = (
+            diagnosed_in_audit_period | left_service | died_in_audit_period
+        )
+
+        # KPI 1
+        kpi_1 = (
+            valid_attributes
+            & below_25
+            & self._has_visit(self._in_audit_period(visits["visit_date"]))
+        )
+        self.eligible[1] = kpi_1
+        # KPI 2
+        self.eligible[2] = kpi_1 & diagnosed_in_audit_period
+        # KPI 3
+        self.eligible[3] = kpi_1 & is_t1dm
+        # KPI 4
+        self.eligible[4] = kpi_1 & is_t1dm & self._gte_12yo
+        # KPI 5
+        self.eligible[5] = kpi_1 & ~complete_year_exclusions
+
+        # KPI 6 - an observation within the audit period, on a visit within
+        # the audit period
+        any_observation_in_audit_period = self._any_in_audit_period(
+            visits, OBSERVATION_DATE_FIELDS
+        )
+        self.eligible[6] = (
+            valid_attributes
+            & ~complete_year_exclusions
+            & self._gte_12yo
+            & is_t1dm
+            & self._has_visit(
+                any_observation_in_audit_period
+                & self._in_audit_period(visits["visit_date"])
+            )
+        )
+        # KPI 7 - an observation within the audit period (any visit date)
+        self.eligible[7] = (
+            valid_attributes
+            & below_25
+            & is_t1dm
+            & diagnosed_in_audit_period
+            & self._has_visit(any_observation_in_audit_period)
+        )
+        # Visits that made a patient KPI 7 eligible (KPIs 41 and 42 only count
+        # these visits)
+        self._kpi_7_visits = any_observation_in_audit_period
+
+        # KPI 8
+        self.eligible[8] = kpi_1 & died_in_audit_period
+        # KPI 9
+        self.eligible[9] = kpi_1 & left_service
+        # KPI 10
+        self.eligible[10] = kpi_1 & self._has_visit(visits["gluten_free_diet"] == 1)
+        # KPI 11
+        self.eligible[11] = kpi_1 & self._has_visit(
+            visits["thyroid_treatment_status"].isin([2, 3])
+        )
+        # KPI 12
+        self.eligible[12] = kpi_1 & self._has_visit(
+            visits["ketone_meter_training"] == 1
+        )
+
+        for kpi_number in COUNT_ONLY_KPI_NUMBERS:
+            self.passed[kpi_number] = self.eligible[kpi_number]
+
+    def _evaluate_kpis_13_24(self) -> None:
+        visits = self.visits_df
+        kpi_1 = self.eligible[1]
+
+        # KPIs 13 - 20: treatment regimen
+        for kpi_number, treatment in TREATMENT_REGIMEN_KPIS.items():
+            self.eligible[kpi_number] = kpi_1
+            self.passed[kpi_number] = kpi_1 & self._has_visit(
+                visits["treatment"] == treatment
+            )
+
+        # KPIs 21 - 23: glucose monitoring
+        self.eligible[21] = kpi_1
+        self.passed[21] = kpi_1 & self._has_visit(
+            visits["glucose_monitoring"].isin([2, 3])
+        )
+        self.eligible[22] = kpi_1
+        self.passed[22] = kpi_1 & self._has_visit(visits["glucose_monitoring"] == 4)
+        self.eligible[23] = self.eligible[2]
+        self.passed[23] = self.eligible[2] & self._has_visit(
+            visits["glucose_monitoring"] == 4
+        )
+
+        # KPI 24: most recent insulin pump visit is part of a closed loop
+        # system. NOTE: matches Postgres DESC ordering where NULLs come first
+        pump_visits = visits[visits["treatment"].isin([3, 6])]
+        latest_pump_visits = pump_visits.sort_values(
+            "visit_date", ascending=False, na_position="first", kind="stable"
+        ).drop_duplicates("patient_id", keep="first")
+        closed_loop_pks = latest_pump_visits.loc[
+            latest_pump_visits["closed_loop_system"].isin([2, 3, 4]), "patient_id"
+        ]
+        self.eligible[24] = kpi_1 & self._has_visit(visits["treatment"].isin([3, 6]))
+        self.passed[24] = self.eligible[24] & self._pks_to_mask(closed_loop_pks)
+
+    def _evaluate_kpis_25_32(self) -> None:
+        visits = self.visits_df
+        kpi_5 = self.eligible[5]
+        kpi_6 = self.eligible[6]
+
+        hba1c_check = self._has_visit(
+            visits["hba1c"].notna() & self._in_audit_period(visits["hba1c_date"])
+        )
+        bmi_check = self._has_visit(
+            visits["height"].notna()
+            & visits["weight"].notna()
+            & self._in_audit_period(visits["height_weight_observation_date"])
+        )
+        thyroid_check = self._has_visit(
+            self._in_audit_period(visits["thyroid_function_date"])
+        )
+        bp_check = self._has_visit(
+            visits["systolic_blood_pressure"].notna()
+            & self._in_audit_period(visits["blood_pressure_observation_date"])
+        )
+        urinary_albumin_check = self._has_visit(
+            visits["albumin_creatinine_ratio"].notna()
+            & self._in_audit_period(visits["albumin_creatinine_ratio_date"])
+        )
+        retinal_screening_check = self._has_visit(
+            visits["retinal_screening_result"].isin(
+                [RETINAL_SCREENING_RESULTS[0][0], RETINAL_SCREENING_RESULTS[1][0]]
+            )
+            & self._in_audit_period(visits["retinal_screening_observation_date"])
+        )
+        foot_exam_check = self._has_visit(
+            self._in_audit_period(visits["foot_examination_observation_date"])
+        )
+
+        for kpi_number, eligible, check in [
+            (25, kpi_5, hba1c_check),
+            (26, kpi_5, bmi_check),
+            (27, kpi_5, thyroid_check),
+            (28, kpi_6, bp_check),
+            (29, kpi_6, urinary_albumin_check),
+            (30, kpi_6, retinal_screening_check),
+            (31, kpi_6, foot_exam_check),
+        ]:
+            self.eligible[kpi_number] = eligible
+            self.passed[kpi_number] = eligible & check
+
+        # KPI 32: health checks
+        self._measure_5_lt_12yo = kpi_5 & ~self._gte_12yo
+        measure_5_gte_12yo = kpi_5 & self._gte_12yo
+
+        lt_12yo_checks = [hba1c_check, bmi_check, thyroid_check]
+        gte_12yo_checks = lt_12yo_checks + [
+            bp_check,
+            urinary_albumin_check,
+            foot_exam_check,
+        ]
+        completed_lt_12yo = sum(check.astype(int) for check in lt_12yo_checks)
+        completed_gte_12yo = sum(check.astype(int) for check in gte_12yo_checks)
+
+        self.expected_health_checks = pd.Series(
+            np.where(self._gte_12yo, 6, 3), index=self.patients_df.index
+        )
+        self.completed_health_checks = completed_lt_12yo.where(
+            ~self._gte_12yo, completed_gte_12yo
+        )
+
+        self.eligible[321] = kpi_5
+        self.passed[321] = kpi_5 & (
+            self.completed_health_checks == self.expected_health_checks
+        )
+        self.eligible[322] = self._measure_5_lt_12yo
+        self.passed[322] = self._measure_5_lt_12yo & (completed_lt_12yo == 3)
+        self.eligible[323] = measure_5_gte_12yo
+        self.passed[323] = measure_5_gte_12yo & (completed_gte_12yo == 6)
+
+    def _evaluate_kpis_33_43(self) -> None:
+        visits = self.visits_df
+        kpi_1 = self.eligible[1]
+        kpi_5 = self.eligible[5]
+        kpi_6 = self.eligible[6]
+        visit_in_audit_period = self._in_audit_period(visits["visit_date"])
+
+        # KPI 33: at least 4 HbA1c measurements
+        hba1c_visits = self._count_visits(
+            visit_in_audit_period
+            & visits["hba1c"].notna()
+            & self._in_audit_period(visits["hba1c_date"])
+        )
+        self.eligible[33] = kpi_5
+        self.passed[33] = kpi_5 & (hba1c_visits >= 4)
+
+        # KPIs 34 - 40: at least one visit in the audit period with an entry
+        for kpi_number, eligible, visit_condition in [
+            (
+                34,
+                kpi_5,
+                self._in_audit_period(
+                    visits["psychological_screening_assessment_date"]
+                ),
+            ),
+            (
+                35,
+                kpi_6,
+                visits["smoking_status"].isin(
+                    [SMOKING_STATUS[0][0], SMOKING_STATUS[1][0]]
+                ),
+            ),
+            (
+                36,
+                kpi_6,
+                self._in_audit_period(visits["smoking_cessation_referral_date"]),
+            ),
+            (37, kpi_5, visits["dietician_additional_appointment_offered"] == 1),
+            (
+                38,
+                kpi_5,
+                self._in_audit_period(visits["dietician_additional_appointment_date"]),
+            ),
+            (
+                39,
+                kpi_5,
+                self._in_audit_period(visits["flu_immunisation_recommended_date"]),
+            ),
+            (
+                40,
+                kpi_1,
+                self._in_audit_period(visits["sick_day_rules_training_date"]),
+            ),
+        ]:
+            self.eligible[kpi_number] = eligible
+            self.passed[kpi_number] = eligible & self._has_visit(
+                visit_in_audit_period & visit_condition
+            )
+
+        # KPIs 41 - 42: measure 7 diagnosed at least 90 days before audit end
+        diagnosed_90d_before_end = self.patients_df["diagnosis_date"] < pd.Timestamp(
+            self.audit_end_date - relativedelta(days=90)
+        )
+        t1dm_90d_before_end = self.eligible[7] & diagnosed_90d_before_end
+
+        for kpi_number, date_field in [
+            (41, "coeliac_screen_date"),
+            (42, "thyroid_function_date"),
+        ]:
+            self.eligible[kpi_number] = t1dm_90d_before_end
+            self.passed[kpi_number] = t1dm_90d_before_end & self._has_visit(
+                self._kpi_7_visits
+                & self._within_days_of_diagnosis(visits[date_field], 90, 90)
+            )
+
+        # KPI 43: measure 7 diagnosed at least 14 days before audit end
+        diagnosed_14d_before_end = self.patients_df["diagnosis_date"] < pd.Timestamp(
+            self.audit_end_date - relativedelta(days=14)
+        )
+        self.eligible[43] = self.eligible[7] & diagnosed_14d_before_end
+        self.passed[43] = self.eligible[43] & self._has_visit(
+            self._within_days_of_diagnosis(
+                visits["carbohydrate_counting_level_three_education_date"], 7, 14
+            )
+        )
+
+    def _evaluate_kpis_44_49(self) -> None:
+        visits = self.visits_df
+        kpi_1 = self.eligible[1]
+        visit_in_audit_period = self._in_audit_period(visits["visit_date"])
+
+        # KPIs 44 - 45: per patient median HbA1c, excluding measurements taken
+        # within 90 days of diagnosis
+        valid_hba1c_visits = visits[
+            visit_in_audit_period
+            & (visits["hba1c_date"] >= visits["diagnosis_date"] + timedelta(days=90))
+            & visits["hba1c"].notna()
+        ]
+        self.median_hba1c = (
+            valid_hba1c_visits.groupby("patient_id")["hba1c"]
+            .median()
+            .reindex(self.patients_df.index)
+        )
+        self.eligible[44] = kpi_1
+        self.passed[44] = kpi_1
+        self.eligible[45] = kpi_1
+        self.passed[45] = kpi_1
+
+        # KPIs 46 - 49
+        admitted_in_audit_period = self._in_audit_period(
+            visits["hospital_admission_date"]
+        ) | self._in_audit_period(visits["hospital_discharge_date"])
+
+        for kpi_number, visit_condition in [
+            (
+                46,
+                admitted_in_audit_period
+                & visits["hospital_admission_reason"].isin(
+                    [choice[0] for choice in HOSPITAL_ADMISSION_REASONS]
+                ),
+            ),
+            (
+                47,
+                admitted_in_audit_period
+                & (
+                    visits["hospital_admission_reason"]
+                    == HOSPITAL_ADMISSION_REASONS[1][0]
+                ),
+            ),
+            (
+                48,
+                visits["psychological_additional_support_status"]
+                == YES_NO_UNKNOWN[0][0],
+            ),
+            (
+                49,
+                visits["albuminuria_stage"].isin(
+                    [ALBUMINURIA_STAGES[1][0], ALBUMINURIA_STAGES[2][0]]
+                ),
+            ),
+        ]:
+            self.eligible[kpi_number] = kpi_1
+            self.passed[kpi_number] = kpi_1 & self._has_visit(
+                visit_in_audit_period & visit_condition
+            )
+
+    # ---------------------------------------------------------------------
+    # Helpers
+    # ---------------------------------------------------------------------
+
+    @staticmethod
+    def _records_to_frame(records, columns: list[str]) -> pd.DataFrame:
+        """Builds a DataFrame from `.values()` records, keeping the columns
+        even if there are no records."""
+        return pd.DataFrame.from_records(list(records), columns=columns)
+
+    def _in_audit_period(self, dates: pd.Series) -> pd.Series:
+        """Equivalent of `__range=AUDIT_DATE_RANGE` (inclusive, NULL is False)"""
+        return (dates >= self._start) & (dates <= self._end)
+
+    def _any_in_audit_period(self, frame: pd.DataFrame, fields: list[str]) -> pd.Series:
+        mask = pd.Series(False, index=frame.index)
+        for field in fields:
+            mask |= self._in_audit_period(frame[field])
+        return mask
+
+    def _within_days_of_diagnosis(
+        self, dates: pd.Series, days_before: int, days_after: int
+    ) -> pd.Series:
+        diagnosis_date = self.visits_df["diagnosis_date"]
+        return (dates >= diagnosis_date - timedelta(days=days_before)) & (
+            dates <= diagnosis_date + timedelta(days=days_after)
+        )
+
+    def _has_visit(self, visit_condition: pd.Series) -> pd.Series:
+        """Patient mask: has at least one visit matching `visit_condition`"""
+        return self._pks_to_mask(self.visits_df.loc[visit_condition, "patient_id"])
+
+    def _count_visits(self, visit_condition: pd.Series) -> pd.Series:
+        """Number of visits matching `visit_condition` for each patient"""
+        return (
+            self.visits_df.loc[visit_condition]
+            .groupby("patient_id")
+            .size()
+            .reindex(self.patients_df.index, fill_value=0)
+        )
+
+    def _pks_to_mask(self, pks) -> pd.Series:
+        return pd.Series(
+            self.patients_df.index.isin(pd.unique(pd.Series(pks))),
+            index=self.patients_df.index,
+        )
+
+    @staticmethod
+    def _mask_to_pks(mask: pd.Series) -> list[int]:
+        return sorted(int(pk) for pk in mask.index[mask.astype(bool)])
@@ -0,0 +1,580 @@
+"""Fused conditional-aggregation queries for count-style KPIs.
+
+Rather than each `calculate_kpi_*` method running its own `.count()` queries
+over the KPI 1 / 5 / 6 / 7 cohorts, every patient in the cohort is annotated
+once with a set of boolean flags (one `Exists` per visit / transfer rule).
+Each KPI's eligible and passed cohorts are then a `Q` over those flags, and
+all counts come back from a single `aggregate(Count(..., filter=Q(...)))`.
+
+KPIs 44 and 45 are not counts (they aggregate HbA1c medians), so are left to
+the `calculate_kpi_44_mean_hba1c` / `calculate_kpi_45_median_hba1c` methods.
+
+The rules in here MUST mirror the `calculate_kpi_*` methods in
+`project.npda.kpi_class.kpis`. Parity is asserted in
+`project/npda/tests/kpi_calculations/test_kpi_fused_queries.py`.
+"""
+
+# Python imports
+import logging
+from datetime import date, timedelta
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+# Django imports
+from django.db.models import (
+    BooleanField,
+    Case,
+    Count,
+    Exists,
+    ExpressionWrapper,
+    IntegerField,
+    OuterRef,
+    Q,
+    QuerySet,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
+
+# NPDA Imports
+from project.constants.albuminuria_stage import ALBUMINURIA_STAGES
+from project.constants.diabetes_types import DIABETES_TYPES
+from project.constants.hospital_admission_reasons import (
+    HOSPITAL_ADMISSION_REASONS,
+)
+from project.constants.retinal_screening_results import (
+    RETINAL_SCREENING_RESULTS,
+)
+from project.constants.smoking_status import SMOKING_STATUS
+from project.constants.types.kpi_types import KPIResult
+from project.constants.yes_no_unknown import YES_NO_UNKNOWN
+from project.npda.kpi_class.patient_ids import get_patient_ids_object, to_patient_ids
+from project.npda.models import Patient, Transfer, Visit
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Count-style KPIs (44 and 45 are HbA1c aggregates)
+FUSED_KPI_NUMBERS = (
+    list(range(1, 32)) + [321, 322, 323] + list(range(33, 44)) + list(range(46, 50))
+)
+
+# KPIs 1 - 12 are counts only, so pass / fail does not apply
+COUNT_ONLY_KPI_NUMBERS = list(range(1, 13))
+
+# The health checks for KPI 32, by age group
+HEALTH_CHECKS_LT_12YO = ["hba1c_check", "bmi_check", "thyroid_check"]
+HEALTH_CHECKS_GTE_12YO = HEALTH_CHECKS_LT_12YO + [
+    "bp_check",
+    "urinary_albumin_check",
+    "foot_exam_check",
+]
+
+
+def _flag(condition) -> Case:
+    """Boolean annotation for a patient-level condition. Never NULL, so the
+    flag can be safely negated."""
+    return Case(
+        When(condition, then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    )
+
+
+def _is(*flags: str) -> Q:
+    """Q requiring all of the given annotated flags to be True"""
+    return Q(**{flag: True for flag in flags})
+
+
+class FusedKPIQueries:
+    """
+    Evaluates all count-style KPIs for a set of patients in one aggregate query.
+
+    Usage:
+        fused_queries = FusedKPIQueries(patients, audit_start_date, audit_end_date)
+        kpi_results = fused_queries.calculate_kpi_results(total_patients_count)
+
+    `eligible_q` / `passed_q` map each KPI number to a Q over the annotated
+    `cohort` queryset, so patient querysets can also be built lazily from it.
+    """
+
+    def __init__(
+        self,
+        patients: QuerySet[Patient],
+        audit_start_date: date,
+        audit_end_date: date,
+    ):
+        self.audit_start_date = audit_start_date
+        self.audit_end_date = audit_end_date
+        self.AUDIT_DATE_RANGE = (audit_start_date, audit_end_date)
+
+        self.cohort = self._get_annotated_cohort(patients)
+        self.eligible_q, self.passed_q = self._get_kpi_conditions()
+
+    def calculate_kpi_results(
+        self,
+        total_patients_count: int,
+        kpi_numbers: Optional[Iterable[int]] = None,
+    ) -> dict[int, KPIResult]:
+        """Runs the single aggregate query and builds a KPIResult for each
+        count-style KPI (of `kpi_numbers`, if given). `patient_querysets` are
+        left as None."""
+
+        fused_kpi_numbers = self._get_fused_kpi_numbers(kpi_numbers)
+
+        # KPI 32.1 is derived from the 5, 32.2 and 32.3 cohorts
+        aggregated_kpi_numbers = set(fused_kpi_numbers)
+        if 321 in aggregated_kpi_numbers:
+            aggregated_kpi_numbers.update([5, 322, 323])
+
+        aggregates = {}
+        for kpi_number in FUSED_KPI_NUMBERS:
+            if kpi_number not in aggregated_kpi_numbers:
+                continue
+            aggregates[f"kpi_{kpi_number}_eligible"] = Count(
+                "pk", filter=self.eligible_q[kpi_number]
+            )
+            if kpi_number not in COUNT_ONLY_KPI_NUMBERS:
+                aggregates[f"kpi_{kpi_number}_passed"] = Count(
+                    "pk", filter=self.passed_q[kpi_number]
+                )
+
+        # KPI 32.1 counts health checks rather than patients
+        if 321 in aggregated_kpi_numbers:
+            for check in HEALTH_CHECKS_GTE_12YO:
+                age_group = [] if check in HEALTH_CHECKS_LT_12YO else ["gte_12yo"]
+                aggregates[f"kpi_321_{check}"] = Count(
+                    "pk", filter=self.eligible_q[5] & _is(check, *age_group)
+                )
+
+        if not aggregates:
+            return {}
+
+        counts = self.cohort.aggregate(**aggregates)
+
+        kpi_results = {}
+        for kpi_number in fused_kpi_numbers:
+            total_eligible = counts[f"kpi_{kpi_number}_eligible"]
+            total_ineligible = total_patients_count - total_eligible
+
+            if kpi_number in COUNT_ONLY_KPI_NUMBERS:
+                total_passed = None
+                total_failed = None
+            elif kpi_number == 321:
+                total_ineligible = total_patients_count - counts["kpi_5_eligible"]
+                total_eligible = (
+                    len(HEALTH_CHECKS_LT_12YO) * counts["kpi_322_eligible"]
+                    + len(HEALTH_CHECKS_GTE_12YO) * counts["kpi_323_eligible"]
+                )
+                total_passed = sum(
+                    counts[f"kpi_321_{check}"] for check in HEALTH_CHECKS_GTE_12YO
+                )
+                total_failed = total_eligible - total_passed
+            else:
+                total_passed = counts[f"kpi_{kpi_number}_passed"]
+                total_failed = total_eligible - total_passed
+
+            kpi_results[kpi_number] = KPIResult(
+                total_eligible=total_eligible,
+                total_ineligible=total_ineligible,
+                total_passed=total_passed,
+                total_failed=total_failed,
+            )
+
+        return kpi_results
+
+    def get_patient_ids(
+        self, kpi_numbers: Optional[Iterable[int]] = None
+    ) -> dict[int, dict[str, np.ndarray]]:
+        """Returns the eligible, ineligible, passed and failed patient ids for
+        every count-style KPI (of `kpi_numbers`, if given) from a single
+        query, selecting each KPI's eligible / passed conditions as
+        booleans."""
+
+        fused_kpi_numbers = self._get_fused_kpi_numbers(kpi_numbers)
+
+        conditions = {}
+        for kpi_number in fused_kpi_numbers:
+            conditions[f"kpi_{kpi_number}_eligible"] = ExpressionWrapper(
+                self.eligible_q[kpi_number], output_field=BooleanField()
+            )
+            conditions[f"kpi_{kpi_number}_passed"] = ExpressionWrapper(
+                self._get_passed_condition(kpi_number), output_field=BooleanField()
+            )
+
+        patients = pd.DataFrame.from_records(
+            list(self.cohort.values("pk", **conditions)),
+            columns=["pk", *conditions],
+        )
+        cohort_ids = to_patient_ids(patients["pk"])
+
+        def ids(column: str) -> np.ndarray:
+            return to_patient_ids(patients.loc[patients[column].astype(bool), "pk"])
+
+        return {
+            kpi_number: get_patient_ids_object(
+                kpi_number=kpi_number,
+                cohort_ids=cohort_ids,
+                eligible_ids=ids(f"kpi_{kpi_number}_eligible"),
+                passed_ids=ids(f"kpi_{kpi_number}_passed"),
+            )
+            for kpi_number in fused_kpi_numbers
+        }
+
+    @staticmethod
+    def _get_fused_kpi_numbers(kpi_numbers: Optional[Iterable[int]]) -> list[int]:
+        """The count-style KPIs of `kpi_numbers`, or all of them if None"""
+
+        if kpi_numbers is None:
+            return FUSED_KPI_NUMBERS
+        return [
+            kpi_number for kpi_number in FUSED_KPI_NUMBERS if kpi_number in kpi_numbers
+        ]
+
+    def _get_passed_condition(self, kpi_number: int) -> Q:
+        """Condition for the passed patients of a KPI, matching the patient
+        querysets returned by the `calculate_kpi_*` methods."""
+
+        if kpi_number == 2:
+            # KPI 2 returns the KPI 1 cohort as passed / failed
+            return self.eligible_q[1]
+        if kpi_number in COUNT_ONLY_KPI_NUMBERS or kpi_number in [322, 323]:
+            return self.eligible_q[kpi_number]
+
+        return self.passed_q[kpi_number]
+
+    def _visits(self, *args, **kwargs) -> Exists:
+        """Exists a visit for the (outer) patient matching the filters"""
+        return Exists(Visit.objects.filter(*args, patient=OuterRef("pk"), **kwargs))
+
+    def _visit_in_audit_period(self, *args, **kwargs) -> Exists:
+        return self._visits(*args, visit_date__range=self.AUDIT_DATE_RANGE, **kwargs)
+
+    def _get_annotated_cohort(self, patients: QuerySet[Patient]) -> QuerySet[Patient]:
+        """Annotates each patient (once, regardless of how many transfers or
+        visits they have) with the flags used by the KPI conditions."""
+
+        AUDIT_DATE_RANGE = self.AUDIT_DATE_RANGE
+
+        # An observation within the audit period (KPIs 6 and 7)
+        any_observation_in_audit_period = (
+            Q(height_weight_observation_date__range=AUDIT_DATE_RANGE)
+            | Q(hba1c_date__range=AUDIT_DATE_RANGE)
+            | Q(blood_pressure_observation_date__range=AUDIT_DATE_RANGE)
+            | Q(foot_examination_observation_date__range=AUDIT_DATE_RANGE)
+            | Q(retinal_screening_observation_date__range=AUDIT_DATE_RANGE)
+            | Q(albumin_creatinine_ratio_date__range=AUDIT_DATE_RANGE)
+            | Q(total_cholesterol_date__range=AUDIT_DATE_RANGE)
+            | Q(thyroid_function_date__range=AUDIT_DATE_RANGE)
+            | Q(coeliac_screen_date__range=AUDIT_DATE_RANGE)
+            | Q(psychological_screening_assessment_date__range=AUDIT_DATE_RANGE)
+        )
+        admitted_in_audit_period = Q(
+            hospital_admission_date__range=AUDIT_DATE_RANGE
+        ) | Q(hospital_discharge_date__range=AUDIT_DATE_RANGE)
+
+        # Most recent insulin pump visit (KPI 24)
+        latest_pump_visit_closed_loop_system = Subquery(
+            Visit.objects.filter(patient=OuterRef("pk"), treatment__in=[3, 6])
+            .order_by("-visit_date")
+            .values("closed_loop_system")[:1]
+        )
+        # Number of HbA1c measurements in the audit period (KPI 33)
+        hba1c_visits_count = Coalesce(
+            Subquery(
+                Visit.objects.filter(
+                    patient=OuterRef("pk"),
+                    visit_date__range=AUDIT_DATE_RANGE,
+                    hba1c__isnull=False,
+                    hba1c_date__range=AUDIT_DATE_RANGE,
+                )
+                .order_by()
+                .values("patient")
+                .annotate(count=Count("pk"))
+                .values("count")
+            ),
+            0,
+            output_field=IntegerField(),
+        )
+
+        def within_days_of_diagnosis(field: str, days_before: int, days_after: int):
+            return Q(
+                **{
+                    f"{field}__gte": OuterRef("diagnosis_date")
+                    - timedelta(days=days_before),
+                    f"{field}__lte": OuterRef("diagnosis_date")
+                    + timedelta(days=days_after),
+                }
+            )
+
+        return (
+            Patient.objects.filter(pk__in=Subquery(patients.order_by().values("pk")))
+            .annotate(
+                latest_pump_visit_closed_loop_system=latest_pump_visit_closed_loop_system,
+                hba1c_visits_count=hba1c_visits_count,
+            )
+            .annotate(
+                # Patient attributes
+                valid_attributes=_flag(
+                    Q(nhs_number__isnull=False, date_of_birth__isnull=False)
+                ),
+                lt_25yo=_flag(
+                    Q(date_of_birth__gt=self.audit_start_date - relativedelta(years=25))
+                ),
+                gte_12yo=_flag(
+                    Q(
+                        date_of_birth__lte=self.audit_start_date
+                        - relativedelta(years=12)
+                    )
+                ),
+                t1dm=_flag(Q(diabetes_type=DIABETES_TYPES[0][0])),
+                diagnosed_in_audit_period=_flag(
+                    Q(diagnosis_date__range=AUDIT_DATE_RANGE)
+                ),
+                died_in_audit_period=_flag(Q(death_date__range=AUDIT_DATE_RANGE)),
+                diagnosed_90d_before_end=_flag(
+                    Q(diagnosis_date__lt=self.audit_end_date - relativedelta(days=90))
+                ),
+                diagnosed_14d_before_end=_flag(
+                    Q(diagnosis_date__lt=self.audit_end_date - relativedelta(days=14))
+                ),
+                left_service_in_audit_period=Exists(
+                    Transfer.objects.filter(
+                        patient=OuterRef("pk"),
+                        date_leaving_service__range=AUDIT_DATE_RANGE,
+                    )
+                ),
+                # Visit based flags (KPIs 1 - 12)
+                visit_in_audit_period=self._visit_in_audit_period(),
+                observation_in_audit_period=self._visits(
+                    any_observation_in_audit_period
+                ),
+                visit_and_observation_in_audit_period=self._visit_in_audit_period(
+                    any_observation_in_audit_period
+                ),
+                gluten_free_diet=self._visits(gluten_free_diet=1),
+                thyroid_treatment=self._visits(thyroid_treatment_status__in=[2, 3]),
+                ketone_meter_training=self._visits(ketone_meter_training=1),
+                # KPIs 13 - 24
+                **{
+                    f"treatment_{treatment}": self._visits(treatment=treatment)
+                    for treatment in range(1, 9)
+                },
+                flash_glucose_monitor=self._visits(glucose_monitoring__in=[2, 3]),
+                real_time_cgm_with_alarms=self._visits(glucose_monitoring=4),
+                insulin_pump=self._visits(treatment__in=[3, 6]),
+                latest_pump_visit_closed_loop=_flag(
+                    Q(latest_pump_visit_closed_loop_system__in=[2, 3, 4])
+                ),
+                # KPIs 25 - 32
+                hba1c_check=self._visits(
+                    hba1c__isnull=False, hba1c_date__range=AUDIT_DATE_RANGE
+                ),
+                bmi_check=self._visits(
+                    height__isnull=False,
+                    weight__isnull=False,
+                    height_weight_observation_date__range=AUDIT_DATE_RANGE,
+                ),
+                thyroid_check=self._visits(
+                    thyroid_function_date__range=AUDIT_DATE_RANGE
+                ),
+                bp_check=self._visits(
+                    systolic_blood_pressure__isnull=False,
+                    blood_pressure_observation_date__range=AUDIT_DATE_RANGE,
+                ),
+                urinary_albumin_check=self._visits(
+                    albumin_creatinine_ratio__isnull=False,
+                    albumin_creatinine_ratio_date__range=AUDIT_DATE_RANGE,
+                ),
+                retinal_screening_check=self._visits(
+                    retinal_screening_result__in=[
+                        RETINAL_SCREENING_RESULTS[0][0],
+                        RETINAL_SCREENING_RESULTS[1][0],
+                    ],
+                    retinal_screening_observation_date__range=AUDIT_DATE_RANGE,
+                ),
+                foot_exam_check=self._visits(
+                    foot_examination_observation_date__range=AUDIT_DATE_RANGE
+                ),
+                # KPIs 33 - 40
+                hba1c_4plus=_flag(Q(hba1c_visits_count__gte=4)),
+                psychological_assessment=self._visit_in_audit_period(
+                    psychological_screening_assessment_date__range=AUDIT_DATE_RANGE
+                ),
+                smoking_status_screened=self._visit_in_audit_period(
+                    smoking_status__in=[SMOKING_STATUS[0][0], SMOKING_STATUS[1][0]]
+                ),
+                smoking_cessation_referral=self._visit_in_audit_period(
+                    smoking_cessation_referral_date__range=AUDIT_DATE_RANGE
+                ),
+                dietetic_appointment_offered=self._visit_in_audit_period(
+                    dietician_additional_appointment_offered=1
+                ),
+                dietetic_appointment_attended=self._visit_in_audit_period(
+                    dietician_additional_appointment_date__range=AUDIT_DATE_RANGE
+                ),
+                influenza_immunisation=self._visit_in_audit_period(
+                    flu_immunisation_recommended_date__range=AUDIT_DATE_RANGE
+                ),
+                sick_day_rules_advice=self._visit_in_audit_period(
+                    sick_day_rules_training_date__range=AUDIT_DATE_RANGE
+                ),
+                # KPIs 41 - 43. NOTE: 41 and 42 only count visits that made the
+                # patient KPI 7 eligible
+                coeliac_screen_at_diagnosis=self._visits(
+                    any_observation_in_audit_period,
+                    within_days_of_diagnosis("coeliac_screen_date", 90, 90),
+                ),
+                thyroid_screen_at_diagnosis=self._visits(
+                    any_observation_in_audit_period,
+                    within_days_of_diagnosis("thyroid_function_date", 90, 90),
+                ),
+                carbohydrate_counting_at_diagnosis=self._visits(
+                    within_days_of_diagnosis(
+                        "carbohydrate_counting_level_three_education_date", 7, 14
+                    )
+                ),
+                # KPIs 46 - 49
+                admission=self._visit_in_audit_period(
+                    admitted_in_audit_period,
+                    hospital_admission_reason__in=[
+                        choice[0] for choice in HOSPITAL_ADMISSION_REASONS
+                    ],
+                ),
+                dka_admission=self._visit_in_audit_period(
+                    admitted_in_audit_period,
+                    hospital_admission_reason=HOSPITAL_ADMISSION_REASONS[1][0],
+                ),
+                additional_psychological_support=self._visit_in_audit_period(
+                    psychological_additional_support_status=YES_NO_UNKNOWN[0][0]
+                ),
+                albuminuria_present=self._visit_in_audit_period(
+                    albuminuria_stage__in=[
+                        ALBUMINURIA_STAGES[1][0],
+                        ALBUMINURIA_STAGES[2][0],
+                    ]
+                ),
+            )
+        )
+
+    def _get_kpi_conditions(self) -> tuple[dict[int, Q], dict[int, Q]]:
+        """Returns the eligible and passed Q (over the annotated cohort) for
+        each KPI."""
+
+        # Base cohorts. NOTE: composed here rather than annotated so that the
+        # aggregate only references the (pre-computed) flags
+        complete_year_exclusions = (
+            _is("diagnosed_in_audit_period")
+            | _is("left_service_in_audit_period")
+            | _is("died_in_audit_period")
+        )
+        kpi_1 = _is("valid_attributes", "lt_25yo", "visit_in_audit_period")
+        kpi_5 = kpi_1 & ~complete_year_exclusions
+        kpi_6 = (
+            _is(
+                "valid_attributes",
+                "gte_12yo",
+                "t1dm",
+                "visit_and_observation_in_audit_period",
+            )
+            & ~complete_year_exclusions
+        )
+        kpi_7 = _is(
+            "valid_attributes",
+            "lt_25yo",
+            "t1dm",
+            "diagnosed_in_audit_period",
+            "observation_in_audit_period",
+        )
+
+        eligible = {
+            1: kpi_1,
+            2: kpi_1 & _is("diagnosed_in_audit_period"),
+            3: kpi_1 & _is("t1dm"),
+            4: kpi_1 & _is("t1dm", "gte_12yo"),
+            5: kpi_5,
+            6: kpi_6,
+            7: kpi_7,
+            8: kpi_1 & _is("died_in_audit_period"),
+            9: kpi_1 & _is("left_service_in_audit_period"),
+            10: kpi_1 & _is("gluten_free_diet"),
+            11: kpi_1 & _is("thyroid_treatment"),
+            12: kpi_1 & _is("ketone_meter_training"),
+        }
+        passed = dict(eligible)
+
+        # KPIs 13 - 20: treatment regimen
+        for kpi_number in range(13, 21):
+            eligible[kpi_number] = kpi_1
+            passed[kpi_number] = kpi_1 & _is(f"treatment_{kpi_number - 12}")
+
+        # KPIs 21 - 24
+        eligible[21] = kpi_1
+        passed[21] = kpi_1 & _is("flash_glucose_monitor")
+        eligible[22] = kpi_1
+        passed[22] = kpi_1 & _is("real_time_cgm_with_alarms")
+        eligible[23] = eligible[2]
+        passed[23] = eligible[2] & _is("real_time_cgm_with_alarms")
+        eligible[24] = kpi_1 & _is("insulin_pump")
+        passed[24] = eligible[24] & _is("latest_pump_visit_closed_loop")
+
+        # KPIs 25 - 31
+        for kpi_number, base_cohort, check in [
+            (25, kpi_5, "hba1c_check"),
+            (26, kpi_5, "bmi_check"),
+            (27, kpi_5, "thyroid_check"),
+            (28, kpi_6, "bp_check"),
+            (29, kpi_6, "urinary_albumin_check"),
+            (30, kpi_6, "retinal_screening_check"),
+            (31, kpi_6, "foot_exam_check"),
+        ]:
+            eligible[kpi_number] = base_cohort
+            passed[kpi_number] = base_cohort & _is(check)
+
+        # KPI 32: passed for 32.1 is the < 12yo cohort (as per the SQL
+        # querysets), the totals are health check counts
+        eligible[321] = kpi_5
+        passed[321] = kpi_5 & ~_is("gte_12yo")
+        eligible[322] = kpi_5 & ~_is("gte_12yo")
+        passed[322] = eligible[322] & _is(*HEALTH_CHECKS_LT_12YO)
+        eligible[323] = kpi_5 & _is("gte_12yo")
+        passed[323] = eligible[323] & _is(*HEALTH_CHECKS_GTE_12YO)
+
+        # KPIs 33 - 40
+        for kpi_number, base_cohort, check in [
+            (33, kpi_5, "hba1c_4plus"),
+            (34, kpi_5, "psychological_assessment"),
+            (35, kpi_6, "smoking_status_screened"),
+            (36, kpi_6, "smoking_cessation_referral"),
+            (37, kpi_5, "dietetic_appointment_offered"),
+            (38, kpi_5, "dietetic_appointment_attended"),
+            (39, kpi_5, "influenza_immunisation"),
+            (40, kpi_1, "sick_day_rules_advice"),
+        ]:
+            eligible[kpi_number] = base_cohort
+            passed[kpi_number] = base_cohort & _is(check)
+
+        # KPIs 41 - 43
+        for kpi_number, diagnosed_before_end, check in [
+            (41, "diagnosed_90d_before_end", "coeliac_screen_at_diagnosis"),
+            (42, "diagnosed_90d_before_end", "thyroid_screen_at_diagnosis"),
+            (43, "diagnosed_14d_before_end", "carbohydrate_counting_at_diagnosis"),
+        ]:
+            eligible[kpi_number] = kpi_7 & _is(diagnosed_before_end)
+            passed[kpi_number] = eligible[kpi_number] & _is(check)
+
+        # KPIs 46 - 49
+        for kpi_number, check in [
+            (46, "admission"),
+            (47, "dka_admission"),
+            (48, "additional_psychological_support"),
+            (49, "albuminuria_present"),
+        ]:
+            eligible[kpi_number] = kpi_1
+            passed[kpi_number] = kpi_1 & _is(check)
+
+        return eligible, passed
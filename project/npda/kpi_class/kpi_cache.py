@@ -0,0 +1,162 @@
+"""Versioned cache of KPI results per PDU.
+
+Cache keys are made of, for each PZ code:
+    * the audit period
+    * the id of the PDU's active Submission
+    * the PDU's data version - a counter bumped whenever any of its patients'
+      records change (see `invalidate_cached_kpi_results`)
+
+so stale results are never read, they are just left to expire. The data
+versions are kept on PaediatricDiabetesUnit rather than in the cache, so they
+can't be culled (which would bring stale results back) and an invalidation
+on one host is seen by all of them. Only the results are cached. Each PDU's
+mergeable KPI partials (see kpi_partials.py) are cached under their own key,
+so a rollup only recalculates the PDUs whose data has changed.
+
+Uses the "kpi_results" cache (see CACHES in settings).
+"""
+
+# Python imports
+import logging
+from datetime import date
+from typing import Iterable, Optional
+
+# Django imports
+from django.core.cache import caches
+from django.db.models import F, OuterRef, Subquery
+
+# NPDA Imports
+from project.constants.types.kpi_types import KPICalculationsObject
+from project.npda.kpi_class.kpi_partials import KPIPartials
+from project.npda.models import Submission, Transfer
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
+
+# Logging
+logger = logging.getLogger(__name__)
+
+KPI_RESULTS_CACHE_ALIAS = "kpi_results"
+
+
+def _cache():
+    return caches[KPI_RESULTS_CACHE_ALIAS]
+
+
+def get_kpi_data_version(pz_code: str) -> int:
+    return (
+        PaediatricDiabetesUnit.objects.filter(pz_code=pz_code)
+        .values_list("kpi_data_version", flat=True)
+        .first()
+        or 0
+    )
+
+
+def invalidate_cached_kpi_results(pz_codes: Iterable[str]) -> None:
+    """Bumps the data version of each PDU, so any cached KPI results are no
+    longer used."""
+
+    pz_codes = set(pz_codes)
+    if pz_codes:
+        PaediatricDiabetesUnit.objects.filter(pz_code__in=pz_codes).update(
+            kpi_data_version=F("kpi_data_version") + 1
+        )
+
+
+def invalidate_cached_kpi_results_for_patients(patient_pks: Iterable[int]) -> None:
+    """Invalidates cached KPI results for every PDU the patients belong to."""
+
+    invalidate_cached_kpi_results(
+        Transfer.objects.filter(patient_id__in=list(patient_pks))
+        .values_list("paediatric_diabetes_unit__pz_code", flat=True)
+        .distinct()
+    )
+
+
+def _get_pdu_versions(pz_codes: Iterable[str]) -> dict[str, str]:
+    """Returns "<active submission id>-<data version>" for each PDU, sorted by
+    PZ code."""
+
+    pz_codes = sorted(set(pz_codes))
+    pdu_versions = {
+        pz_code: f"{active_submission}-{data_version}"
+        for pz_code, active_submission, data_version in PaediatricDiabetesUnit.objects.filter(
+            pz_code__in=pz_codes
+        )
+        .annotate(
+            active_submission=Subquery(
+                Submission.objects.filter(
+                    paediatric_diabetes_unit=OuterRef("pk"), submission_active=True
+                ).values("pk")[:1]
+            )
+        )
+        .values_list("pz_code", "active_submission", "kpi_data_version")
+    }
+
+    return {pz_code: pdu_versions.get(pz_code, "None-0") for pz_code in pz_codes}
+
+
+def get_kpi_results_cache_key(
+    pz_codes: list[str],
+    audit_start_date: date,
+    return_pt_querysets: bool,
+    kpi_numbers: Optional[list[int]] = None,
+) -> str:
+    """Returns the versioned cache key for KPI results for the given PDUs
+    (and subset of KPIs, if not all of them)."""
+
+    pdu_versions = ",".join(
+        f"{pz_code}-{pdu_version}"
+        for pz_code, pdu_version in _get_pdu_versions(pz_codes).items()
+    )
+
+    kpis = "all" if kpi_numbers is None else "-".join(map(str, sorted(kpi_numbers)))
+
+    return (
+        f"kpi_results:{audit_start_date}:{int(return_pt_querysets)}:{kpis}:"
+        f"{pdu_versions}"
+    )
+
+
+def get_cached_kpi_results(key: str) -> Optional[KPICalculationsObject]:
+    """Returns cached KPI results, or None if not cached."""
+
+    return _cache().get(key)
+
+
+def set_cached_kpi_results(key: str, kpi_calculations_object: KPICalculationsObject):
+    """Caches KPI results. Patient ids are cached as they are (sorted arrays
+    of patient pks, see `KPIResult.patient_ids`)."""
+
+    _cache().set(key, kpi_calculations_object)
+
+
+def get_kpi_partials_cache_keys(
+    pz_codes: Iterable[str], audit_start_date: date
+) -> dict[str, str]:
+    """Returns the versioned cache key for each PDU's KPI partials (see
+    kpi_partials.py)."""
+
+    return {
+        pz_code: f"kpi_partials:{audit_start_date}:{pz_code}-{pdu_version}"
+        for pz_code, pdu_version in _get_pdu_versions(pz_codes).items()
+    }
+
+
+def get_cached_kpi_partials(keys: dict[str, str]) -> dict[str, KPIPartials]:
+    """Returns the cached KPI partials of each PDU that has them, from
+    a dict of pz_code: cache key."""
+
+    cached = _cache().get_many(list(keys.values()))
+    return {pz_code: cached[key] for pz_code, key in keys.items() if key in cached}
+
+
+def set_cached_kpi_partials(
+    keys: dict[str, str], kpi_partials_by_pdu: dict[str, KPIPartials]
+) -> None:
+    """Caches each PDU's KPI partials under its key in `keys`."""
+
+    _cache().set_many(
+        {
+            keys[pz_code]: kpi_partials
+            for pz_code, kpi_partials in kpi_partials_by_pdu.items()
+        }
+    )
@@ -0,0 +1,247 @@
+"""Columnar export of KPI results for central analysis.
+
+Writes the KPICalculationsObjects of many PDUs (as returned by
+`calculate_kpis_by_pdu`, or loaded back from `calculate_kpis` checkpoints) as
+two tables, in Parquet or Arrow IPC files:
+
+    * kpis.<ext> - one row per PDU and KPI, with the KPI's totals
+    * patients.<ext> - one row per PDU, KPI and patient in the PDU's cohort,
+      flagging whether the patient was eligible and, if eligible, passed
+
+pz_code, kpi_name and kpi_label are dictionary encoded, so a national
+extract holds each PZ code and KPI name once rather than on every row.
+
+Per-patient rows need each KPI's `patient_ids`, so calculate with
+`return_pt_querysets=True`.
+"""
+
+# Python imports
+import logging
+import os
+from datetime import date, datetime
+from typing import Union
+
+# Third party imports
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+# NPDA Imports
+from project.constants.types.kpi_types import KPICalculationsObject
+from project.npda.kpi_class.dataframe_engine import COUNT_ONLY_KPI_NUMBERS
+from project.npda.kpi_class.kpi_snapshots import KPI_NUMBERS_BY_ATTRIBUTE_NAME
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# File extension of each format
+KPI_EXPORT_FORMATS = {"parquet": "parquet", "arrow": "arrow"}
+
+KPI_RESULTS_SCHEMA = pa.schema(
+    [
+        ("pz_code", pa.dictionary(pa.int32(), pa.string())),
+        ("audit_start_date", pa.date32()),
+        ("audit_end_date", pa.date32()),
+        ("calculation_datetime", pa.timestamp("us")),
+        ("kpi_number", pa.int16()),
+        ("kpi_name", pa.dictionary(pa.int16(), pa.string())),
+        ("kpi_label", pa.dictionary(pa.int16(), pa.string())),
+        ("total_eligible", pa.int64()),
+        ("total_ineligible", pa.int64()),
+        # KPIs 44 and 45 hold the mean and median HbA1c here
+        ("total_passed", pa.float64()),
+        ("total_failed", pa.float64()),
+    ]
+)
+
+PATIENT_KPI_SCHEMA = pa.schema(
+    [
+        ("pz_code", pa.dictionary(pa.int32(), pa.string())),
+        ("kpi_number", pa.int16()),
+        ("kpi_name", pa.dictionary(pa.int16(), pa.string())),
+        ("patient_id", pa.int64()),
+        ("eligible", pa.bool_()),
+        # Null for the count-only KPIs (1 - 12), which have no pass / fail
+        ("passed", pa.bool_()),
+    ]
+)
+
+
+def _as_date(value: Union[date, str]) -> date:
+    # Checkpoints loaded from JSON hold ISO format strings
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _as_datetime(value: Union[datetime, str]) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _dictionary_column(values: list[str], index_type: pa.DataType) -> pa.Array:
+    """Dictionary encodes a column of strings"""
+    return (
+        pa.array(values, type=pa.string())
+        .dictionary_encode()
+        .cast(pa.dictionary(index_type, pa.string()))
+    )
+
+
+def kpi_results_table(
+    kpi_calculations_by_pdu: dict[str, KPICalculationsObject],
+) -> pa.Table:
+    """One row per PDU and KPI, with the KPI's totals"""
+
+    rows = []
+    for pz_code, kpi_calculations in kpi_calculations_by_pdu.items():
+        for kpi_name, kpi_result in kpi_calculations["calculated_kpi_values"].items():
+            rows.append(
+                {
+                    "pz_code": pz_code,
+                    "audit_start_date": _as_date(kpi_calculations["audit_start_date"]),
+                    "audit_end_date": _as_date(kpi_calculations["audit_end_date"]),
+                    "calculation_datetime": _as_datetime(
+                        kpi_calculations["calculation_datetime"]
+                    ),
+                    "kpi_number": KPI_NUMBERS_BY_ATTRIBUTE_NAME[kpi_name],
+                    "kpi_name": kpi_name,
+                    "kpi_label": kpi_result["kpi_label"],
+                    "total_eligible": kpi_result["total_eligible"],
+                    "total_ineligible": kpi_result["total_ineligible"],
+                    "total_passed": kpi_result["total_passed"],
+                    "total_failed": kpi_result["total_failed"],
+                }
+            )
+
+    columns = {
+        field.name: [row[field.name] for row in rows] for field in KPI_RESULTS_SCHEMA
+    }
+    return pa.table(
+        {
+            field.name: (
+                _dictionary_column(columns[field.name], field.type.index_type)
+                if pa.types.is_dictionary(field.type)
+                else pa.array(columns[field.name], type=field.type)
+            )
+            for field in KPI_RESULTS_SCHEMA
+        },
+        schema=KPI_RESULTS_SCHEMA,
+    )
+
+
+def patient_kpi_table(
+    kpi_calculations_by_pdu: dict[str, KPICalculationsObject],
+) -> pa.Table:
+    """One row per PDU, KPI and patient in the PDU's cohort, flagging whether
+    the patient was eligible for, and passed, the KPI.
+
+    Raises ValueError if the KPIs were calculated without patient ids.
+    """
+
+    pz_codes = list(kpi_calculations_by_pdu)
+    kpi_names = list(KPI_NUMBERS_BY_ATTRIBUTE_NAME)
+
+    # Built from the dictionary indices of each PDU / KPI block, rather than
+    # encoding a string per row
+    pz_code_indices = []
+    kpi_name_indices = []
+    patient_ids = []
+    eligible = []
+    passed = []
+    passed_valid = []
+
+    for pz_code_index, kpi_calculations in enumerate(kpi_calculations_by_pdu.values()):
+        for kpi_name, kpi_result in kpi_calculations["calculated_kpi_values"].items():
+            kpi_patient_ids = kpi_result["patient_ids"]
+            if kpi_patient_ids is None:
+                raise ValueError(
+                    f"No patient ids for {kpi_name} of {pz_codes[pz_code_index]}, "
+                    "calculate KPIs with return_pt_querysets=True"
+                )
+
+            eligible_ids = np.asarray(kpi_patient_ids["eligible"], dtype=np.int64)
+            passed_ids = np.asarray(kpi_patient_ids["passed"], dtype=np.int64)
+            cohort_ids = np.union1d(
+                eligible_ids,
+                np.asarray(kpi_patient_ids["ineligible"], dtype=np.int64),
+            )
+            n_patients = len(cohort_ids)
+
+            pz_code_indices.append(np.full(n_patients, pz_code_index, dtype=np.int32))
+            kpi_name_indices.append(
+                np.full(n_patients, kpi_names.index(kpi_name), dtype=np.int16)
+            )
+            patient_ids.append(cohort_ids)
+            is_eligible = np.isin(cohort_ids, eligible_ids, assume_unique=True)
+            eligible.append(is_eligible)
+            passed.append(np.isin(cohort_ids, passed_ids, assume_unique=True))
+            passed_valid.append(
+                np.zeros(n_patients, dtype=bool)
+                if KPI_NUMBERS_BY_ATTRIBUTE_NAME[kpi_name] in COUNT_ONLY_KPI_NUMBERS
+                else is_eligible
+            )
+
+    def concatenate(arrays: list[np.ndarray], dtype) -> np.ndarray:
+        return np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+
+    kpi_name_indices = concatenate(kpi_name_indices, np.int16)
+    kpi_numbers = np.array(
+        [KPI_NUMBERS_BY_ATTRIBUTE_NAME[kpi_name] for kpi_name in kpi_names],
+        dtype=np.int16,
+    )
+
+    return pa.table(
+        {
+            "pz_code": pa.DictionaryArray.from_arrays(
+                concatenate(pz_code_indices, np.int32),
+                pa.array(pz_codes, type=pa.string()),
+            ),
+            "kpi_number": pa.array(kpi_numbers[kpi_name_indices], type=pa.int16()),
+            "kpi_name": pa.DictionaryArray.from_arrays(
+                kpi_name_indices, pa.array(kpi_names, type=pa.string())
+            ),
+            "patient_id": pa.array(concatenate(patient_ids, np.int64)),
+            "eligible": pa.array(concatenate(eligible, bool)),
+            "passed": pa.array(
+                concatenate(passed, bool), mask=~concatenate(passed_valid, bool)
+            ),
+        },
+        schema=PATIENT_KPI_SCHEMA,
+    )
+
+
+def _write_table(table: pa.Table, path: str, file_format: str) -> None:
+    # Write then rename so an interrupted export never leaves a partial file
+    if file_format == "parquet":
+        pq.write_table(table, f"{path}.tmp")
+    else:
+        with pa.ipc.new_file(f"{path}.tmp", table.schema) as writer:
+            writer.write_table(table)
+    os.replace(f"{path}.tmp", path)
+
+
+def write_kpi_export(
+    kpi_calculations_by_pdu: dict[str, KPICalculationsObject],
+    output_dir: str,
+    file_format: str = "parquet",
+) -> list[str]:
+    """Writes kpis.<ext> and patients.<ext> (see module docstring) to
+    `output_dir` as Parquet ("parquet") or Arrow IPC ("arrow") files.
+
+    Returns the paths written.
+    """
+
+    if file_format not in KPI_EXPORT_FORMATS:
+        raise ValueError(f"Unknown KPI export format: {file_format}")
+
+    extension = KPI_EXPORT_FORMATS[file_format]
+    paths = []
+    for name, table in [
+        ("kpis", kpi_results_table(kpi_calculations_by_pdu)),
+        ("patients", patient_kpi_table(kpi_calculations_by_pdu)),
+    ]:
+        path = os.path.join(output_dir, f"{name}.{extension}")
+        _write_table(table, path, file_format)
+        logger.debug(f"Written {table.num_rows} rows to {path}")
+        paths.append(path)
+
+    return paths
@@ -0,0 +1,225 @@
+"""Mergeable partial KPI aggregates, for rolling PDU results up to network,
+trust and national level.
+
+A `KPIPartials` holds, for a group of patients (e.g. one PDU), the counts
+each KPI result is made of, the sum and number of the patients' median
+HbA1c (KPI 44) and a sketch of their distribution (KPI 45). Merging two
+partials adds these together, so a network's KPIs are its PDUs' partials
+merged, without loading any patients or visits again.
+
+The HbA1c sketch counts patients by median HbA1c, to the nearest
+1 / HBA1C_SKETCH_SCALE. HbA1c is recorded to 2 decimal places, so patient
+medians (a value, or the mean of two) are kept exactly, and the median of
+a merged sketch is the same as the median of all the patients' medians.
+
+As with `calculate_kpis_by_pdu`, a patient who has been in more than one
+PDU is counted in each of them, so in each rollup.
+"""
+
+# Python imports
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Hashable, Iterable, Optional
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# NPDA Imports
+from project.constants.types.kpi_types import KPIResult
+from project.npda.kpi_class.dataframe_engine import (
+    COUNT_ONLY_KPI_NUMBERS,
+    KPI_NUMBERS,
+    DataFrameKPIEngine,
+)
+
+# Logging
+logger = logging.getLogger(__name__)
+
+HBA1C_SKETCH_SCALE = 1000
+
+
+@dataclass
+class KPIPartials:
+    """Mergeable KPI totals of a group of patients for an audit period.
+
+    `eligible` and `passed` are keyed by KPI number. For KPI 32.1 (321) they
+    count expected and completed health checks rather than patients.
+    """
+
+    audit_start_date: date
+    audit_end_date: date
+    total_patients_count: int = 0
+    eligible: dict[int, int] = field(default_factory=dict)
+    passed: dict[int, int] = field(default_factory=dict)
+    # Of each KPI 44 eligible patient's median HbA1c, where they have one
+    hba1c_sum: float = 0.0
+    hba1c_count: int = 0
+    # round(median HbA1c * HBA1C_SKETCH_SCALE): number of patients
+    hba1c_sketch: dict[int, int] = field(default_factory=dict)
+
+    def merge(self, other: "KPIPartials") -> "KPIPartials":
+        """Returns the partials of both groups of patients combined"""
+
+        if (self.audit_start_date, self.audit_end_date) != (
+            other.audit_start_date,
+            other.audit_end_date,
+        ):
+            raise ValueError("Can't merge KPI partials of different audit periods")
+
+        return KPIPartials(
+            audit_start_date=self.audit_start_date,
+            audit_end_date=self.audit_end_date,
+            total_patients_count=self.total_patients_count + other.total_patients_count,
+            eligible=dict(Counter(self.eligible) + Counter(other.eligible)),
+            passed=dict(Counter(self.passed) + Counter(other.passed)),
+            hba1c_sum=self.hba1c_sum + other.hba1c_sum,
+            hba1c_count=self.hba1c_count + other.hba1c_count,
+            hba1c_sketch=dict(Counter(self.hba1c_sketch) + Counter(other.hba1c_sketch)),
+        )
+
+    def median_hba1c(self) -> float:
+        """Median of the patients' median HbA1c, 0 if there are none"""
+
+        if not self.hba1c_count:
+            return 0.0
+
+        values = np.array(sorted(self.hba1c_sketch), dtype=np.int64)
+        cumulative_counts = np.cumsum([self.hba1c_sketch[value] for value in values])
+
+        def nth(n: int) -> int:
+            # 0-based nth smallest patient median
+            return values[np.searchsorted(cumulative_counts, n + 1)]
+
+        middle = (self.hba1c_count - 1) // 2
+        if self.hba1c_count % 2:
+            return float(nth(middle)) / HBA1C_SKETCH_SCALE
+        return float(nth(middle) + nth(middle + 1)) / 2 / HBA1C_SKETCH_SCALE
+
+    def to_kpi_results(self) -> dict[int, KPIResult]:
+        """KPIResult for each KPI number, as `calculate_kpi_results` returns"""
+
+        kpi_results = {}
+        for kpi_number in KPI_NUMBERS:
+            total_eligible = self.eligible.get(kpi_number, 0)
+            total_ineligible = self.total_patients_count - total_eligible
+
+            if kpi_number in COUNT_ONLY_KPI_NUMBERS:
+                total_passed = None
+                total_failed = None
+
+            elif kpi_number == 321:
+                # Health checks rather than patients (see KPI 32.1 docstring)
+                total_ineligible = self.total_patients_count - self.eligible.get(5, 0)
+                total_passed = self.passed.get(321, 0)
+                total_failed = total_eligible - total_passed
+
+            elif kpi_number == 44:
+                total_passed = (
+                    self.hba1c_sum / self.hba1c_count if self.hba1c_count else 0.0
+                )
+                total_failed = -1
+
+            elif kpi_number == 45:
+                total_passed = self.median_hba1c()
+                total_failed = -1
+
+            else:
+                total_passed = self.passed.get(kpi_number, 0)
+                total_failed = total_eligible - total_passed
+
+            kpi_results[kpi_number] = KPIResult(
+                total_eligible=total_eligible,
+                total_ineligible=total_ineligible,
+                total_passed=total_passed,
+                total_failed=total_failed,
+            )
+
+        return kpi_results
+
+
+def merge_kpi_partials(partials: Iterable[KPIPartials]) -> Optional[KPIPartials]:
+    """Merges the partials of many groups of patients, None if there are
+    none"""
+
+    merged = None
+    for kpi_partials in partials:
+        merged = kpi_partials if merged is None else merged.merge(kpi_partials)
+    return merged
+
+
+def kpi_partials_by_group(
+    dataframe_engine: DataFrameKPIEngine,
+    patient_groups: pd.Series,
+    total_patients_counts: dict[Hashable, int],
+) -> dict[Hashable, KPIPartials]:
+    """Builds the KPIPartials of each group of patients (e.g. each PDU) from
+    a loaded DataFrameKPIEngine, in the same way as
+    `DataFrameKPIEngine.calculate_kpi_results_by_group`.
+
+    Params:
+        * patient_groups (pd.Series) - group key, indexed by patient pk.
+        A patient may appear in more than one group.
+        * total_patients_counts (dict) - total patients for each group key.
+    """
+
+    patient_pks = patient_groups.index
+    group_keys = patient_groups.to_numpy()
+    groups = list(total_patients_counts)
+
+    def group_sums(frame):
+        return (
+            frame.loc[patient_pks]
+            .groupby(group_keys)
+            .sum()
+            .reindex(groups)
+            .fillna(0)
+            .astype(int)
+        )
+
+    kpi_5_eligible = dataframe_engine.eligible[5]
+    eligible_counts = group_sums(dataframe_engine.eligible)
+    passed_counts = group_sums(dataframe_engine.passed)
+    # KPI 32.1 counts health checks
+    eligible_counts[321] = group_sums(
+        dataframe_engine.expected_health_checks.where(kpi_5_eligible, 0)
+    )
+    passed_counts[321] = group_sums(
+        dataframe_engine.completed_health_checks.where(kpi_5_eligible, 0)
+    )
+
+    median_hba1c = (
+        dataframe_engine.median_hba1c.where(dataframe_engine.eligible[44])
+        .loc[patient_pks]
+        .set_axis(group_keys)
+        .dropna()
+    )
+    hba1c_sketch_keys = np.round(median_hba1c * HBA1C_SKETCH_SCALE).astype(np.int64)
+
+    kpi_partials = {}
+    for group in groups:
+        group_sketch_keys = hba1c_sketch_keys[hba1c_sketch_keys.index == group]
+        kpi_partials[group] = KPIPartials(
+            audit_start_date=dataframe_engine.audit_start_date,
+            audit_end_date=dataframe_engine.audit_end_date,
+            total_patients_count=total_patients_counts[group],
+            eligible={
+                kpi_number: int(eligible_counts.at[group, kpi_number])
+                for kpi_number in KPI_NUMBERS
+            },
+            passed={
+                kpi_number: int(passed_counts.at[group, kpi_number])
+                for kpi_number in KPI_NUMBERS
+                if kpi_number not in COUNT_ONLY_KPI_NUMBERS
+            },
+            hba1c_sum=float(median_hba1c[median_hba1c.index == group].sum()),
+            hba1c_count=len(group_sketch_keys),
+            hba1c_sketch={
+                int(value): int(count)
+                for value, count in group_sketch_keys.value_counts().items()
+            },
+        )
+
+    return kpi_partials
@@ -0,0 +1,104 @@
+"""Opt-in profiling of KPI calculations, `CalculateKPIS(profile=True)`.
+
+Records, per named step (each `calculate_kpi_*` method, or an engine's single
+pass), the wall time, number of SQL statements and the time spent executing
+them. A step that runs another (e.g. a KPI lazily calculating its base
+cohort) includes the time and queries of the inner step.
+
+Usage:
+    profiler = KPIProfiler()
+    with profiler.profile("kpi_25_hba1c"):
+        ...
+    logger.info(format_kpi_profile(profiler.steps))
+"""
+
+# Python imports
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+# Django imports
+from django.db import connection
+
+# Profile of a single step, e.g.
+# {"wall_time": 0.012, "queries": 2, "db_time": 0.009} (times in seconds)
+KPIProfile = dict[str, float | int]
+
+
+class _QueryTimer:
+    """`connection.execute_wrapper` counting and timing every statement"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+class KPIProfiler:
+    """Accumulates a KPIProfile per step name in `steps`"""
+
+    def __init__(self):
+        self.steps: dict[str, KPIProfile] = {}
+
+    @contextmanager
+    def profile(self, name: str):
+        query_timer = _QueryTimer()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(query_timer):
+                yield
+        finally:
+            step = self.steps.setdefault(
+                name, {"wall_time": 0.0, "queries": 0, "db_time": 0.0}
+            )
+            step["wall_time"] += time.perf_counter() - start
+            step["queries"] += query_timer.queries
+            step["db_time"] += query_timer.db_time
+
+
+def merge_kpi_profiles(
+    profiles: Iterable[dict[str, KPIProfile]],
+) -> dict[str, KPIProfile]:
+    """Sums the profiles of several calculations (e.g. one per PDU) by step"""
+
+    merged = {}
+    for profile in profiles:
+        for name, step in profile.items():
+            merged_step = merged.setdefault(
+                name, {"wall_time": 0.0, "queries": 0, "db_time": 0.0}
+            )
+            for key, value in step.items():
+                merged_step[key] += value
+    return merged
+
+
+def format_kpi_profile(
+    profile: dict[str, KPIProfile], limit: Optional[int] = None
+) -> str:
+    """Renders a profile as a plain text table, slowest step first"""
+
+    rows = sorted(profile.items(), key=lambda item: item[1]["wall_time"], reverse=True)
+    if limit is not None:
+        rows = rows[:limit]
+
+    name_width = max([len("step")] + [len(name) for name, _ in rows])
+    lines = [f"{'step':<{name_width}}  {'wall ms':>10}  {'queries':>8}  {'db ms':>10}"]
+    for name, step in rows:
+        lines.append(
+            f"{name:<{name_width}}  {step['wall_time'] * 1000:>10.1f}  "
+            f"{step['queries']:>8}  {step['db_time'] * 1000:>10.1f}"
+        )
+    lines.append(
+        f"{'total':<{name_width}}  "
+        f"{sum(step['wall_time'] for _, step in rows) * 1000:>10.1f}  "
+        f"{sum(step['queries'] for _, step in rows):>8}  "
+        f"{sum(step['db_time'] for _, step in rows) * 1000:>10.1f}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,158 @@
+"""History of KPI results per PDU.
+
+Each calculation saved with `save_kpi_snapshots` adds one KPISnapshot row
+per (PZ code, audit period, KPI), stamped with its `calculation_datetime`.
+Snapshots are written by the `calculate_kpis --snapshot` command (e.g. on a
+schedule) and after each csv upload, and read back by `get_kpi_trend` to
+compare a PDU's KPIs year on year or quarter on quarter, without running
+CalculateKPIS for every period again.
+"""
+
+# Python imports
+import logging
+from datetime import date
+from typing import Iterable, Optional
+
+# Django imports
+from django.db.models.functions import TruncQuarter
+from django.utils import timezone
+
+# NPDA Imports
+from project.constants.types.kpi_types import KPICalculationsObject, kpi_registry
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import KPISnapshot
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Intervals of `get_kpi_trend`
+AUDIT_YEAR = "audit_year"
+QUARTER = "quarter"
+TREND_INTERVALS = [AUDIT_YEAR, QUARTER]
+
+TREND_FIELDS = [
+    "audit_start_date",
+    "audit_end_date",
+    "calculation_datetime",
+    "total_eligible",
+    "total_ineligible",
+    "total_passed",
+    "total_failed",
+]
+
+# calculated_kpi_values are keyed by attribute name, e.g.
+# kpi_32_1_health_check_completion_rate -> 321
+KPI_NUMBERS_BY_ATTRIBUTE_NAME = {
+    kpi_registry.get_attribute_name(kpi_number): kpi_number
+    for kpi_number in kpi_registry.get_kpi_numbers()
+}
+
+
+def build_kpi_snapshots(
+    pz_code: str, kpi_calculations: KPICalculationsObject
+) -> list[KPISnapshot]:
+    """Unsaved KPISnapshots of each KPI in a PDU's KPICalculationsObject"""
+
+    calculation_datetime = kpi_calculations["calculation_datetime"]
+    if timezone.is_naive(calculation_datetime):
+        calculation_datetime = timezone.make_aware(calculation_datetime)
+
+    return [
+        KPISnapshot(
+            pz_code=pz_code,
+            audit_start_date=kpi_calculations["audit_start_date"],
+            audit_end_date=kpi_calculations["audit_end_date"],
+            kpi_number=KPI_NUMBERS_BY_ATTRIBUTE_NAME[kpi_name],
+            calculation_datetime=calculation_datetime,
+            total_eligible=kpi_result["total_eligible"],
+            total_ineligible=kpi_result["total_ineligible"],
+            total_passed=kpi_result["total_passed"],
+            total_failed=kpi_result["total_failed"],
+        )
+        for kpi_name, kpi_result in kpi_calculations["calculated_kpi_values"].items()
+    ]
+
+
+def save_kpi_snapshots(
+    kpi_calculations_by_pdu: dict[str, KPICalculationsObject],
+) -> int:
+    """Saves a snapshot of each PDU's KPI results, as returned by
+    `calculate_kpis_by_pdu`. Saving the same calculation twice is a no-op.
+
+    Returns the number of KPISnapshots saved.
+    """
+
+    snapshots = [
+        snapshot
+        for pz_code, kpi_calculations in kpi_calculations_by_pdu.items()
+        for snapshot in build_kpi_snapshots(pz_code, kpi_calculations)
+    ]
+    KPISnapshot.objects.bulk_create(snapshots, ignore_conflicts=True)
+
+    logger.debug(
+        f"Saved {len(snapshots)} KPI snapshots for {len(kpi_calculations_by_pdu)} PDUs"
+    )
+    return len(snapshots)
+
+
+def snapshot_kpis_for_pdu(
+    pz_code: str, calculation_date: Optional[date] = None
+) -> KPICalculationsObject:
+    """Calculates a PDU's KPIs from its stored KPI statuses and saves a
+    snapshot of them, e.g. after a csv upload.
+
+    The results are also cached, so the dashboard doesn't calculate them
+    again."""
+
+    kpi_calculations = CalculateKPIS(
+        calculation_date=calculation_date or date.today(), engine="stored"
+    ).calculate_kpis_for_pdus([pz_code], use_cache=True)
+
+    save_kpi_snapshots({pz_code: kpi_calculations})
+    return kpi_calculations
+
+
+def get_kpi_trend(
+    pz_code: str,
+    kpi_numbers: Optional[Iterable[int]] = None,
+    interval: str = AUDIT_YEAR,
+) -> dict[int, list[dict]]:
+    """A PDU's snapshotted KPI results over time, oldest first.
+
+    With `interval="audit_year"`, the latest snapshot of each audit period.
+    With `interval="quarter"`, the latest snapshot calculated in each quarter
+    of each audit period (calendar quarters, which line up with the April to
+    March audit year).
+
+    Returns a dict of kpi_number: list of dicts of TREND_FIELDS (plus
+    "quarter" - the first day of the quarter - for quarterly trends).
+    """
+
+    if interval not in TREND_INTERVALS:
+        raise ValueError(f"Unknown trend interval: {interval}")
+
+    snapshots = KPISnapshot.objects.filter(pz_code=pz_code)
+    if kpi_numbers is not None:
+        snapshots = snapshots.filter(kpi_number__in=list(kpi_numbers))
+
+    # PostgreSQL DISTINCT ON keeps the first, so latest, row of each period
+    periods = ["kpi_number", "audit_start_date"]
+    fields = TREND_FIELDS
+    if interval == QUARTER:
+        snapshots = snapshots.annotate(quarter=TruncQuarter("calculation_datetime"))
+        periods.append("quarter")
+        fields = TREND_FIELDS + ["quarter"]
+
+    snapshots = (
+        snapshots.order_by(*periods, "-calculation_datetime")
+        .distinct(*periods)
+        .values("kpi_number", *fields)
+    )
+
+    trend = {}
+    for snapshot in snapshots:
+        kpi_number = snapshot.pop("kpi_number")
+        if interval == QUARTER:
+            snapshot["quarter"] = snapshot["quarter"].date()
+        trend.setdefault(kpi_number, []).append(snapshot)
+    return trend
@@ -2,6 +2,7 @@
 """
 
 import logging
+from contextlib import nullcontext
 from dataclasses import asdict, is_dataclass
 from datetime import date, datetime, timedelta
 
@@ -10,17 +11,17 @@ from decimal import Decimal
 from pprint import pformat
 from typing import Optional, Tuple, Union
 
+import numpy as np
+import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 # Django imports
 from django.apps import apps
 from django.db.models import (
-    Avg,
     Case,
     Count,
     Exists,
     F,
-    Func,
     IntegerField,
     OuterRef,
     Q,
@@ -46,8 +47,34 @@ from project.constants.types.kpi_types import (
     kpi_registry,
 )
 from project.constants.yes_no_unknown import YES_NO_UNKNOWN
-from project.npda.general_functions import get_audit_period_for_date
-from project.npda.models import Patient, Visit
+from project.npda.general_functions import (
+    get_audit_period_for_date,
+    get_quarter_end_dates,
+)
+from project.npda.kpi_class.aggregates import Median
+from project.npda.kpi_class.dataframe_engine import (
+    COUNT_ONLY_KPI_NUMBERS,
+    DataFrameKPIEngine,
+)
+from project.npda.kpi_class.fused_queries import FusedKPIQueries
+from project.npda.kpi_class.kpi_cache import (
+    get_cached_kpi_partials,
+    get_cached_kpi_results,
+    get_kpi_partials_cache_keys,
+    get_kpi_results_cache_key,
+    set_cached_kpi_partials,
+    set_cached_kpi_results,
+)
+from project.npda.kpi_class.kpi_partials import (
+    KPIPartials,
+    kpi_partials_by_group,
+    merge_kpi_partials,
+)
+from project.npda.kpi_class.kpi_profiler import KPIProfiler, format_kpi_profile
+from project.npda.kpi_class.patient_ids import get_patient_ids_object, to_patient_ids
+from project.npda.kpi_class.patient_kpi_status import StoredKPIResults
+from project.npda.models import Patient, Transfer, Visit
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -58,18 +85,52 @@ class CalculateKPIS:
     Calculates KPIs
     """
 
+    ENGINES = ("sql", "fused", "dataframe", "stored")
+
+    # PaediatricDiabetesUnit field each rollup level groups PDUs by
+    ROLLUP_LEVELS = {
+        "network": "paediatric_diabetes_network_code",
+        "trust": "parent_ods_code",
+        "national": None,
+    }
+
     def __init__(
         self,
         calculation_date: date = None,
         return_pt_querysets: bool = False,
+        engine: str = "sql",
+        kpis: Optional[list[int]] = None,
+        profile: bool = False,
     ):
         """Calculates KPIs for given pz_code
 
         Initialise with:
             * calculation_date (date) - used to define start and end date of
             audit period
-            * return_pt_querysets (bool) - if True, will return the querysets
-            of patients for each kpi calculation
+            * return_pt_querysets (bool) - if True, will return the patients
+            for each kpi calculation, as `patient_ids` (sorted arrays of
+            eligible, ineligible, passed and failed patient pks)
+            * engine (str) - one of:
+                - "sql" (default): each KPI is calculated with its own ORM
+                queries (the `calculate_kpi_*` methods)
+                - "fused": all count-style KPIs are counted in a single
+                conditional aggregation query (see `FusedKPIQueries`). KPIs
+                44 and 45 still use their `calculate_kpi_*` methods.
+                - "dataframe": patients, visits and transfers are loaded once
+                and all KPIs are evaluated in memory in a single pass (see
+                `DataFrameKPIEngine`).
+                - "stored": aggregates the per-patient `PatientKPIStatus`
+                table with a single GROUP BY (see `StoredKPIResults`), or
+                for a single PDU reads its running counts (`PDUKPICount`).
+            Results are identical whichever engine is used.
+            * kpis (list[int]) - KPI numbers to calculate (e.g. [25, 44]).
+            Defaults to all of them. Only these and the KPIs they depend on
+            (see `KPIRegistry.get_calculation_order`) are calculated, but only
+            these are returned.
+            * profile (bool) - if True, records the wall time, number of SQL
+            statements and DB time of each `calculate_kpi_*` method (and of
+            the engine's single pass), returned under a `profile` key and
+            logged (debug) as a table, slowest first (see `kpi_profiler.py`).
 
         Exposes methods:
             1) calculate_kpis_for_patients (QuerySet[Patient])
@@ -77,7 +138,8 @@ class CalculateKPIS:
             2) calculate_kpis_for_pdus (list[str])
                 - Calculate KPIs for given PZ codes.
             3) calculate_kpis_for_single_patient (Patient)
-                - Calculate KPIs for a single patient.
+                - Calculate KPIs for a single patient (by default, KPIs 13
+                onwards).
 
             Each calculation method works to set the `self.patients` and
             `self.total_patients_count` attributes used throughout all
@@ -104,9 +166,22 @@ class CalculateKPIS:
         # Set the return_pt_querysets attribute
         self.return_pt_querysets = return_pt_querysets
 
+        if engine not in self.ENGINES:
+            raise ValueError(
+                f"engine must be one of {self.ENGINES}, got {engine!r}"
+            )
+        self.engine = engine
+
         # Sets the KPI attribute names map
         self.kpi_name_registry = kpi_registry
 
+        if kpis is not None:
+            # Raises ValueError for any unknown KPI number
+            self.kpi_name_registry.get_calculation_order(kpis)
+        self.kpis = kpis
+
+        self.profiler = KPIProfiler() if profile else None
+
     def calculate_kpis_for_patients(
         self,
         patients: QuerySet[Patient],
@@ -120,6 +195,7 @@ class CalculateKPIS:
         """
 
         self.patients = patients
+        self.pz_code = None
         self.total_patients_count = self.patients.count()
 
         return self._calculate_kpis()
@@ -127,92 +203,572 @@ class CalculateKPIS:
     def calculate_kpis_for_pdus(
         self,
         pz_codes: list[str],
+        use_cache: bool = False,
     ) -> KPICalculationsObject:
         """Calculate KPIs 1 - 49 for given pz_codes and cohort range
         (self.audit_start_date and self.audit_end_date).
 
         Params:
             * pz_codes (list[str]) - List of PZ codes used to filter patients
-            for KPI calculations and aggregations."""
+            for KPI calculations and aggregations.
+            * use_cache (bool) - Reuse results from the KPI results cache
+            while none of the PDUs' data has changed (see kpi_cache.py).
+            Ignored when profiling."""
 
         self.patients = Patient.objects.filter(
             paediatric_diabetes_units__paediatric_diabetes_unit__pz_code__in=pz_codes
         )
+        # The stored engine reads a single PDU's running KPI counts
+        self.pz_code = pz_codes[0] if len(set(pz_codes)) == 1 else None
+
+        use_cache = use_cache and self.profiler is None
+
+        if use_cache:
+            cache_key = get_kpi_results_cache_key(
+                pz_codes=pz_codes,
+                audit_start_date=self.audit_start_date,
+                return_pt_querysets=self.return_pt_querysets,
+                kpi_numbers=self.kpis,
+            )
+            cached_kpi_calculations = get_cached_kpi_results(cache_key)
+            if cached_kpi_calculations is not None:
+                return cached_kpi_calculations
+
         self.total_patients_count = self.patients.count()
+        kpi_calculations = self._calculate_kpis()
 
-        return self._calculate_kpis()
+        if use_cache:
+            set_cached_kpi_results(cache_key, kpi_calculations)
+
+        return kpi_calculations
+
+    def calculate_kpis_by_pdu(
+        self,
+        pz_codes: Optional[list[str]] = None,
+    ) -> dict[str, KPICalculationsObject]:
+        """Calculate KPIs 1 - 49 separately for each PDU, in a single pass.
+
+        All patients are loaded once into the `DataFrameKPIEngine` (whatever
+        `self.engine` is) and aggregated with one groupby on PZ code, rather
+        than running a full calculation per PDU. A patient transferred
+        between PDUs is counted in each of them, as with
+        `calculate_kpis_for_pdus`.
+
+        Params:
+            * pz_codes (list[str]) - PZ codes to calculate KPIs for. Defaults
+            to every PDU with patients.
+
+        Returns a dict of pz_code: KPICalculationsObject. If profiling, the
+        profile of the single pass is left in `self.profiler.steps` rather
+        than being returned with each PDU.
+        """
+
+        dataframe_engine, patient_groups, total_patients_counts = (
+            self._load_dataframe_engine_by_pdu(pz_codes)
+        )
+
+        with self._profile("dataframe engine by pdu"):
+            kpi_results_by_pdu = dataframe_engine.calculate_kpi_results_by_group(
+                patient_groups=patient_groups,
+                total_patients_counts=total_patients_counts,
+            )
+
+        kpi_calculations_by_pdu = {}
+        for pz_code, kpi_results in kpi_results_by_pdu.items():
+            if self.kpis is not None:
+                kpi_results = {
+                    kpi_number: kpi_result
+                    for kpi_number, kpi_result in kpi_results.items()
+                    if kpi_number in self.kpis
+                }
+            if self.return_pt_querysets:
+                pdu_patient_pks = patient_groups.index[patient_groups == pz_code]
+                with self._profile("patient ids"):
+                    for kpi_number, kpi_result in kpi_results.items():
+                        kpi_result.patient_ids = {
+                            key: np.asarray(pks, dtype=np.int64)
+                            for key, pks in dataframe_engine.get_patient_pks(
+                                kpi_number, patient_pks=pdu_patient_pks
+                            ).items()
+                        }
+
+            kpi_calculations_by_pdu[pz_code] = self._get_kpi_calculations_object(
+                kpi_results=kpi_results,
+                total_patients_count=total_patients_counts[pz_code],
+            )
+
+        return kpi_calculations_by_pdu
+
+    def calculate_kpi_partials_by_pdu(
+        self,
+        pz_codes: Optional[list[str]] = None,
+        use_cache: bool = False,
+    ) -> dict[str, KPIPartials]:
+        """Calculate the mergeable KPI partials (see kpi_partials.py) of each
+        PDU, loading all of their patients once as `calculate_kpis_by_pdu`
+        does.
+
+        Params:
+            * pz_codes (list[str]) - PZ codes to calculate partials for.
+            Defaults to every PDU with patients.
+            * use_cache (bool) - Reuse each PDU's cached partials while none
+            of its data has changed (see kpi_cache.py), so only the PDUs
+            without them are loaded.
+
+        Returns a dict of pz_code: KPIPartials.
+        """
+
+        if pz_codes is None:
+            pz_codes = list(
+                Transfer.objects.order_by()
+                .values_list("paediatric_diabetes_unit__pz_code", flat=True)
+                .distinct()
+            )
+
+        kpi_partials_by_pdu = {}
+        if use_cache:
+            cache_keys = get_kpi_partials_cache_keys(
+                pz_codes=pz_codes, audit_start_date=self.audit_start_date
+            )
+            kpi_partials_by_pdu = get_cached_kpi_partials(cache_keys)
+
+        uncached_pz_codes = [
+            pz_code for pz_code in pz_codes if pz_code not in kpi_partials_by_pdu
+        ]
+        if uncached_pz_codes:
+            dataframe_engine, patient_groups, total_patients_counts = (
+                self._load_dataframe_engine_by_pdu(uncached_pz_codes)
+            )
+            with self._profile("dataframe engine partials by pdu"):
+                calculated_kpi_partials = kpi_partials_by_group(
+                    dataframe_engine,
+                    patient_groups=patient_groups,
+                    total_patients_counts=total_patients_counts,
+                )
+            if use_cache:
+                set_cached_kpi_partials(cache_keys, calculated_kpi_partials)
+            kpi_partials_by_pdu.update(calculated_kpi_partials)
+
+        return {pz_code: kpi_partials_by_pdu[pz_code] for pz_code in pz_codes}
+
+    def calculate_kpis_by_rollup(
+        self,
+        level: str,
+        use_cache: bool = True,
+    ) -> dict[str, KPICalculationsObject]:
+        """Calculate KPIs 1 - 49 for each paediatric diabetes network ("network"),
+        trust ("trust") or nationally ("national"), by merging the KPI
+        partials of their PDUs (see `calculate_kpi_partials_by_pdu`) rather
+        than loading their patients and visits again.
+
+        A patient who has been in more than one PDU is counted in each of
+        them, so may be counted more than once in a rollup. PDUs without a
+        network or trust code are left out of those rollups.
+
+        Returns a dict of network code, parent ODS code or "national":
+        KPICalculationsObject. Patient ids aren't returned.
+        """
+
+        if level not in self.ROLLUP_LEVELS:
+            raise ValueError(
+                f"level must be one of {tuple(self.ROLLUP_LEVELS)}, got {level!r}"
+            )
+        rollup_field = self.ROLLUP_LEVELS[level]
+
+        kpi_partials_by_pdu = self.calculate_kpi_partials_by_pdu(use_cache=use_cache)
+
+        rollup_pz_codes = {}
+        if rollup_field is None:
+            rollup_pz_codes["national"] = list(kpi_partials_by_pdu)
+        else:
+            for pz_code, rollup_code in (
+                PaediatricDiabetesUnit.objects.filter(
+                    pz_code__in=list(kpi_partials_by_pdu),
+                    **{f"{rollup_field}__isnull": False},
+                )
+                .values_list("pz_code", rollup_field)
+                .distinct()
+            ):
+                rollup_pz_codes.setdefault(rollup_code, []).append(pz_code)
+
+        kpi_calculations_by_rollup = {}
+        for rollup_code, pz_codes in sorted(rollup_pz_codes.items()):
+            merged_kpi_partials = merge_kpi_partials(
+                kpi_partials_by_pdu[pz_code] for pz_code in sorted(set(pz_codes))
+            )
+            if merged_kpi_partials is None:
+                continue
+
+            kpi_results = merged_kpi_partials.to_kpi_results()
+            if self.kpis is not None:
+                kpi_results = {
+                    kpi_number: kpi_result
+                    for kpi_number, kpi_result in kpi_results.items()
+                    if kpi_number in self.kpis
+                }
+            kpi_calculations_by_rollup[rollup_code] = (
+                self._get_kpi_calculations_object(
+                    kpi_results=kpi_results,
+                    total_patients_count=merged_kpi_partials.total_patients_count,
+                )
+            )
+
+        return kpi_calculations_by_rollup
+
+    def calculate_kpis_by_quarter(
+        self,
+        pz_codes: list[str],
+    ) -> dict[int, KPICalculationsObject]:
+        """Calculate KPIs 1 - 49 for given pz_codes cumulatively for each
+        quarter of the audit period: Q1, Q1 - Q2, Q1 - Q3 and the full year.
+
+        The patients, their visits and transfers are loaded once into the
+        `DataFrameKPIEngine` (whatever `self.engine` is), which is then
+        re-evaluated in memory for each quarter's end date, rather than
+        calculating four audit periods separately. Each period's results are
+        the same as for an audit period ending on that quarter's last day.
+
+        Returns a dict of quarter number (1 - 4): KPICalculationsObject, with
+        `audit_end_date` set to the last day of the quarter. If profiling,
+        the profile is left in `self.profiler.steps`.
+        """
+
+        self.patients = Patient.objects.filter(
+            paediatric_diabetes_units__paediatric_diabetes_unit__pz_code__in=pz_codes
+        )
+        self.pz_code = None
+        self.total_patients_count = self.patients.count()
+
+        dataframe_engine = DataFrameKPIEngine(
+            audit_start_date=self.audit_start_date,
+            audit_end_date=self.audit_end_date,
+        )
+        with self._profile("dataframe engine load"):
+            dataframe_engine.load(self.patients)
+
+        quarter_end_dates = get_quarter_end_dates(self.audit_start_date)
+
+        kpi_calculations_by_quarter = {}
+        # The engine is loaded for the full year, so it's evaluated first
+        for quarter, quarter_end_date in reversed(
+            list(enumerate(quarter_end_dates, start=1))
+        ):
+            if quarter_end_date != dataframe_engine.audit_end_date:
+                with self._profile("dataframe engine quarter"):
+                    dataframe_engine.set_audit_end_date(quarter_end_date)
+
+            kpi_results = dataframe_engine.calculate_kpi_results(
+                total_patients_count=self.total_patients_count
+            )
+            if self.kpis is not None:
+                kpi_results = {
+                    kpi_number: kpi_result
+                    for kpi_number, kpi_result in kpi_results.items()
+                    if kpi_number in self.kpis
+                }
+            if self.return_pt_querysets:
+                with self._profile("patient ids"):
+                    for kpi_number, kpi_result in kpi_results.items():
+                        kpi_result.patient_ids = {
+                            key: np.asarray(pks, dtype=np.int64)
+                            for key, pks in dataframe_engine.get_patient_pks(
+                                kpi_number
+                            ).items()
+                        }
+
+            kpi_calculations = self._get_kpi_calculations_object(
+                kpi_results=kpi_results,
+                total_patients_count=self.total_patients_count,
+            )
+            kpi_calculations["audit_end_date"] = quarter_end_date
+            kpi_calculations_by_quarter[quarter] = kpi_calculations
+
+        return dict(sorted(kpi_calculations_by_quarter.items()))
+
+    def calculate_kpis_by_period(
+        self,
+        pz_codes: list[str],
+        calculation_dates: list[date],
+    ) -> dict[date, KPICalculationsObject]:
+        """Calculate KPIs 1 - 49 for given pz_codes for each audit period
+        (e.g. the current and previous audit years), given as a date within
+        each period, as `calculation_date` is.
+
+        The patients, their visits and transfers are loaded once into the
+        `DataFrameKPIEngine` (whatever `self.engine` is) for the span of all
+        the periods, which is then re-evaluated in memory for each period,
+        rather than loading the cohort for each period separately. Each
+        period's results are the same as calculating it on its own.
+
+        Returns a dict of audit start date: KPICalculationsObject, oldest
+        period first. If profiling, the profile is left in
+        `self.profiler.steps`.
+        """
+
+        audit_periods = sorted(
+            {
+                get_audit_period_for_date(calculation_date)
+                for calculation_date in calculation_dates
+            }
+        )
+        if not audit_periods:
+            return {}
+
+        self.patients = Patient.objects.filter(
+            paediatric_diabetes_units__paediatric_diabetes_unit__pz_code__in=pz_codes
+        )
+        self.pz_code = None
+        self.total_patients_count = self.patients.count()
+
+        dataframe_engine = DataFrameKPIEngine(
+            audit_start_date=audit_periods[0][0],
+            audit_end_date=audit_periods[-1][1],
+        )
+        with self._profile("dataframe engine load"):
+            dataframe_engine.load(self.patients)
+
+        kpi_calculations_by_period = {}
+        for audit_start_date, audit_end_date in audit_periods:
+            with self._profile("dataframe engine period"):
+                dataframe_engine.set_audit_period(audit_start_date, audit_end_date)
+
+            kpi_results = dataframe_engine.calculate_kpi_results(
+                total_patients_count=self.total_patients_count
+            )
+            if self.kpis is not None:
+                kpi_results = {
+                    kpi_number: kpi_result
+                    for kpi_number, kpi_result in kpi_results.items()
+                    if kpi_number in self.kpis
+                }
+            if self.return_pt_querysets:
+                with self._profile("patient ids"):
+                    for kpi_number, kpi_result in kpi_results.items():
+                        kpi_result.patient_ids = {
+                            key: np.asarray(pks, dtype=np.int64)
+                            for key, pks in dataframe_engine.get_patient_pks(
+                                kpi_number
+                            ).items()
+                        }
+
+            kpi_calculations = self._get_kpi_calculations_object(
+                kpi_results=kpi_results,
+                total_patients_count=self.total_patients_count,
+            )
+            kpi_calculations["audit_start_date"] = audit_start_date
+            kpi_calculations["audit_end_date"] = audit_end_date
+            kpi_calculations_by_period[audit_start_date] = kpi_calculations
+
+        return kpi_calculations_by_period
 
     def calculate_kpis_for_single_patient(
         self, patient: Patient
     ) -> KPICalculationsObject:
         """Calculate relevant KPIs subset for a single patient.
 
+        Individual patients exclude KPIs 1 - 12 (counts) unless `kpis` was
+        given. Those used as denominators are still calculated, but not
+        returned.
+
         Params:
             * patient (Patient) - Single patient for KPI calculations and aggregations.
         """
 
         self.patients = Patient.objects.filter(pk=patient.pk)
+        self.pz_code = None
         self.total_patients_count = self.patients.count()
 
-        # Because the calculations require KPIs 1-12 to act as denominators,
-        # we need to run all of them still. And at the end, just filter out
-        # the ones we don't need.
-        calculations_object = self._calculate_kpis()
-
-        # Individual patients should exclude KPIs 1 - 12 (counts)
-        # First set the KPIs to exclude
-        exclude_kpis_subset = list(range(1, 13))
-        # Get the kpi_attribute_names from those indexes
-        exclude_kpi_keys = set(
-            [self.kpi_name_registry.get_attribute_name(i) for i in exclude_kpis_subset]
-        )
-
-        # Create new filtered dict
-        current_calculated_kpi_values = calculations_object["calculated_kpi_values"]
-        filtered_calculated_kpi_values = {}
-        for kpi_name, kpi_result in current_calculated_kpi_values.items():
-
-            if kpi_name not in exclude_kpi_keys:
-                filtered_calculated_kpi_values[kpi_name] = kpi_result
-
-        calculations_object["calculated_kpi_values"] = filtered_calculated_kpi_values
+        kpi_numbers = self.kpis
+        if kpi_numbers is None:
+            kpi_numbers = [
+                kpi_number
+                for kpi_number in self.kpi_name_registry.get_kpi_numbers()
+                if kpi_number not in COUNT_ONLY_KPI_NUMBERS
+            ]
 
-        return calculations_object
+        return self._calculate_kpis(kpi_numbers=kpi_numbers)
 
     def _calculate_kpis(
         self,
+        kpi_numbers: Optional[list[int]] = None,
     ) -> KPICalculationsObject:
-        """Calculate KPIs 1 - 49 for set self.patients and cohort range
+        """Calculate KPIs (`kpi_numbers`, defaulting to `self.kpis` or else
+        all of them) for set self.patients and cohort range
         (self.audit_start_date and self.audit_end_date).
 
-        We dynamically set these attributes using names set in self.kpis, done
-        in the self._get_kpi_attribute_names method during object init.
-
         Incrementally build the query, which will be executed in a single
         transaction once a value is evaluated.
         """
-        # Init dict to store calc results
-        calculated_kpis = {}
-
-        # Standard KPIs plus 32 which has 3 sub KPIs
-        kpi_idxs = list(range(1, 32)) + [321, 322, 323] + (list(range(33, 50)))
+        if kpi_numbers is None:
+            kpi_numbers = self.kpis
+        if kpi_numbers is None:
+            kpi_numbers = self.kpi_name_registry.get_kpi_numbers()
+
+        # The median HbA1cs are only shared by KPIs 44 and 45 of one
+        # calculation, not across calculations for other patients or periods
+        if hasattr(self, "kpi_1_eligible_pts_median_hba1cs"):
+            del self.kpi_1_eligible_pts_median_hba1cs
+
+        # KPI results already calculated by the selected engine, keyed by
+        # kpi number. Anything missing falls back to its calculate_ method.
+        precalculated_kpi_results = {}
+        if self.engine != "sql":
+            with self._profile(f"{self.engine} engine"):
+                if self.engine == "dataframe":
+                    precalculated_kpi_results = (
+                        self._calculate_kpis_with_dataframe_engine()
+                    )
+                elif self.engine == "fused":
+                    precalculated_kpi_results = (
+                        self._calculate_kpis_with_fused_queries(kpi_numbers)
+                    )
+                elif self.engine == "stored":
+                    precalculated_kpi_results = (
+                        self._calculate_kpis_from_stored_statuses()
+                    )
 
-        for i in kpi_idxs:
+        # The calculate_ methods set the base cohorts later KPIs filter on,
+        # so run the remaining KPIs with their dependencies, in order
+        calculation_order = self.kpi_name_registry.get_calculation_order(
+            [i for i in kpi_numbers if i not in precalculated_kpi_results]
+        )
+        calculated_kpi_results = {}
+        for i in calculation_order:
             # Dynamically get the method name from the kpis_names_map
-            kpi_method_name = self.kpi_name_registry.get_attribute_name(i)
+            calculated_kpi_results[i] = self._run_kpi_calculation_method(
+                self.kpi_name_registry.get_attribute_name(i)
+            )
+
+        kpi_results = {}
+        for i in self.kpi_name_registry.get_kpi_numbers():
+            if i in kpi_numbers:
+                kpi_results[i] = precalculated_kpi_results.get(
+                    i, calculated_kpi_results.get(i)
+                )
+
+        if self.return_pt_querysets:
+            with self._profile("patient ids"):
+                self._set_patient_ids(kpi_results)
+
+        kpi_calculations = self._get_kpi_calculations_object(
+            kpi_results=kpi_results,
+            total_patients_count=self.total_patients_count,
+        )
+
+        if self.profiler is not None:
+            kpi_calculations["profile"] = {
+                name: dict(step) for name, step in self.profiler.steps.items()
+            }
+            logger.debug(
+                "KPI calculation profile:\n%s",
+                format_kpi_profile(kpi_calculations["profile"]),
+            )
+
+        return kpi_calculations
+
+    def _set_patient_ids(self, kpi_results: dict[int, KPIResult]) -> None:
+        """Materialises each KPI's patient querysets once, as sorted arrays of
+        patient pks in `patient_ids` (see `get_patient_ids_object`), so
+        callers don't re-evaluate the querysets.
+
+        Only eligible and passed are evaluated, the rest is set algebra.
+        """
+
+        cohort_ids = None
+
+        for kpi_number, kpi_result in kpi_results.items():
+            if kpi_result.patient_ids is None:
+                if cohort_ids is None:
+                    cohort_ids = to_patient_ids(
+                        self.patients.values_list("pk", flat=True)
+                    )
+
+                patient_querysets = kpi_result.patient_querysets
+                eligible_ids = to_patient_ids(
+                    patient_querysets["eligible"].values_list("pk", flat=True)
+                )
+                passed_ids = (
+                    eligible_ids
+                    if patient_querysets["passed"] is patient_querysets["eligible"]
+                    else to_patient_ids(
+                        patient_querysets["passed"].values_list("pk", flat=True)
+                    )
+                )
+
+                kpi_result.patient_ids = get_patient_ids_object(
+                    kpi_number=kpi_number,
+                    cohort_ids=cohort_ids,
+                    eligible_ids=eligible_ids,
+                    passed_ids=passed_ids,
+                )
+            kpi_result.patient_querysets = None
+
+    def _load_dataframe_engine_by_pdu(
+        self,
+        pz_codes: Optional[list[str]] = None,
+    ) -> tuple[DataFrameKPIEngine, pd.Series, dict[str, int]]:
+        """Loads the patients of the given PDUs (defaulting to every PDU with
+        patients) into a DataFrameKPIEngine.
+
+        Returns the engine, each patient's PZ code(s) as a Series indexed by
+        patient pk and the total patients of each PDU.
+        """
+
+        transfers = Transfer.objects.all()
+        if pz_codes is not None:
+            transfers = transfers.filter(
+                paediatric_diabetes_unit__pz_code__in=pz_codes
+            )
+        patient_pdus = pd.DataFrame.from_records(
+            list(
+                transfers.order_by()
+                .values_list("patient_id", "paediatric_diabetes_unit__pz_code")
+                .distinct()
+            ),
+            columns=["patient_id", "pz_code"],
+        )
 
-            kpi_result = self._run_kpi_calculation_method(kpi_method_name)
+        self.patients = Patient.objects.filter(
+            pk__in=patient_pdus["patient_id"].unique().tolist()
+        )
+        self.pz_code = None
+
+        dataframe_engine = DataFrameKPIEngine(
+            audit_start_date=self.audit_start_date,
+            audit_end_date=self.audit_end_date,
+        )
+        with self._profile("dataframe engine load"):
+            dataframe_engine.load(self.patients)
+
+        patient_groups = patient_pdus.set_index("patient_id")["pz_code"]
+        total_patients_counts = {
+            pz_code: 0 for pz_code in (pz_codes if pz_codes is not None else [])
+        }
+        total_patients_counts.update(patient_groups.value_counts().to_dict())
 
+        return dataframe_engine, patient_groups, total_patients_counts
+
+    def _get_kpi_calculations_object(
+        self,
+        kpi_results: dict[int, KPIResult],
+        total_patients_count: int,
+    ) -> KPICalculationsObject:
+        """Builds the KPICalculationsObject from KPIResults keyed by kpi number."""
+
+        calculated_kpis = {}
+        for kpi_number, kpi_result in kpi_results.items():
             # Each kpi method returns a KPIResult object
             # so we convert it first to a dictionary
-            calculated_kpis[kpi_method_name] = asdict(kpi_result)
+            calculated_kpis[self.kpi_name_registry.get_attribute_name(kpi_number)] = (
+                asdict(kpi_result)
+            )
 
         # Add in used attributes for calculations
         return_obj = {}
         return_obj["calculation_datetime"] = datetime.now()
         return_obj["audit_start_date"] = self.audit_start_date
         return_obj["audit_end_date"] = self.audit_end_date
-        return_obj["total_patients_count"] = self.total_patients_count
+        return_obj["total_patients_count"] = total_patients_count
 
         # Finally, add in the kpis
         return_obj["calculated_kpi_values"] = {}
@@ -241,9 +797,95 @@ class CalculateKPIS:
 
         return return_obj
 
+    def _calculate_kpis_with_dataframe_engine(self) -> dict[int, KPIResult]:
+        """Evaluates all KPIs for self.patients in memory, in a single pass.
+
+        Returns a dict of kpi_number: KPIResult. Patient ids, if required,
+        come straight from the patient masks of each KPI.
+        """
+        dataframe_engine = DataFrameKPIEngine(
+            audit_start_date=self.audit_start_date,
+            audit_end_date=self.audit_end_date,
+        )
+        dataframe_engine.load(self.patients)
+
+        kpi_results = dataframe_engine.calculate_kpi_results(
+            total_patients_count=self.total_patients_count
+        )
+
+        if self.return_pt_querysets:
+            for kpi_number, kpi_result in kpi_results.items():
+                kpi_result.patient_ids = {
+                    key: np.asarray(pks, dtype=np.int64)
+                    for key, pks in dataframe_engine.get_patient_pks(
+                        kpi_number
+                    ).items()
+                }
+
+        return kpi_results
+
+    def _calculate_kpis_with_fused_queries(
+        self, kpi_numbers: list[int]
+    ) -> dict[int, KPIResult]:
+        """Counts the requested count-style KPIs for self.patients in a
+        single conditional aggregation query.
+
+        Returns a dict of kpi_number: KPIResult. Patient ids, if required,
+        are selected over the same annotated cohort in a single query.
+        """
+        fused_queries = FusedKPIQueries(
+            patients=self.patients,
+            audit_start_date=self.audit_start_date,
+            audit_end_date=self.audit_end_date,
+        )
+
+        kpi_results = fused_queries.calculate_kpi_results(
+            total_patients_count=self.total_patients_count,
+            kpi_numbers=kpi_numbers,
+        )
+
+        if self.return_pt_querysets:
+            patient_ids = fused_queries.get_patient_ids(kpi_numbers=kpi_numbers)
+            for kpi_number, kpi_result in kpi_results.items():
+                kpi_result.patient_ids = patient_ids[kpi_number]
+
+        return kpi_results
+
+    def _calculate_kpis_from_stored_statuses(self) -> dict[int, KPIResult]:
+        """Aggregates the stored per-patient KPI statuses for self.patients.
+
+        Returns a dict of kpi_number: KPIResult. Patient ids, if required,
+        are read from the stored statuses in a single query. For a single
+        PDU, totals are read from its running counts (`PDUKPICount`).
+        """
+        stored_kpi_results = StoredKPIResults(
+            patients=self.patients,
+            audit_start_date=self.audit_start_date,
+            audit_end_date=self.audit_end_date,
+            pz_code=self.pz_code,
+        )
+
+        kpi_results = stored_kpi_results.calculate_kpi_results(
+            total_patients_count=self.total_patients_count
+        )
+
+        if self.return_pt_querysets:
+            patient_ids = stored_kpi_results.get_patient_ids()
+            for kpi_number, kpi_result in kpi_results.items():
+                kpi_result.patient_ids = patient_ids[kpi_number]
+
+        return kpi_results
+
     def _get_audit_start_and_end_dates(self) -> tuple[date, date]:
         return get_audit_period_for_date(input_date=self.calculation_date)
 
+    def _profile(self, name: str):
+        """Profiles the enclosed step as `name`, if profiling"""
+
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.profile(name)
+
     def _get_kpi_label(self, kpi_number: int) -> str:
         """Returns a readable title for a given KPI number"""
 
@@ -258,7 +900,8 @@ class CalculateKPIS:
 
         kpi_method = getattr(self, f"calculate_{kpi_method_name}", None)
 
-        kpi_result = kpi_method()
+        with self._profile(kpi_method_name):
+            kpi_result = kpi_method()
 
         # Validations
         if not is_dataclass(kpi_result):
@@ -331,8 +974,7 @@ class CalculateKPIS:
         the returned KPIResult object.
         """
 
-        # Set the query set as an attribute to be used in subsequent KPI calculations
-        self.total_kpi_1_eligible_pts_base_query_set = self.patients.filter(
+        eligible_patients = self.patients.filter(
             # Valid attributes
             Q(nhs_number__isnull=False)
             & Q(date_of_birth__isnull=False)
@@ -346,9 +988,15 @@ class CalculateKPIS:
         # that fall within the specified date range, the patient will appear
         # multiple times in the filtered queryset—once for each matching visit.
 
-        # Count eligible patients and set as attribute
-        # to be used in subsequent KPI calculations
-        self.kpi_1_total_eligible = self.total_kpi_1_eligible_pts_base_query_set.count()
+        # Set the query set and count as attributes to be used in subsequent
+        # KPI calculations
+        (
+            self.total_kpi_1_eligible_pts_base_query_set,
+            self.kpi_1_total_eligible,
+        ) = self._materialise_cohort(
+            eligible_patients,
+            visit_filter=Q(visit__visit_date__range=(self.AUDIT_DATE_RANGE)),
+        )
         total_eligible = self.kpi_1_total_eligible
 
         # Calculate ineligible patients
@@ -400,12 +1048,15 @@ class CalculateKPIS:
         )
 
         # This is same as KPI1 but with an additional filter for diagnosis date
-        self.total_kpi_2_eligible_pts_base_query_set = base_eligible_patients.filter(
-            Q(diagnosis_date__range=(self.AUDIT_DATE_RANGE))
+        (
+            self.total_kpi_2_eligible_pts_base_query_set,
+            self.kpi_2_total_eligible,
+        ) = self._materialise_cohort(
+            base_eligible_patients.filter(
+                Q(diagnosis_date__range=(self.AUDIT_DATE_RANGE))
+            ),
+            visit_filter=Q(visit__visit_date__range=(self.AUDIT_DATE_RANGE)),
         )
-
-        # Count eligible patients
-        self.kpi_2_total_eligible = self.total_kpi_2_eligible_pts_base_query_set.count()
         total_eligible = self.kpi_2_total_eligible
 
         # Calculate ineligible patients
@@ -581,7 +1232,11 @@ class CalculateKPIS:
         )
 
         # Count eligible patients
-        total_eligible = eligible_patients.count()
+        eligible_patients, total_eligible = self._materialise_cohort(
+            eligible_patients,
+            # As KPI 1
+            visit_filter=Q(visit__visit_date__range=(self.AUDIT_DATE_RANGE)),
+        )
         # We also use this as denominator for subsequent KPIS
         # so set as attributes
         self.total_kpi_5_eligible_pts_base_query_set = eligible_patients
@@ -695,10 +1350,12 @@ class CalculateKPIS:
 
         eligible_patients = eligible_pts_annotated_kpi_6_visits.filter(
             valid_kpi_6_visits__gte=1
-        )
+        ).distinct()  # the reason for distinct is same as KPI1 (see comments).
+        # Subsequent KPIs (28-31) filter this on visit__ fields, which would
+        # otherwise count a patient once per matching visit.
 
         # Count eligible patients
-        total_eligible = eligible_patients.count()
+        eligible_patients, total_eligible = self._materialise_cohort(eligible_patients)
 
         # We reuse this as a base query set for subsequent KPIs so set
         # as an attribute
@@ -744,6 +1401,41 @@ class CalculateKPIS:
         the returned KPIResult object.
         """
 
+        # an observation within the audit period
+        # this requires checking for a date in any of the Visit model's
+        # observation fields (found simply by searching for date fields
+        # with the word 'observation' in the field verbose_name)
+        # Set as an attribute as the cohort stays joined to these visits (see
+        # `_materialise_cohort`)
+        self.kpi_7_observation_visit_filter = (
+            Q(visit__height_weight_observation_date__range=(self.AUDIT_DATE_RANGE))
+            | Q(visit__hba1c_date__range=(self.AUDIT_DATE_RANGE))
+            | Q(
+                visit__blood_pressure_observation_date__range=(
+                    self.AUDIT_DATE_RANGE
+                )
+            )
+            | Q(
+                visit__foot_examination_observation_date__range=(
+                    self.AUDIT_DATE_RANGE
+                )
+            )
+            | Q(
+                visit__retinal_screening_observation_date__range=(
+                    self.AUDIT_DATE_RANGE
+                )
+            )
+            | Q(visit__albumin_creatinine_ratio_date__range=(self.AUDIT_DATE_RANGE))
+            | Q(visit__total_cholesterol_date__range=(self.AUDIT_DATE_RANGE))
+            | Q(visit__thyroid_function_date__range=(self.AUDIT_DATE_RANGE))
+            | Q(visit__coeliac_screen_date__range=(self.AUDIT_DATE_RANGE))
+            | Q(
+                visit__psychological_screening_assessment_date__range=(
+                    self.AUDIT_DATE_RANGE
+                )
+            )
+        )
+
         # total_kpi_1_eligible_pts_base_query_set is slightly different
         # (additionally specifies visit date). So we need to make a new
         # query set
@@ -756,43 +1448,14 @@ class CalculateKPIS:
             # Diagnosis of Type 1 diabetes
             & Q(diabetes_type=DIABETES_TYPES[0][0])
             & Q(diagnosis_date__range=self.AUDIT_DATE_RANGE)
-            & (
-                # an observation within the audit period
-                # this requires checking for a date in any of the Visit model's
-                # observation fields (found simply by searching for date fields
-                # with the word 'observation' in the field verbose_name)
-                Q(visit__height_weight_observation_date__range=(self.AUDIT_DATE_RANGE))
-                | Q(visit__hba1c_date__range=(self.AUDIT_DATE_RANGE))
-                | Q(
-                    visit__blood_pressure_observation_date__range=(
-                        self.AUDIT_DATE_RANGE
-                    )
-                )
-                | Q(
-                    visit__foot_examination_observation_date__range=(
-                        self.AUDIT_DATE_RANGE
-                    )
-                )
-                | Q(
-                    visit__retinal_screening_observation_date__range=(
-                        self.AUDIT_DATE_RANGE
-                    )
-                )
-                | Q(visit__albumin_creatinine_ratio_date__range=(self.AUDIT_DATE_RANGE))
-                | Q(visit__total_cholesterol_date__range=(self.AUDIT_DATE_RANGE))
-                | Q(visit__thyroid_function_date__range=(self.AUDIT_DATE_RANGE))
-                | Q(visit__coeliac_screen_date__range=(self.AUDIT_DATE_RANGE))
-                | Q(
-                    visit__psychological_screening_assessment_date__range=(
-                        self.AUDIT_DATE_RANGE
-                    )
-                )
-            )
+            & self.kpi_7_observation_visit_filter
         ).distinct()  # the reason for distinct is same as KPI1 (see comments).
         # This time, was failing tests for KPI 41-42.
 
         # Count eligible patients
-        total_eligible = eligible_patients.count()
+        eligible_patients, total_eligible = self._materialise_cohort(
+            eligible_patients, visit_filter=self.kpi_7_observation_visit_filter
+        )
 
         # In case we need to use this as a base query set for subsequent KPIs
         self.total_kpi_7_eligible_pts_base_query_set = eligible_patients
@@ -942,13 +1605,7 @@ class CalculateKPIS:
         base_query_set, _ = (
             self._get_total_kpi_1_eligible_pts_base_query_set_and_total_count()
         )
-        eligible_patients = base_query_set.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        eligible_patients = base_query_set.filter(visit__in=latest_visit_subquery)
 
         # Count eligible patients
         total_eligible = eligible_patients.count()
@@ -1002,13 +1659,7 @@ class CalculateKPIS:
         base_query_set, _ = (
             self._get_total_kpi_1_eligible_pts_base_query_set_and_total_count()
         )
-        eligible_patients = base_query_set.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        eligible_patients = base_query_set.filter(visit__in=latest_visit_subquery)
 
         # Count eligible patients
         total_eligible = eligible_patients.count()
@@ -1060,13 +1711,7 @@ class CalculateKPIS:
         base_query_set, _ = (
             self._get_total_kpi_1_eligible_pts_base_query_set_and_total_count()
         )
-        eligible_patients = base_query_set.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        eligible_patients = base_query_set.filter(visit__in=latest_visit_subquery)
 
         # Count eligible patients
         total_eligible = eligible_patients.count()
@@ -1117,13 +1762,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1163,13 +1802,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1209,13 +1842,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1256,13 +1883,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1302,13 +1923,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1348,13 +1963,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1394,13 +2003,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1440,13 +2043,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1486,13 +2083,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1532,13 +2123,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1579,13 +2164,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         # Filter the Patient queryset based on the subquery
-        passed_patients = eligible_patients.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(visit__in=latest_visit_subquery).values("id")
-                )
-            )
-        )
+        passed_patients = eligible_patients.filter(visit__in=latest_visit_subquery)
         total_passed = passed_patients.count()
         total_failed = total_eligible - total_passed
 
@@ -1638,13 +2217,7 @@ class CalculateKPIS:
             .values("pk")[:1]
         )
         eligible_patients_kpi_24 = total_kpi_1_eligible_pts_base_query_set.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(
-                        visit__in=eligible_kpi_24_latest_visit_subquery
-                    ).values("id")
-                )
-            )
+            visit__in=eligible_kpi_24_latest_visit_subquery
         )
         total_eligible_kpi_24 = eligible_patients_kpi_24.count()
 
@@ -1659,18 +2232,12 @@ class CalculateKPIS:
 
         # Passing patients are the subset of kpi_24 eligible who are on closed loop system
         passing_patients = eligible_patients_kpi_24.filter(
-            Q(
-                id__in=Subquery(
-                    Patient.objects.filter(
-                        Q(visit__in=eligible_kpi_24_latest_visit_subquery)
-                        # AND whose most recent entry for item 21 (based on visit date) is either
-                        # * 2 = Closed loop system (licenced)
-                        # * or 3 = Closed loop system (DIY, unlicenced)
-                        # * or 4 = Closed loop system (licence status unknown)
-                        & Q(visit__closed_loop_system__in=[2, 3, 4])
-                    ).values("id")
-                )
-            )
+            Q(visit__in=eligible_kpi_24_latest_visit_subquery)
+            # AND whose most recent entry for item 21 (based on visit date) is either
+            # * 2 = Closed loop system (licenced)
+            # * or 3 = Closed loop system (DIY, unlicenced)
+            # * or 4 = Closed loop system (licence status unknown)
+            & Q(visit__closed_loop_system__in=[2, 3, 4])
         )
         total_passed = passing_patients.count()
         total_failed = eligible_patients_kpi_24.count() - total_passed
@@ -3033,8 +3600,8 @@ class CalculateKPIS:
 
         Denominator: Total number of eligible patients (measure 1)
 
-        NOTE: Django does not support Median aggregation function. We do
-        manually through custom `Median` class.
+        NOTE: the per patient medians are shared with KPI 45 (see
+        `_get_kpi_1_eligible_pts_median_hba1cs`).
 
         NOTE: for pt querysets, only `eligible` and `ineligible` are valid, the
             others should be discarded.
@@ -3044,39 +3611,11 @@ class CalculateKPIS:
         )
         total_ineligible = self.total_patients_count - total_eligible
 
-        # Calculate median HBa1c for each patient
-
-        # Get the visits that match the valid HbA1c criteria
-
-        # Subquery to filter valid HBA1c values while ensuring visit_date is in
-        # the required range
-        valid_hba1c_subquery = (
-            Visit.objects.filter(
-                visit_date__range=self.AUDIT_DATE_RANGE,
-                hba1c_date__gte=F("patient__diagnosis_date")
-                + timedelta(days=90),  # Ensure HbA1c is taken >90 days after diagnosis
-                patient=OuterRef("pk"),
-            )
-            # Clear any implicit ordering, select only 'hba1c' for calculating
-            # the median as getting error with the visit_date field
-            .order_by().values("hba1c")
-        )
-
-        # Annotate eligible patients with the median HbA1c value
-        eligible_pts_annotated = eligible_patients.annotate(
-            median_hba1c=Subquery(
-                valid_hba1c_subquery.annotate(median_hba1c=Median("hba1c")).values(
-                    "median_hba1c"
-                )[:1]
-            )
-        )
+        median_hba1cs = self._get_kpi_1_eligible_pts_median_hba1cs()
 
-        # Calculate the median of the medians and convert to float (as Decimal)
-        median_of_median_hba1cs = (
-            eligible_pts_annotated.aggregate(
-                median_of_median_hba1cs=Avg("median_hba1c")
-            ).get("median_of_median_hba1cs")
-            or 0
+        # Calculate the mean of the medians (0 if no patient has a valid HbA1c)
+        mean_of_median_hba1cs = (
+            float(np.mean(median_hba1cs)) if median_hba1cs.size else 0
         )
 
         # Also set pt querysets to be returned if required
@@ -3089,7 +3628,7 @@ class CalculateKPIS:
             total_eligible=total_eligible,
             total_ineligible=total_ineligible,
             # Use passed for storing the value
-            total_passed=median_of_median_hba1cs,
+            total_passed=mean_of_median_hba1cs,
             # Failed is not used
             total_failed=-1,
             patient_querysets=patient_querysets,
@@ -3099,7 +3638,7 @@ class CalculateKPIS:
         self,
     ) -> dict:
         """
-        Calculates KPI 43: Median HbA1c
+        Calculates KPI 45: Median HbA1c
 
         SINGLE NUMBER: median of HbA1c measurements (item 17) within the audit
         period, excluding measurements taken within 90 days of diagnosis
@@ -3109,6 +3648,9 @@ class CalculateKPIS:
 
         Denominator: Total number of eligible patients (measure 1)
 
+        NOTE: the per patient medians are shared with KPI 44 (see
+        `_get_kpi_1_eligible_pts_median_hba1cs`).
+
         NOTE: for pt querysets, only `eligible` and `ineligible` are valid, the
             others should be discarded.
         """
@@ -3117,39 +3659,11 @@ class CalculateKPIS:
         )
         total_ineligible = self.total_patients_count - total_eligible
 
-        # Calculate median HBa1c for each patient
+        median_hba1cs = self._get_kpi_1_eligible_pts_median_hba1cs()
 
-        # Get the visits that match the valid HbA1c criteria
-
-        # Subquery to filter valid HBA1c values while ensuring visit_date is in
-        # the required range
-        valid_hba1c_subquery = (
-            Visit.objects.filter(
-                visit_date__range=self.AUDIT_DATE_RANGE,
-                hba1c_date__gte=F("patient__diagnosis_date")
-                + timedelta(days=90),  # Ensure HbA1c is taken >90 days after diagnosis
-                patient=OuterRef("pk"),
-            )
-            # Clear any implicit ordering, select only 'hba1c' for calculating
-            # the median as getting error with the visit_date field
-            .order_by().values("hba1c")
-        )
-
-        # Annotate eligible patients with the median HbA1c value
-        eligible_pts_annotated = eligible_patients.annotate(
-            median_hba1c=Subquery(
-                valid_hba1c_subquery.annotate(median_hba1c=Median("hba1c")).values(
-                    "median_hba1c"
-                )[:1]
-            )
-        )
-
-        # Calculate the mean of the medians and convert to float (as Decimal)
-        mean_of_median_hba1cs = (
-            eligible_pts_annotated.aggregate(
-                mean_of_median_hba1cs=Avg("median_hba1c")
-            ).get("mean_of_median_hba1cs")
-            or 0
+        # Calculate the median of the medians (0 if no patient has a valid HbA1c)
+        median_of_median_hba1cs = (
+            float(np.median(median_hba1cs)) if median_hba1cs.size else 0
         )
 
         # Also set pt querysets to be returned if required
@@ -3162,7 +3676,7 @@ class CalculateKPIS:
             total_eligible=total_eligible,
             total_ineligible=total_ineligible,
             # Use passed for storing the value
-            total_passed=mean_of_median_hba1cs,
+            total_passed=median_of_median_hba1cs,
             # Failed is not used
             total_failed=-1,
             patient_querysets=patient_querysets,
@@ -3415,6 +3929,40 @@ class CalculateKPIS:
 
         logger.debug(f"====================")
 
+    def _materialise_cohort(
+        self,
+        eligible_patients: QuerySet[Patient],
+        visit_filter: Optional[Q] = None,
+    ) -> Tuple[QuerySet[Patient], int]:
+        """Evaluates a base cohort (KPIs 1, 2, 5, 6, 7 and the KPI 41-43
+        denominator) once, in the same single query that would count it.
+
+        The dependent KPIs each re-filter their base cohort, so would
+        otherwise each re-run its joins, DISTINCT and subqueries. Instead they
+        filter on the fetched pks.
+
+        `visit_filter` is the filter on `visit__` fields the cohort was built
+        with. It is kept, as dependent KPIs annotating `Count("visit")` only
+        count the visits joined by it (e.g. KPI 33 only counts visits within
+        the audit period, as KPI 1 filters on the visit date).
+
+        Returns:
+            QuerySet: the cohort's patients, by pk
+            int: the number of patients in the cohort
+        """
+
+        patient_pks = to_patient_ids(
+            eligible_patients.order_by().values_list("pk", flat=True)
+        )
+        # Postgres plans the pk list as pk = ANY(array), a lookup on the pk
+        # index (which it doesn't always do for IN (SELECT unnest(array)))
+        materialised_patients = Patient.objects.filter(pk__in=patient_pks.tolist())
+        if visit_filter is not None:
+            materialised_patients = materialised_patients.filter(visit_filter)
+
+        # the reason for distinct is same as KPI1 (see comments)
+        return materialised_patients.distinct(), len(patient_pks)
+
     def _get_total_kpi_1_eligible_pts_base_query_set_and_total_count(
         self,
     ) -> Tuple[QuerySet[Patient], int]:
@@ -3437,6 +3985,42 @@ class CalculateKPIS:
             self.kpi_1_total_eligible,
         )
 
+    def _get_kpi_1_eligible_pts_median_hba1cs(self) -> np.ndarray:
+        """Median HbA1c of each KPI 1 eligible patient, for KPIs 44 and 45
+
+        Only measurements (item 17) within the audit period, excluding those
+        taken within 90 days of diagnosis, are used. Patients without any are
+        left out.
+
+        All of the medians come from a single GROUP BY query (rather than a
+        correlated subquery per patient), and are computed once and reused by
+        both KPIs. `_calculate_kpis` clears them before each calculation.
+
+        Returns:
+            np.ndarray: one median HbA1c per patient (unordered)
+        """
+
+        if not hasattr(self, "kpi_1_eligible_pts_median_hba1cs"):
+            eligible_patients, _ = (
+                self._get_total_kpi_1_eligible_pts_base_query_set_and_total_count()
+            )
+            self.kpi_1_eligible_pts_median_hba1cs = np.fromiter(
+                Visit.objects.filter(
+                    patient__in=eligible_patients.order_by().values("pk"),
+                    visit_date__range=self.AUDIT_DATE_RANGE,
+                    # Ensure HbA1c is taken >90 days after diagnosis
+                    hba1c_date__gte=F("patient__diagnosis_date") + timedelta(days=90),
+                    hba1c__isnull=False,
+                )
+                .values("patient")
+                .annotate(median_hba1c=Median("hba1c"))
+                .order_by()
+                .values_list("median_hba1c", flat=True),
+                dtype=float,
+            )
+
+        return self.kpi_1_eligible_pts_median_hba1cs
+
     def _get_total_kpi_2_eligible_pts_base_query_set_and_total_count(
         self,
     ) -> Tuple[QuerySet[Patient], int]:
@@ -3473,7 +4057,7 @@ class CalculateKPIS:
             int: base query set count of total eligible patients for KPI 5
         """
 
-        if not hasattr(self, "total_kpi_1_eligible_pts_base_query_set"):
+        if not hasattr(self, "total_kpi_5_eligible_pts_base_query_set"):
             self.calculate_kpi_5_total_t1dm_complete_year()
 
         return (
@@ -3495,7 +4079,7 @@ class CalculateKPIS:
             int: base query set count of total eligible patients for KPI 6
         """
 
-        if not hasattr(self, "total_kpi_1_eligible_pts_base_query_set"):
+        if not hasattr(self, "total_kpi_6_eligible_pts_base_query_set"):
             self.calculate_kpi_6_total_t1dm_complete_year_gte_12yo()
 
         return (
@@ -3517,7 +4101,7 @@ class CalculateKPIS:
             int: base query set count of total eligible patients for KPI 7
         """
 
-        if not hasattr(self, "total_kpi_1_eligible_pts_base_query_set"):
+        if not hasattr(self, "total_kpi_7_eligible_pts_base_query_set"):
             self.calculate_kpi_7_total_new_diagnoses_t1dm()
 
         return (
@@ -3553,11 +4137,15 @@ class CalculateKPIS:
         )
 
         # Filter for those diagnoses at least 90 days before audit end date
-        self.t1dm_pts_diagnosed_90D_before_end_base_query_set = base_query_set.filter(
-            diagnosis_date__lt=self.audit_end_date - relativedelta(days=90),
-        )
-        self.t1dm_pts_diagnosed_90D_before_end_total_eligible = (
-            self.t1dm_pts_diagnosed_90D_before_end_base_query_set.count()
+        (
+            self.t1dm_pts_diagnosed_90D_before_end_base_query_set,
+            self.t1dm_pts_diagnosed_90D_before_end_total_eligible,
+        ) = self._materialise_cohort(
+            base_query_set.filter(
+                diagnosis_date__lt=self.audit_end_date - relativedelta(days=90),
+            ),
+            # As KPI 7
+            visit_filter=self.kpi_7_observation_visit_filter,
         )
 
         return (
@@ -3566,22 +4154,20 @@ class CalculateKPIS:
         )
 
 
-# Custom Median function for PostgreSQL
-class Median(Func):
-    function = "percentile_cont"
-    template = "%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)"
-
-
 def queryset_median_value(queryset: QuerySet, column_name: str):
     """Calculates the median value of a given column_name:str in a queryset
 
     Median is not a SQL aggregate function so we have to calculate it manually
+    (for per group medians in SQL, use the `Median` aggregate)
 
     Thanks https://stackoverflow.com/questions/942620/missing-median-aggregate-function-in-django.
     """
     count = queryset.count()
+    if count == 0:
+        return None
     values = queryset.values_list(column_name, flat=True).order_by(column_name)
+    middle = count // 2
     if count % 2 == 1:
-        return values[int(round(count / 2))]
+        return values[middle]
     else:
-        return sum(values[count / 2 - 1 : count / 2 + 1]) / Decimal(2.0)
+        return sum(values[middle - 1 : middle + 1]) / Decimal(2.0)
@@ -0,0 +1,49 @@
+"""Compact patient id sets for KPIResult.patient_ids.
+
+Each KPI's eligible / ineligible / passed / failed patients are held as
+sorted numpy arrays of patient pks, rather than as querysets which would each
+be re-evaluated whenever they are used (e.g. for every tooltip in
+`kpi_table.html`). Only eligible and passed need to come from an engine, the
+rest is set algebra in memory.
+"""
+
+# Python imports
+from typing import Iterable
+
+# Third party imports
+import numpy as np
+
+# NPDA Imports
+from project.npda.kpi_class.dataframe_engine import COUNT_ONLY_KPI_NUMBERS
+
+
+def to_patient_ids(patient_pks: Iterable[int]) -> np.ndarray:
+    """Sorted, unique array of patient pks"""
+    return np.unique(np.fromiter(patient_pks, dtype=np.int64))
+
+
+def get_patient_ids_object(
+    kpi_number: int,
+    cohort_ids: np.ndarray,
+    eligible_ids: np.ndarray,
+    passed_ids: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """Builds the eligible, ineligible, passed and failed patient id arrays
+    for a KPI from sorted arrays of the whole cohort, eligible and passed.
+
+    Matches `CalculateKPIS._get_pt_querysets_object`:
+        - ineligible is the cohort less eligible
+        - failed is eligible less passed, except for the count-only KPIs
+        (1 - 12) where it is the same as passed
+    """
+
+    return {
+        "eligible": eligible_ids,
+        "ineligible": np.setdiff1d(cohort_ids, eligible_ids, assume_unique=True),
+        "passed": passed_ids,
+        "failed": (
+            passed_ids
+            if kpi_number in COUNT_ONLY_KPI_NUMBERS
+            else np.setdiff1d(eligible_ids, passed_ids, assume_unique=True)
+        ),
+    }
@@ -0,0 +1,619 @@
+"""Persisted per-patient KPI statuses (the `PatientKPIStatus` table).
+
+Each patient's eligible / passed status for every KPI is stored per audit
+period, and recomputed only for a patient whose Visit, Transfer or Patient
+records change (see the receivers in `project.npda.signals`). Aggregate KPI
+results for a cohort are then a GROUP BY over the table, used by
+`CalculateKPIS(engine="stored")`.
+
+Per-patient statuses are evaluated with the `DataFrameKPIEngine`, so follow
+exactly the same rules as the other engines.
+
+For a single PDU, the statuses are also kept as running totals
+(`PDUKPICount`): recomputing a patient's statuses adds the difference between
+their old and new statuses to the counts of each of their PDUs, so e.g. a
+visit edit doesn't mean aggregating every patient in the PDU again.
+"""
+
+# Python imports
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+# Django imports
+from django.db import transaction
+from django.db.models import Avg, Count, Q, QuerySet, Subquery, Sum
+
+# NPDA Imports
+from project.constants.types.kpi_types import KPIResult
+from project.npda.general_functions.audit_period import get_audit_period_for_date
+from project.npda.kpi_class.aggregates import Median
+from project.npda.kpi_class.dataframe_engine import (
+    COUNT_ONLY_KPI_NUMBERS,
+    KPI_NUMBERS,
+    DataFrameKPIEngine,
+)
+from project.npda.kpi_class.kpi_cache import (
+    invalidate_cached_kpi_results,
+    invalidate_cached_kpi_results_for_patients,
+)
+from project.npda.kpi_class.patient_ids import get_patient_ids_object, to_patient_ids
+from project.npda.models import Patient, PatientKPIStatus, PDUKPICount, Transfer
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
+
+# Logging
+logger = logging.getLogger(__name__)
+
+# Number of patients evaluated per DataFrameKPIEngine run when rebuilding
+PATIENT_BATCH_SIZE = 2_000
+
+# Used to collect changed patients and PDUs while updates are deferred
+_deferred = threading.local()
+
+# A mean or median of the patients' median HbA1c can't be updated from the
+# change to one patient, so these are aggregated from the stored statuses on
+# every calculation rather than counted
+RECOMPUTED_KPI_NUMBERS = [44, 45]
+COUNTED_KPI_NUMBERS = [
+    kpi_number for kpi_number in KPI_NUMBERS if kpi_number not in RECOMPUTED_KPI_NUMBERS
+]
+
+
+def calculate_patient_kpi_statuses(
+    patients: QuerySet[Patient],
+    audit_start_date: date,
+    audit_end_date: date,
+) -> list[PatientKPIStatus]:
+    """Returns (unsaved) PatientKPIStatus rows for every patient / KPI."""
+
+    engine = DataFrameKPIEngine(audit_start_date, audit_end_date)
+    engine.load(patients)
+
+    values = {
+        321: engine.completed_health_checks,
+        44: engine.median_hba1c,
+        45: engine.median_hba1c,
+    }
+
+    kpi_statuses = []
+    for kpi_number in KPI_NUMBERS:
+        for patient_pk, eligible, passed in zip(
+            engine.patients_df.index,
+            engine.eligible[kpi_number],
+            engine.passed[kpi_number],
+        ):
+            value = (
+                values[kpi_number][patient_pk] if kpi_number in values else None
+            )
+            kpi_statuses.append(
+                PatientKPIStatus(
+                    patient_id=int(patient_pk),
+                    audit_start_date=audit_start_date,
+                    audit_end_date=audit_end_date,
+                    kpi_number=kpi_number,
+                    eligible=bool(eligible),
+                    passed=bool(passed),
+                    value=None if pd.isna(value) else Decimal(f"{value:.3f}"),
+                )
+            )
+
+    return kpi_statuses
+
+
+def update_patient_kpi_statuses(
+    patient_pks: Iterable[int],
+    audit_periods: Optional[Iterable[tuple[date, date]]] = None,
+) -> None:
+    """Recomputes the stored KPI statuses for the given patients.
+
+    If `audit_periods` is not given, updates every audit period already
+    stored for those patients, plus the current audit period.
+    """
+
+    patient_pks = list(set(patient_pks))
+    if not patient_pks:
+        return
+
+    if audit_periods is None:
+        audit_periods = set(
+            PatientKPIStatus.objects.filter(patient_id__in=patient_pks)
+            .values_list("audit_start_date", "audit_end_date")
+            .distinct()
+        )
+        try:
+            audit_periods.add(get_audit_period_for_date(date.today()))
+        except ValueError:
+            logger.warning(
+                f"No audit period for {date.today()}, only updating existing KPI statuses"
+            )
+
+    for batch_start in range(0, len(patient_pks), PATIENT_BATCH_SIZE):
+        batch_pks = patient_pks[batch_start : batch_start + PATIENT_BATCH_SIZE]
+
+        for audit_start_date, audit_end_date in audit_periods:
+            with transaction.atomic():
+                # Locked before their records are read, so of two concurrent
+                # updates for a patient the later one waits and calculates
+                # from the latest records, rather than overwriting them with
+                # statuses calculated from older ones
+                _lock_patients(batch_pks)
+                patient_pz_codes, pdu_kpi_counts = _lock_pdu_kpi_counts(
+                    batch_pks, audit_start_date
+                )
+
+                kpi_statuses = calculate_patient_kpi_statuses(
+                    # Deleted patients are dropped here, their statuses cascade
+                    Patient.objects.filter(pk__in=batch_pks),
+                    audit_start_date,
+                    audit_end_date,
+                )
+
+                previous_statuses = (
+                    list(
+                        PatientKPIStatus.objects.filter(
+                            patient_id__in=batch_pks,
+                            audit_start_date=audit_start_date,
+                            kpi_number__in=COUNTED_KPI_NUMBERS,
+                            eligible=True,
+                        ).values_list("patient_id", "kpi_number", "passed", "value")
+                    )
+                    if pdu_kpi_counts
+                    else []
+                )
+
+                PatientKPIStatus.objects.filter(
+                    patient_id__in=batch_pks, audit_start_date=audit_start_date
+                ).delete()
+                PatientKPIStatus.objects.bulk_create(kpi_statuses, batch_size=5_000)
+
+                if pdu_kpi_counts:
+                    _apply_pdu_kpi_count_deltas(
+                        pdu_kpi_counts,
+                        patient_pz_codes,
+                        previous_statuses,
+                        [
+                            (
+                                kpi_status.patient_id,
+                                kpi_status.kpi_number,
+                                kpi_status.passed,
+                                kpi_status.value,
+                            )
+                            for kpi_status in kpi_statuses
+                            if kpi_status.eligible
+                            and kpi_status.kpi_number in COUNTED_KPI_NUMBERS
+                        ],
+                    )
+
+
+def _lock_patients(patient_pks: Iterable[int]) -> None:
+    """Row locks the patients (in pk order, so concurrent updates can't
+    deadlock) until the end of the transaction. Taken before their PDUs'."""
+
+    list(
+        Patient.objects.select_for_update()
+        .filter(pk__in=patient_pks)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def _lock_pdus(pz_codes: Iterable[str]) -> list[int]:
+    """Row locks the PDUs (in pk order, so concurrent updates can't
+    deadlock) until the end of the transaction. Serialises updating,
+    building and dropping their PDUKPICounts. Returns the locked pks."""
+
+    return list(
+        PaediatricDiabetesUnit.objects.select_for_update()
+        .filter(pz_code__in=set(pz_codes))
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def _lock_pdu_kpi_counts(
+    patient_pks: list[int], audit_start_date: date
+) -> tuple[dict[int, set[str]], dict[tuple[str, int], PDUKPICount]]:
+    """Locks the PDUs of the patients. Returns the PZ codes of each patient
+    and the PDUKPICounts of those PDUs (keyed by pz_code, kpi_number), for
+    any PDUs which have them."""
+
+    patient_pz_codes = {}
+    for patient_pk, pz_code in (
+        Transfer.objects.filter(patient_id__in=patient_pks)
+        .values_list("patient_id", "paediatric_diabetes_unit__pz_code")
+        .distinct()
+    ):
+        patient_pz_codes.setdefault(patient_pk, set()).add(pz_code)
+
+    pz_codes = set().union(*patient_pz_codes.values())
+    _lock_pdus(pz_codes)
+
+    pdu_kpi_counts = {
+        (pdu_kpi_count.pz_code, pdu_kpi_count.kpi_number): pdu_kpi_count
+        for pdu_kpi_count in PDUKPICount.objects.filter(
+            pz_code__in=pz_codes, audit_start_date=audit_start_date
+        )
+    }
+
+    return patient_pz_codes, pdu_kpi_counts
+
+
+def _apply_pdu_kpi_count_deltas(
+    pdu_kpi_counts: dict[tuple[str, int], PDUKPICount],
+    patient_pz_codes: dict[int, set[str]],
+    previous_statuses: list[tuple],
+    statuses: list[tuple],
+) -> None:
+    """Subtracts the patients' previous eligible statuses from their PDUs'
+    counts and adds their new ones. Statuses are (patient_id, kpi_number,
+    passed, value) tuples."""
+
+    for sign, eligible_statuses in ((-1, previous_statuses), (1, statuses)):
+        for patient_pk, kpi_number, passed, value in eligible_statuses:
+            for pz_code in patient_pz_codes.get(patient_pk, ()):
+                pdu_kpi_count = pdu_kpi_counts.get((pz_code, kpi_number))
+                if pdu_kpi_count is None:
+                    continue
+                pdu_kpi_count.total_eligible += sign
+                pdu_kpi_count.total_passed += sign * passed
+                if value is not None:
+                    pdu_kpi_count.value_sum += sign * value
+
+    PDUKPICount.objects.bulk_update(
+        pdu_kpi_counts.values(), ["total_eligible", "total_passed", "value_sum"]
+    )
+
+
+def get_pdu_kpi_counts(
+    pz_code: str,
+    audit_start_date: date,
+    audit_end_date: date,
+) -> Optional[dict[int, PDUKPICount]]:
+    """Returns the PDU's counts for each of COUNTED_KPI_NUMBERS, first
+    building them from the stored statuses of its patients if they haven't
+    been (or have been dropped). Every patient in the PDU must already have
+    stored statuses for the audit period.
+
+    Returns None if there is no PDU with the PZ code."""
+
+    with transaction.atomic():
+        if not _lock_pdus([pz_code]):
+            return None
+
+        pdu_kpi_counts = {
+            pdu_kpi_count.kpi_number: pdu_kpi_count
+            for pdu_kpi_count in PDUKPICount.objects.filter(
+                pz_code=pz_code, audit_start_date=audit_start_date
+            )
+        }
+        if pdu_kpi_counts:
+            return pdu_kpi_counts
+
+        eligible = Q(eligible=True)
+        aggregated_statuses = {
+            row["kpi_number"]: row
+            for row in PatientKPIStatus.objects.filter(
+                patient__in=Patient.objects.filter(
+                    paediatric_diabetes_units__paediatric_diabetes_unit__pz_code=pz_code
+                ),
+                audit_start_date=audit_start_date,
+                kpi_number__in=COUNTED_KPI_NUMBERS,
+            )
+            .values("kpi_number")
+            .annotate(
+                total_eligible=Count("pk", filter=eligible),
+                total_passed=Count("pk", filter=eligible & Q(passed=True)),
+                value_sum=Sum("value", filter=eligible),
+            )
+            .order_by()
+        }
+
+        for kpi_number in COUNTED_KPI_NUMBERS:
+            aggregated = aggregated_statuses.get(kpi_number, {})
+            pdu_kpi_counts[kpi_number] = PDUKPICount(
+                pz_code=pz_code,
+                audit_start_date=audit_start_date,
+                audit_end_date=audit_end_date,
+                kpi_number=kpi_number,
+                total_eligible=aggregated.get("total_eligible", 0),
+                total_passed=aggregated.get("total_passed", 0),
+                value_sum=aggregated.get("value_sum") or 0,
+            )
+        PDUKPICount.objects.bulk_create(pdu_kpi_counts.values())
+
+    return pdu_kpi_counts
+
+
+def drop_pdu_kpi_counts(
+    pz_codes: Iterable[str], audit_start_date: Optional[date] = None
+) -> None:
+    """Drops the PDUs' counts (for every audit period, unless
+    `audit_start_date` is given). They are rebuilt from the stored statuses
+    when next needed.
+
+    Needed whenever the counts would no longer match the statuses of the
+    PDU's patients other than by a patient's statuses being recomputed, e.g.
+    a patient joining or leaving the PDU."""
+
+    pz_codes = set(pz_codes)
+    with transaction.atomic():
+        _lock_pdus(pz_codes)
+
+        pdu_kpi_counts = PDUKPICount.objects.filter(pz_code__in=pz_codes)
+        if audit_start_date is not None:
+            pdu_kpi_counts = pdu_kpi_counts.filter(audit_start_date=audit_start_date)
+        pdu_kpi_counts.delete()
+
+
+def _records_changed(
+    patient_pks: Iterable[int], pdu_pks: Iterable[int], pz_codes: Iterable[str]
+) -> None:
+    """Drops the changed PDUs' counts, recomputes the changed patients'
+    statuses, then invalidates cached KPI results for all of their PDUs."""
+
+    patient_pks = set(patient_pks)
+    pz_codes = set(pz_codes)
+    if pdu_pks:
+        pz_codes.update(
+            PaediatricDiabetesUnit.objects.filter(pk__in=set(pdu_pks)).values_list(
+                "pz_code", flat=True
+            )
+        )
+
+    # Dropped first, so they aren't updated only to be rebuilt
+    if pz_codes:
+        drop_pdu_kpi_counts(pz_codes)
+
+    # Statuses before the cache, so cached KPI results can't be rebuilt from
+    # stale ones
+    update_patient_kpi_statuses(patient_pks)
+    invalidate_cached_kpi_results(pz_codes)
+    invalidate_cached_kpi_results_for_patients(patient_pks)
+
+
+def _schedule(
+    patient_pks: Iterable[int] = (),
+    pdu_pks: Iterable[int] = (),
+    pz_codes: Iterable[str] = (),
+) -> None:
+    deferred = getattr(_deferred, "changes", None)
+    if deferred is not None:
+        deferred["patient_pks"].update(patient_pks)
+        deferred["pdu_pks"].update(pdu_pks)
+        deferred["pz_codes"].update(pz_codes)
+        return
+
+    patient_pks, pdu_pks, pz_codes = list(patient_pks), list(pdu_pks), list(pz_codes)
+    transaction.on_commit(lambda: _records_changed(patient_pks, pdu_pks, pz_codes))
+
+
+def schedule_patient_kpi_status_update(patient_pk: int) -> None:
+    """Recomputes a patient's KPI statuses, and invalidates cached KPI results
+    for their PDU(s), once the current transaction commits (immediately in
+    autocommit mode).
+
+    Inside `deferred_patient_kpi_status_updates()` the patient is only
+    recorded, and updated with the rest of the batch at the end.
+    """
+
+    _schedule(patient_pks=[patient_pk])
+
+
+def schedule_pdu_kpi_counts_drop(
+    pdu_pks: Iterable[int] = (), pz_codes: Iterable[str] = ()
+) -> None:
+    """Drops the running KPI counts of the PDUs (by pk or PZ code), and
+    invalidates their cached KPI results, once the current transaction
+    commits. Needed when a patient joins or leaves them.
+
+    Deferred like `schedule_patient_kpi_status_update`.
+    """
+
+    _schedule(pdu_pks=pdu_pks, pz_codes=pz_codes)
+
+
+@contextmanager
+def deferred_patient_kpi_status_updates():
+    """Batches KPI status updates (and PDU count drops) for everything touched
+    within the block (e.g. a csv upload, or deleting patients, which cascades
+    to each of their visits and transfers), rather than recomputing for every
+    single row."""
+
+    if getattr(_deferred, "changes", None) is not None:
+        # Already deferring, the outermost block does the update
+        yield
+        return
+
+    _deferred.changes = {"patient_pks": set(), "pdu_pks": set(), "pz_codes": set()}
+    try:
+        yield
+    finally:
+        changes = _deferred.changes
+        _deferred.changes = None
+
+        if any(changes.values()):
+            transaction.on_commit(
+                lambda: _records_changed(
+                    changes["patient_pks"], changes["pdu_pks"], changes["pz_codes"]
+                )
+            )
+
+
+class StoredKPIResults:
+    """
+    Aggregates stored PatientKPIStatus rows into KPIResults for a cohort.
+
+    Any patients in the cohort without stored statuses for the audit period
+    are calculated first, so results are always complete.
+
+    If the cohort is all of a single PDU's patients (`pz_code`), its
+    PDUKPICounts are read rather than aggregating every patient's statuses,
+    bar KPIs 44 and 45.
+    """
+
+    def __init__(
+        self,
+        patients: QuerySet[Patient],
+        audit_start_date: date,
+        audit_end_date: date,
+        pz_code: Optional[str] = None,
+    ):
+        self.audit_start_date = audit_start_date
+        self.audit_end_date = audit_end_date
+        self.pz_code = pz_code
+
+        self.cohort = Patient.objects.filter(
+            pk__in=Subquery(patients.order_by().values("pk"))
+        )
+
+        missing_patient_pks = list(
+            self.cohort.exclude(
+                kpi_statuses__audit_start_date=audit_start_date
+            ).values_list("pk", flat=True)
+        )
+        if missing_patient_pks:
+            update_patient_kpi_statuses(
+                missing_patient_pks,
+                audit_periods=[(audit_start_date, audit_end_date)],
+            )
+
+    def calculate_kpi_results(self, total_patients_count: int) -> dict[int, KPIResult]:
+        """Builds a KPIResult for every KPI from a single GROUP BY query (or,
+        for a single PDU, its counts and a GROUP BY of KPIs 44 and 45).
+        `patient_querysets` are left as None."""
+
+        pdu_kpi_counts = (
+            get_pdu_kpi_counts(self.pz_code, self.audit_start_date, self.audit_end_date)
+            if self.pz_code is not None
+            else None
+        )
+
+        if pdu_kpi_counts is None:
+            aggregated_statuses = self._aggregate_statuses(KPI_NUMBERS)
+        else:
+            aggregated_statuses = self._aggregate_statuses(RECOMPUTED_KPI_NUMBERS)
+            for kpi_number, pdu_kpi_count in pdu_kpi_counts.items():
+                aggregated_statuses[kpi_number] = {
+                    "total_eligible": pdu_kpi_count.total_eligible,
+                    "total_passed": pdu_kpi_count.total_passed,
+                    "value_sum": pdu_kpi_count.value_sum,
+                }
+
+        def aggregated(kpi_number: int, key: str):
+            return aggregated_statuses.get(kpi_number, {}).get(key) or 0
+
+        kpi_results = {}
+        for kpi_number in KPI_NUMBERS:
+            total_eligible = aggregated(kpi_number, "total_eligible")
+            total_ineligible = total_patients_count - total_eligible
+
+            if kpi_number in COUNT_ONLY_KPI_NUMBERS:
+                total_passed = None
+                total_failed = None
+            elif kpi_number == 321:
+                # Health checks rather than patients (see KPI 32.1 docstring)
+                total_ineligible = total_patients_count - aggregated(
+                    5, "total_eligible"
+                )
+                total_eligible = 3 * aggregated(322, "total_eligible") + 6 * aggregated(
+                    323, "total_eligible"
+                )
+                total_passed = int(aggregated(321, "value_sum"))
+                total_failed = total_eligible - total_passed
+            elif kpi_number == 44:
+                # Mean of each eligible patient's median HbA1c
+                total_passed = float(aggregated(kpi_number, "value_avg"))
+                total_failed = -1
+            elif kpi_number == 45:
+                # Median of each eligible patient's median HbA1c
+                total_passed = float(aggregated(kpi_number, "value_median"))
+                total_failed = -1
+            else:
+                total_passed = aggregated(kpi_number, "total_passed")
+                total_failed = total_eligible - total_passed
+
+            kpi_results[kpi_number] = KPIResult(
+                total_eligible=total_eligible,
+                total_ineligible=total_ineligible,
+                total_passed=total_passed,
+                total_failed=total_failed,
+            )
+
+        return kpi_results
+
+    def _aggregate_statuses(self, kpi_numbers: list[int]) -> dict[int, dict]:
+        """Totals and values of the cohort's stored statuses, by KPI"""
+
+        eligible = Q(eligible=True)
+        return {
+            row["kpi_number"]: row
+            for row in PatientKPIStatus.objects.filter(
+                patient__in=self.cohort,
+                audit_start_date=self.audit_start_date,
+                kpi_number__in=kpi_numbers,
+            )
+            .values("kpi_number")
+            .annotate(
+                total_eligible=Count("pk", filter=eligible),
+                total_passed=Count("pk", filter=eligible & Q(passed=True)),
+                value_sum=Sum("value", filter=eligible),
+                value_avg=Avg("value", filter=eligible),
+                value_median=Median("value", filter=eligible),
+            )
+            .order_by()
+        }
+
+    def get_patient_ids(self) -> dict[int, dict[str, np.ndarray]]:
+        """Returns the eligible, ineligible, passed and failed patient ids for
+        every KPI from a single query, matching the patient querysets
+        returned by the `calculate_kpi_*` methods."""
+
+        statuses = pd.DataFrame.from_records(
+            list(
+                PatientKPIStatus.objects.filter(
+                    patient__in=self.cohort,
+                    audit_start_date=self.audit_start_date,
+                    eligible=True,
+                ).values_list("kpi_number", "patient_id", "passed")
+            ),
+            columns=["kpi_number", "patient_id", "passed"],
+        )
+        cohort_ids = to_patient_ids(self.cohort.values_list("pk", flat=True))
+
+        def eligible_ids(kpi_number: int, passed_only: bool = False) -> np.ndarray:
+            mask = statuses["kpi_number"] == kpi_number
+            if passed_only:
+                mask &= statuses["passed"]
+            return to_patient_ids(statuses.loc[mask, "patient_id"])
+
+        patient_ids = {}
+        for kpi_number in KPI_NUMBERS:
+            eligible = eligible_ids(kpi_number)
+
+            if kpi_number == 2:
+                # KPI 2 returns the KPI 1 cohort as passed / failed
+                passed = eligible_ids(1)
+            elif kpi_number in COUNT_ONLY_KPI_NUMBERS:
+                passed = eligible
+            elif kpi_number == 321:
+                # Passed for 32.1 is the < 12yo cohort (as per the SQL querysets)
+                passed = eligible_ids(322)
+            elif kpi_number in [322, 323, 44, 45]:
+                passed = eligible
+            else:
+                passed = eligible_ids(kpi_number, passed_only=True)
+
+            patient_ids[kpi_number] = get_patient_ids_object(
+                kpi_number=kpi_number,
+                cohort_ids=cohort_ids,
+                eligible_ids=eligible,
+                passed_ids=passed,
+            )
+
+        return patient_ids
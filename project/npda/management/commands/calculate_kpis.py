@@ -0,0 +1,374 @@
+# python
+import csv
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from typing import Optional
+
+import django
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+
+# RCPCH
+from project.npda.general_functions.audit_period import get_audit_period_for_date
+from project.npda.kpi_class.kpi_export import KPI_EXPORT_FORMATS, write_kpi_export
+from project.npda.kpi_class.kpi_profiler import (
+    KPIProfile,
+    format_kpi_profile,
+    merge_kpi_profiles,
+)
+from project.npda.kpi_class.kpi_snapshots import save_kpi_snapshots
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+CSV_FIELDS = [
+    "pz_code",
+    "kpi_name",
+    "kpi_label",
+    "total_eligible",
+    "total_ineligible",
+    "total_passed",
+    "total_failed",
+]
+
+
+class CheckpointEncoder(DjangoJSONEncoder):
+    # Patient ids are numpy arrays
+    def default(self, o):
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        return super().default(o)
+
+
+def _init_worker():
+    # Each worker process must open its own database connection
+    django.setup()
+    connections.close_all()
+
+
+def calculate_kpis_for_pz_codes(
+    pz_codes: list[str],
+    calculation_date: date,
+    checkpoint_dir: str,
+    engine: Optional[str] = None,
+    profile: bool = False,
+    snapshot: bool = False,
+    return_pt_querysets: bool = False,
+) -> tuple[list[str], dict[str, KPIProfile]]:
+    """Calculates KPIs for a chunk of PDUs and checkpoints each PDU's results
+    to `checkpoint_dir/<pz_code>.json`. With `snapshot`, the results are also
+    saved as KPISnapshots. With `return_pt_querysets`, each KPI's patient ids
+    are checkpointed too.
+
+    Without an `engine`, the chunk is calculated in a single pass with
+    `calculate_kpis_by_pdu`. Otherwise each PDU is calculated separately
+    with that engine.
+
+    Returns the PZ codes calculated and, if profiling, the chunk's profile.
+    """
+
+    if engine is None:
+        kpi_calculator = CalculateKPIS(
+            calculation_date=calculation_date,
+            return_pt_querysets=return_pt_querysets,
+            profile=profile,
+        )
+        kpi_calculations_by_pdu = kpi_calculator.calculate_kpis_by_pdu(
+            pz_codes=pz_codes
+        )
+        profiles = [kpi_calculator.profiler.steps] if profile else []
+    else:
+        kpi_calculations_by_pdu = {}
+        profiles = []
+        for pz_code in pz_codes:
+            kpi_calculations = CalculateKPIS(
+                calculation_date=calculation_date,
+                return_pt_querysets=return_pt_querysets,
+                engine=engine,
+                profile=profile,
+            ).calculate_kpis_for_pdus([pz_code])
+            if profile:
+                profiles.append(kpi_calculations.pop("profile"))
+            kpi_calculations_by_pdu[pz_code] = kpi_calculations
+
+    # Before checkpointing, so a resumed run snapshots any PDU missed here
+    if snapshot:
+        save_kpi_snapshots(kpi_calculations_by_pdu)
+
+    for pz_code, kpi_calculations in kpi_calculations_by_pdu.items():
+        checkpoint_path = os.path.join(checkpoint_dir, f"{pz_code}.json")
+        # Write then rename so an interrupted run never leaves a partial file
+        with open(f"{checkpoint_path}.tmp", "w") as checkpoint_file:
+            json.dump(kpi_calculations, checkpoint_file, cls=CheckpointEncoder)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+    return list(kpi_calculations_by_pdu), merge_kpi_profiles(profiles)
+
+
+class Command(BaseCommand):
+    help = (
+        "Calculates KPIs for each PDU across a pool of worker processes, "
+        "checkpointing completed PDUs so an interrupted run can resume."
+    )
+
+    def add_arguments(self, parser):
+        pdus = parser.add_mutually_exclusive_group(required=True)
+        pdus.add_argument(
+            "--all-pdus",
+            action="store_true",
+            help="Calculate KPIs for every PDU.",
+        )
+        pdus.add_argument(
+            "-p",
+            "--pz-codes",
+            nargs="+",
+            help="PZ codes of the PDUs to calculate KPIs for.",
+        )
+        parser.add_argument(
+            "-d",
+            "--date",
+            type=date.fromisoformat,
+            default=None,
+            help="Any date within the audit period (YYYY-MM-DD). Defaults to today.",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes. 1 runs in this process.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10,
+            help="Number of PDUs calculated together by a worker.",
+        )
+        parser.add_argument(
+            "-o",
+            "--output-dir",
+            default="kpi_results",
+            help="Directory for checkpoints and results.",
+        )
+        parser.add_argument(
+            "-f",
+            "--format",
+            choices=["json", "csv", *KPI_EXPORT_FORMATS],
+            nargs="+",
+            default=["json", "csv"],
+            help=(
+                "Output format(s). parquet and arrow also write each KPI's "
+                "patients (patients.parquet / patients.arrow)."
+            ),
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore checkpoints from a previous run and recalculate every PDU.",
+        )
+        parser.add_argument(
+            "-e",
+            "--engine",
+            choices=CalculateKPIS.ENGINES,
+            default=None,
+            help=(
+                "Calculate each PDU separately with this CalculateKPIS engine. "
+                "By default, each chunk of PDUs is calculated in a single pass."
+            ),
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help=(
+                "Print the wall time, SQL statements and DB time of each KPI "
+                "calculation step (summed over PDUs), slowest first. Use with "
+                "--engine sql to profile each KPI method."
+            ),
+        )
+        parser.add_argument(
+            "--snapshot",
+            action="store_true",
+            help=(
+                "Also save each PDU's results as KPI snapshots, for "
+                "comparing KPIs across audit years and quarters."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        calculation_date = options["date"] or date.today()
+        workers = options["workers"]
+        chunk_size = options["chunk_size"]
+
+        if workers < 1 or chunk_size < 1:
+            raise CommandError("--workers and --chunk-size must be at least 1")
+
+        try:
+            audit_start_date, audit_end_date = get_audit_period_for_date(
+                calculation_date
+            )
+        except ValueError as error:
+            raise CommandError(error)
+
+        if options["all_pdus"]:
+            pz_codes = list(
+                PaediatricDiabetesUnit.objects.order_by("pz_code").values_list(
+                    "pz_code", flat=True
+                )
+            )
+        else:
+            pz_codes = sorted(set(options["pz_codes"]))
+
+        run_dir = os.path.join(
+            options["output_dir"], f"{audit_start_date}_{audit_end_date}"
+        )
+        checkpoint_dir = os.path.join(run_dir, "pdus")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # The options that change a PDU's checkpoint. Checkpoints are only
+        # resumed by a run with the same ones
+        manifest = {
+            "calculation_date": calculation_date.isoformat(),
+            "engine": options["engine"],
+            "snapshot": options["snapshot"],
+        }
+        manifest_path = os.path.join(run_dir, "manifest.json")
+
+        if options["restart"]:
+            for file_name in os.listdir(checkpoint_dir):
+                os.remove(os.path.join(checkpoint_dir, file_name))
+
+        completed_pz_codes = {
+            file_name.removesuffix(".json")
+            for file_name in os.listdir(checkpoint_dir)
+            if file_name.endswith(".json")
+        }
+
+        if completed_pz_codes:
+            previous_manifest = {}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as manifest_file:
+                    previous_manifest = json.load(manifest_file)
+
+            changed_options = [
+                name
+                for name, value in manifest.items()
+                if name not in previous_manifest or previous_manifest[name] != value
+            ]
+            if changed_options:
+                raise CommandError(
+                    f"{run_dir} has checkpoints from a run with different "
+                    f"{', '.join(changed_options)} (use --restart)"
+                )
+
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        remaining_pz_codes = [
+            pz_code for pz_code in pz_codes if pz_code not in completed_pz_codes
+        ]
+
+        self.stdout.write(
+            f"calculating KPIs for {audit_start_date} - {audit_end_date}: "
+            f"{len(remaining_pz_codes)} PDUs to calculate, "
+            f"{len(pz_codes) - len(remaining_pz_codes)} already checkpointed..."
+        )
+
+        chunks = [
+            remaining_pz_codes[i : i + chunk_size]
+            for i in range(0, len(remaining_pz_codes), chunk_size)
+        ]
+
+        calculate_options = {
+            "calculation_date": calculation_date,
+            "checkpoint_dir": checkpoint_dir,
+            "engine": options["engine"],
+            "profile": options["profile"],
+            "snapshot": options["snapshot"],
+            # Columnar exports include the patients of each KPI
+            "return_pt_querysets": any(
+                file_format in KPI_EXPORT_FORMATS for file_format in options["format"]
+            ),
+        }
+        profiles = []
+
+        if workers == 1:
+            for chunk in chunks:
+                _, profile = calculate_kpis_for_pz_codes(chunk, **calculate_options)
+                profiles.append(profile)
+                self.stdout.write(f"calculated {', '.join(chunk)}")
+        elif chunks:
+            # Connections can't be shared with forked processes
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        calculate_kpis_for_pz_codes, chunk, **calculate_options
+                    )
+                    for chunk in chunks
+                ]
+                for future in as_completed(futures):
+                    calculated_pz_codes, profile = future.result()
+                    profiles.append(profile)
+                    self.stdout.write(f"calculated {', '.join(calculated_pz_codes)}")
+
+        kpi_calculations_by_pdu = {}
+        for pz_code in pz_codes:
+            with open(os.path.join(checkpoint_dir, f"{pz_code}.json")) as checkpoint:
+                kpi_calculations_by_pdu[pz_code] = json.load(checkpoint)
+
+        if "json" in options["format"]:
+            json_path = os.path.join(run_dir, "kpis.json")
+            with open(json_path, "w") as json_file:
+                json.dump(kpi_calculations_by_pdu, json_file, indent=2)
+            self.stdout.write(f"written {json_path}")
+
+        if "csv" in options["format"]:
+            csv_path = os.path.join(run_dir, "kpis.csv")
+            with open(csv_path, "w", newline="") as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDS)
+                writer.writeheader()
+                for pz_code, kpi_calculations in kpi_calculations_by_pdu.items():
+                    for kpi_name, kpi_result in kpi_calculations[
+                        "calculated_kpi_values"
+                    ].items():
+                        writer.writerow(
+                            {
+                                "pz_code": pz_code,
+                                "kpi_name": kpi_name,
+                                **{
+                                    field: kpi_result[field]
+                                    for field in CSV_FIELDS[2:]
+                                },
+                            }
+                        )
+            self.stdout.write(f"written {csv_path}")
+
+        for file_format in KPI_EXPORT_FORMATS:
+            if file_format in options["format"]:
+                try:
+                    paths = write_kpi_export(
+                        kpi_calculations_by_pdu, run_dir, file_format=file_format
+                    )
+                except ValueError as error:
+                    # Checkpoints from a run without patient ids
+                    raise CommandError(f"{error} (use --restart)")
+                for path in paths:
+                    self.stdout.write(f"written {path}")
+
+        if options["profile"]:
+            self.stdout.write(
+                f"profile of {len(remaining_pz_codes)} calculated PDUs:\n"
+                + format_kpi_profile(merge_kpi_profiles(profiles))
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Calculated KPIs for {len(pz_codes)} PDUs.")
+        )
@@ -0,0 +1,143 @@
+# python
+import logging
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+# RCPCH
+from project.npda.general_functions.index_multiple_deprivation import (
+    cached_imd_for_postcode,
+)
+from project.npda.models import PostcodeDeprivation
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+# Postcode rows read and inserted at a time. The full postcode lookup has ~2.6m rows
+CHUNK_SIZE = 100_000
+
+
+class Command(BaseCommand):
+    help = (
+        "Replaces the local postcode deprivation table used by imd_for_postcode, "
+        "from the ONS postcode to LSOA lookup and the index of multiple deprivation by LSOA (both csv)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "postcodes_csv",
+            help="ONS postcode to LSOA lookup, e.g. PCD_OA_LSOA_MSOA_LAD.csv",
+        )
+        parser.add_argument(
+            "deprivation_csv",
+            help="Index of multiple deprivation by LSOA, e.g. the English Indices of Deprivation 2019 File 7",
+        )
+        parser.add_argument(
+            "--postcode-column",
+            default="pcds",
+            help="Postcode column of postcodes_csv. Defaults to pcds.",
+        )
+        parser.add_argument(
+            "--postcode-lsoa-column",
+            default="lsoa11cd",
+            help="LSOA code column of postcodes_csv. Defaults to lsoa11cd.",
+        )
+        parser.add_argument(
+            "--lsoa-column",
+            default="LSOA code (2011)",
+            help="LSOA code column of deprivation_csv. Defaults to 'LSOA code (2011)'.",
+        )
+        parser.add_argument(
+            "--decile-column",
+            default="Index of Multiple Deprivation (IMD) Decile (where 1 is most deprived 10% of LSOAs)",
+            help="IMD decile column of deprivation_csv (1 is the most deprived). Defaults to the File 7 heading.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            deprivation = read_columns(
+                options["deprivation_csv"],
+                [options["lsoa_column"], options["decile_column"]],
+            )
+        except ValueError as error:
+            raise CommandError(error)
+
+        deciles = pd.to_numeric(deprivation[options["decile_column"]])
+        # Deciles 1 and 2 are quintile 1, and so on
+        quintile_by_lsoa = dict(
+            zip(deprivation[options["lsoa_column"]], (deciles + 1) // 2)
+        )
+
+        self.stdout.write(
+            f"loading postcodes in {len(quintile_by_lsoa)} LSOAs from {options['postcodes_csv']}..."
+        )
+
+        loaded_count = 0
+        skipped_count = 0
+
+        with transaction.atomic():
+            PostcodeDeprivation.objects.all().delete()
+
+            try:
+                chunks = read_columns(
+                    options["postcodes_csv"],
+                    [options["postcode_column"], options["postcode_lsoa_column"]],
+                    chunksize=CHUNK_SIZE,
+                )
+
+                for chunk in chunks:
+                    postcodes = (
+                        chunk[options["postcode_column"]]
+                        .str.upper()
+                        .str.replace(r"[\s-]", "", regex=True)
+                    )
+                    lsoa_codes = chunk[options["postcode_lsoa_column"]]
+                    quintiles = lsoa_codes.map(quintile_by_lsoa)
+
+                    # Postcodes outside the indices (e.g. in another nation) are left
+                    # to the RCPCH Census Platform
+                    found = quintiles.notna() & postcodes.notna()
+                    skipped_count += int((~found).sum())
+
+                    PostcodeDeprivation.objects.bulk_create(
+                        [
+                            PostcodeDeprivation(
+                                postcode=postcode,
+                                lsoa_code=lsoa_code,
+                                imd_quintile=int(quintile),
+                            )
+                            for postcode, lsoa_code, quintile in zip(
+                                postcodes[found], lsoa_codes[found], quintiles[found]
+                            )
+                        ],
+                        batch_size=10_000,
+                    )
+                    loaded_count += int(found.sum())
+            except ValueError as error:
+                raise CommandError(error)
+
+        # Only this process's cache. Running web servers and upload workers keep
+        # the quintiles they've cached until restarted
+        cached_imd_for_postcode.cache_clear()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Loaded {loaded_count} postcodes ({skipped_count} not in the deprivation csv skipped)."
+            )
+        )
+
+
+def read_columns(path, columns, chunksize=None):
+    """
+    Reads the given columns of a published csv as text. They're often large and
+    not always utf-8, but the columns we need are
+    """
+    return pd.read_csv(
+        path,
+        usecols=columns,
+        dtype=str,
+        encoding="utf-8-sig",
+        encoding_errors="replace",
+        chunksize=chunksize,
+    )
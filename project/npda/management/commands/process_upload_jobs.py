@@ -0,0 +1,58 @@
+# python
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+# RCPCH
+from project.npda.general_functions.upload_jobs import (
+    claim_next_upload_job,
+    process_upload_job,
+)
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Processes queued csv uploads, polling the database for new ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process the jobs already queued, then exit.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5,
+            help="Seconds to wait before checking again when no jobs are queued. Defaults to 5.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("processing upload jobs...")
+        processed_count = 0
+
+        while True:
+            job = claim_next_upload_job()
+
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+
+            self.stdout.write(
+                f"processing upload job {job.pk} for {job.paediatric_diabetes_unit.pz_code}..."
+            )
+            job = process_upload_job(job)
+            processed_count += 1
+
+            self.stdout.write(
+                f"upload job {job.pk}: {job.get_state_display()} ({job.rows_processed} rows, {job.error_count} errors)"
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Processed {processed_count} upload jobs.")
+        )
@@ -0,0 +1,65 @@
+# python
+import logging
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+# RCPCH
+from project.npda.general_functions.audit_period import get_audit_period_for_date
+from project.npda.kpi_class.kpi_cache import invalidate_cached_kpi_results
+from project.npda.kpi_class.patient_kpi_status import (
+    drop_pdu_kpi_counts,
+    update_patient_kpi_statuses,
+)
+from project.npda.models import Patient, PatientKPIStatus
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the stored per-patient KPI statuses for an audit period."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-d",
+            "--date",
+            type=date.fromisoformat,
+            default=None,
+            help="Any date within the audit period to rebuild (YYYY-MM-DD). Defaults to today.",
+        )
+
+    def handle(self, *args, **options):
+        calculation_date = options["date"] or date.today()
+
+        try:
+            audit_start_date, audit_end_date = get_audit_period_for_date(
+                calculation_date
+            )
+        except ValueError as error:
+            raise CommandError(error)
+
+        self.stdout.write(
+            f"rebuilding patient KPI statuses for {audit_start_date} - {audit_end_date}..."
+        )
+
+        pz_codes = PaediatricDiabetesUnit.objects.values_list("pz_code", flat=True)
+
+        # Counts are rebuilt from the new statuses when next needed
+        drop_pdu_kpi_counts(pz_codes, audit_start_date=audit_start_date)
+        deleted_count, _ = PatientKPIStatus.objects.filter(
+            audit_start_date=audit_start_date
+        ).delete()
+
+        patient_pks = list(Patient.objects.values_list("pk", flat=True))
+        update_patient_kpi_statuses(
+            patient_pks, audit_periods=[(audit_start_date, audit_end_date)]
+        )
+        invalidate_cached_kpi_results(pz_codes)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt KPI statuses for {len(patient_pks)} patients ({deleted_count} rows replaced)."
+            )
+        )
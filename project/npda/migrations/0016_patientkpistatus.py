@@ -0,0 +1,64 @@
+# Generated by Django 5.1.15 on 2026-10-17 03:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0015_alter_patientsubmission_unique_together"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PatientKPIStatus",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("audit_start_date", models.DateField()),
+                ("audit_end_date", models.DateField()),
+                ("kpi_number", models.PositiveSmallIntegerField()),
+                ("eligible", models.BooleanField(default=False)),
+                ("passed", models.BooleanField(default=False)),
+                (
+                    "value",
+                    models.DecimalField(
+                        blank=True, decimal_places=3, max_digits=8, null=True
+                    ),
+                ),
+                ("calculated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "patient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="kpi_statuses",
+                        to="npda.patient",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Patient KPI Status",
+                "verbose_name_plural": "Patient KPI Statuses",
+                "indexes": [
+                    models.Index(
+                        fields=["audit_start_date", "kpi_number"],
+                        name="npda_patien_audit_s_ad2168_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("patient", "audit_start_date", "kpi_number"),
+                        name="unique_patient_kpi_status_per_audit_period",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-17 06:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0016_patientkpistatus"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="visit",
+            index=models.Index(
+                fields=["patient", "-visit_date"], name="npda_visit_patient_date_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.15 on 2026-10-17 06:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0017_visit_patient_date_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PDUKPICount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("pz_code", models.CharField(max_length=10)),
+                ("audit_start_date", models.DateField()),
+                ("audit_end_date", models.DateField()),
+                ("kpi_number", models.PositiveSmallIntegerField()),
+                ("total_eligible", models.IntegerField(default=0)),
+                ("total_passed", models.IntegerField(default=0)),
+                (
+                    "value_sum",
+                    models.DecimalField(decimal_places=3, default=0, max_digits=12),
+                ),
+            ],
+            options={
+                "verbose_name": "PDU KPI Count",
+                "verbose_name_plural": "PDU KPI Counts",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("pz_code", "audit_start_date", "kpi_number"),
+                        name="unique_pdu_kpi_count_per_audit_period",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.15 on 2026-10-17 06:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0018_pdukpicount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="KPISnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("pz_code", models.CharField(max_length=10)),
+                ("audit_start_date", models.DateField()),
+                ("audit_end_date", models.DateField()),
+                ("kpi_number", models.PositiveSmallIntegerField()),
+                ("calculation_datetime", models.DateTimeField()),
+                ("total_eligible", models.IntegerField()),
+                ("total_ineligible", models.IntegerField()),
+                ("total_passed", models.FloatField(blank=True, null=True)),
+                ("total_failed", models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "KPI Snapshot",
+                "verbose_name_plural": "KPI Snapshots",
+                "indexes": [
+                    models.Index(
+                        fields=["pz_code", "kpi_number", "-calculation_datetime"],
+                        name="npda_kpisnapshot_trend_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=(
+                            "pz_code",
+                            "audit_start_date",
+                            "kpi_number",
+                            "calculation_datetime",
+                        ),
+                        name="unique_kpi_snapshot_per_calculation",
+                    )
+                ],
+            },
+        ),
+    ]
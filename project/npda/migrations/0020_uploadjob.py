@@ -0,0 +1,82 @@
+# Generated by Django 5.1.15 on 2026-10-17 07:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0019_kpisnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "csv_file",
+                    models.FileField(
+                        help_text="CSV file to upload. Deleted once processed, as the submission keeps a copy",
+                        null=True,
+                        upload_to="upload_jobs/csv/",
+                    ),
+                ),
+                (
+                    "state",
+                    models.PositiveSmallIntegerField(
+                        choices=[
+                            (1, "Queued"),
+                            (2, "Running"),
+                            (3, "Complete"),
+                            (4, "Complete with errors"),
+                            (5, "Failed"),
+                        ],
+                        default=1,
+                    ),
+                ),
+                ("total_rows", models.PositiveIntegerField(blank=True, null=True)),
+                ("rows_processed", models.PositiveIntegerField(default=0)),
+                ("error_count", models.PositiveIntegerField(default=0)),
+                ("errors", models.JSONField(blank=True, default=list)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "paediatric_diabetes_unit",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="upload_jobs",
+                        to="npda.paediatricdiabetesunit",
+                    ),
+                ),
+                (
+                    "uploaded_by",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Upload Job",
+                "verbose_name_plural": "Upload Jobs",
+                "ordering": ("created_at",),
+                "indexes": [
+                    models.Index(
+                        fields=["state", "created_at"], name="npda_uploadjob_queue_idx"
+                    )
+                ],
+            },
+        ),
+    ]
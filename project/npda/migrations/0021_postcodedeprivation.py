@@ -0,0 +1,34 @@
+# Generated by Django 5.1.15 on 2026-10-17 08:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0020_uploadjob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PostcodeDeprivation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("postcode", models.CharField(max_length=8, unique=True)),
+                ("lsoa_code", models.CharField(max_length=9)),
+                ("imd_quintile", models.PositiveSmallIntegerField()),
+            ],
+            options={
+                "verbose_name": "Postcode Deprivation",
+                "verbose_name_plural": "Postcode Deprivation",
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.15 on 2026-10-17 08:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("npda", "0021_postcodedeprivation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="paediatricdiabetesunit",
+            name="kpi_data_version",
+            field=models.PositiveIntegerField(
+                default=0,
+                help_text="Bumped whenever any of the PDU's patients' records change, so its cached KPI results are no longer used",
+            ),
+        ),
+    ]
@@ -1,11 +1,16 @@
 from .help_text_mixin import *
+from .kpi_snapshot import *
 from .npda_user import *
 from .organisation_employer import *
 from .paediatric_diabetes_unit import *
 from .patientsubmission import *
 from .patient import *
+from .patient_kpi_status import *
+from .pdu_kpi_count import *
+from .postcode_deprivation import *
 from .transfer import *
 from .submission import *
 from .time_and_user_abstract_base_classes import *
+from .upload_job import *
 from .visit import *
 from .visitactivity import *
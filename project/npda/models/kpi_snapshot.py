@@ -0,0 +1,60 @@
+# django imports
+from django.contrib.gis.db import models
+
+
+class KPISnapshot(models.Model):
+    """
+    The KPISnapshot class.
+
+    The totals of one KPI for a PDU, as calculated at `calculation_datetime`
+    for an audit period. Snapshots are kept, not overwritten, so a PDU's
+    KPIs can be compared across audit years, or across the quarters of an
+    audit year, without calculating them again (see
+    `project.npda.kpi_class.kpi_snapshots`).
+    """
+
+    pz_code = models.CharField(max_length=10)
+
+    audit_start_date = models.DateField()
+
+    audit_end_date = models.DateField()
+
+    # KPI 32 sub KPIs are stored as 321, 322, 323
+    kpi_number = models.PositiveSmallIntegerField()
+
+    calculation_datetime = models.DateTimeField()
+
+    total_eligible = models.IntegerField()
+
+    total_ineligible = models.IntegerField()
+
+    # KPIs 44 and 45 hold the mean and median HbA1c here, so not integers
+    total_passed = models.FloatField(null=True, blank=True)
+
+    total_failed = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "KPI Snapshot"
+        verbose_name_plural = "KPI Snapshots"
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    "pz_code",
+                    "audit_start_date",
+                    "kpi_number",
+                    "calculation_datetime",
+                ],
+                name="unique_kpi_snapshot_per_calculation",
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["pz_code", "kpi_number", "-calculation_datetime"],
+                name="npda_kpisnapshot_trend_idx",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return (
+            f"KPI {self.kpi_number} for {self.pz_code} at {self.calculation_datetime}"
+        )
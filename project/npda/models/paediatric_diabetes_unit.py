@@ -1,4 +1,4 @@
-from django.contrib.gis.db.models import Model, CharField
+from django.contrib.gis.db.models import Model, CharField, PositiveIntegerField
 
 
 class PaediatricDiabetesUnit(Model):
@@ -44,6 +44,12 @@ class PaediatricDiabetesUnit(Model):
         blank=True,
         null=True,
     )
+    # Kept in the database rather than the cache, so it can't be evicted and
+    # every host sees the same version (see kpi_class/kpi_cache.py)
+    kpi_data_version = PositiveIntegerField(
+        default=0,
+        help_text="Bumped whenever any of the PDU's patients' records change, so its cached KPI results are no longer used",
+    )
 
     class Meta:
         verbose_name = "Paediatric Diabetes Unit"
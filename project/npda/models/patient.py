@@ -35,8 +35,8 @@ class Patient(models.Model):
     """
     The Patient class.
 
-    The index of multiple deprivation is calculated in the save() method using the postcode supplied and the
-    RCPCH Census Platform
+    The index of multiple deprivation is calculated in the save() method using the postcode supplied, from the
+    local PostcodeDeprivation table or else the RCPCH Census Platform
 
     Custom methods age and age_days, returns the age
     """
@@ -141,7 +141,10 @@ class Patient(models.Model):
             today_date = self.get_todays_date()
         return stringify_time_elapsed(self.date_of_birth, today_date)
 
-    def save(self, *args, **kwargs) -> None:
+    def set_index_of_multiple_deprivation_quintile(self) -> None:
+        """Looks up the deprivation quintile of the patient's postcode. Called
+        on save, and for each patient before a bulk insert (which skips
+        save)."""
         if self.postcode:
             try:
                 self.index_of_multiple_deprivation_quintile = imd_for_postcode(
@@ -152,4 +155,7 @@ class Patient(models.Model):
                     f"Cannot calculate deprivation score for {self.postcode} {err}"
                 )
 
+    def save(self, *args, **kwargs) -> None:
+        self.set_index_of_multiple_deprivation_quintile()
+
         return super().save(*args, **kwargs)
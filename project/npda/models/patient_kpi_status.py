@@ -0,0 +1,58 @@
+# django imports
+from django.contrib.gis.db import models
+
+
+class PatientKPIStatus(models.Model):
+    """
+    The PatientKPIStatus class.
+
+    Stores whether a patient is eligible for, and has passed, each KPI for an
+    audit period. Rows are recomputed for a single patient whenever one of
+    their Visit, Transfer or Patient records changes (see
+    `project.npda.kpi_class.patient_kpi_status`), so aggregate KPI results
+    for a PDU are a GROUP BY over this table.
+
+    `value` is only used by:
+        * KPI 32.1 (321) - number of health checks completed
+        * KPIs 44 and 45 - the patient's median HbA1c
+    """
+
+    audit_start_date = models.DateField()
+
+    audit_end_date = models.DateField()
+
+    # KPI 32 sub KPIs are stored as 321, 322, 323
+    kpi_number = models.PositiveSmallIntegerField()
+
+    eligible = models.BooleanField(default=False)
+
+    passed = models.BooleanField(default=False)
+
+    value = models.DecimalField(
+        max_digits=8, decimal_places=3, blank=True, null=True
+    )
+
+    calculated_at = models.DateTimeField(auto_now=True)
+
+    # relationships
+    patient = models.ForeignKey(
+        to="npda.Patient",
+        on_delete=models.CASCADE,
+        related_name="kpi_statuses",
+    )
+
+    class Meta:
+        verbose_name = "Patient KPI Status"
+        verbose_name_plural = "Patient KPI Statuses"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["patient", "audit_start_date", "kpi_number"],
+                name="unique_patient_kpi_status_per_audit_period",
+            )
+        ]
+        indexes = [
+            models.Index(fields=["audit_start_date", "kpi_number"]),
+        ]
+
+    def __str__(self) -> str:
+        return f"KPI {self.kpi_number} for {self.patient} ({self.audit_start_date} - {self.audit_end_date})"
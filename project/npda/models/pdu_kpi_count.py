@@ -0,0 +1,50 @@
+# django imports
+from django.contrib.gis.db import models
+
+
+class PDUKPICount(models.Model):
+    """
+    The PDUKPICount class.
+
+    Running totals of the stored PatientKPIStatus rows of a PDU's patients,
+    per audit period and KPI. When a patient's statuses are recomputed (e.g.
+    a visit is edited) the difference between their old and new statuses is
+    added to the counts of each of their PDUs, so the PDU's KPI results don't
+    need aggregating over all of its patients again.
+
+    Counts are dropped when a patient joins or leaves the PDU, and rebuilt
+    from PatientKPIStatus the next time they are needed (see
+    `project.npda.kpi_class.patient_kpi_status`).
+
+    KPIs 44 and 45 (mean and median of the patients' median HbA1c) can't be
+    updated this way, so have no counts.
+    """
+
+    pz_code = models.CharField(max_length=10)
+
+    audit_start_date = models.DateField()
+
+    audit_end_date = models.DateField()
+
+    # KPI 32 sub KPIs are stored as 321, 322, 323
+    kpi_number = models.PositiveSmallIntegerField()
+
+    total_eligible = models.IntegerField(default=0)
+
+    total_passed = models.IntegerField(default=0)
+
+    # Sum of `PatientKPIStatus.value` of eligible patients (KPI 32.1)
+    value_sum = models.DecimalField(max_digits=12, decimal_places=3, default=0)
+
+    class Meta:
+        verbose_name = "PDU KPI Count"
+        verbose_name_plural = "PDU KPI Counts"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["pz_code", "audit_start_date", "kpi_number"],
+                name="unique_pdu_kpi_count_per_audit_period",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"KPI {self.kpi_number} for {self.pz_code} ({self.audit_start_date} - {self.audit_end_date})"
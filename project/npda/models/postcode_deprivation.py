@@ -0,0 +1,28 @@
+# django imports
+from django.contrib.gis.db import models
+
+
+class PostcodeDeprivation(models.Model):
+    """
+    The PostcodeDeprivation class.
+
+    A local copy of the published postcode to LSOA lookup, joined to the index of
+    multiple deprivation quintile of each LSOA. imd_for_postcode looks postcodes up
+    here before asking the RCPCH Census Platform. Loaded with the
+    load_postcode_deprivation management command.
+    """
+
+    # Upper case without spaces (see postcode_lookup_key)
+    postcode = models.CharField(max_length=8, unique=True)
+
+    lsoa_code = models.CharField(max_length=9)
+
+    # 1 is the most deprived fifth of LSOAs
+    imd_quintile = models.PositiveSmallIntegerField()
+
+    class Meta:
+        verbose_name = "Postcode Deprivation"
+        verbose_name_plural = "Postcode Deprivation"
+
+    def __str__(self) -> str:
+        return f"{self.postcode} ({self.lsoa_code}): IMD quintile {self.imd_quintile}"
@@ -0,0 +1,85 @@
+# django imports
+from django.contrib.gis.db import models
+
+# npda imports
+from ...constants import (
+    UNFINISHED_UPLOAD_JOB_STATES,
+    UPLOAD_JOB_QUEUED,
+    UPLOAD_JOB_STATES,
+)
+
+
+class UploadJob(models.Model):
+    """
+    The UploadJob class.
+
+    A csv file queued for upload to a PDU. The home view only queues the file:
+    the process_upload_jobs management command takes queued jobs in turn, runs
+    csv_upload on them and records their progress here, which the submissions
+    page polls (see `project.npda.general_functions.upload_jobs`).
+    """
+
+    paediatric_diabetes_unit = models.ForeignKey(
+        on_delete=models.CASCADE,
+        to="npda.PaediatricDiabetesUnit",
+        related_name="upload_jobs",
+    )
+
+    uploaded_by = models.ForeignKey(
+        on_delete=models.CASCADE,
+        to="npda.NPDAUser",
+    )
+
+    csv_file = models.FileField(
+        upload_to="upload_jobs/csv/",
+        help_text="CSV file to upload. Deleted once processed, as the submission keeps a copy",
+        null=True,
+    )
+
+    state = models.PositiveSmallIntegerField(
+        choices=UPLOAD_JOB_STATES,
+        default=UPLOAD_JOB_QUEUED,
+    )
+
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+
+    rows_processed = models.PositiveIntegerField(default=0)
+
+    error_count = models.PositiveIntegerField(default=0)
+
+    # Errors found so far: a list of {"field", "message", "original_row_index"}
+    errors = models.JSONField(default=list, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    started_at = models.DateTimeField(null=True, blank=True)
+
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    # Saved with the job's progress, so a job whose worker has stopped (e.g.
+    # crashed, or was redeployed) can be told apart from one still running
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Upload Job"
+        verbose_name_plural = "Upload Jobs"
+        ordering = ("created_at",)
+        indexes = [
+            models.Index(
+                fields=["state", "created_at"],
+                name="npda_uploadjob_queue_idx",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"Upload to {self.paediatric_diabetes_unit.pz_code} ({self.get_state_display()})"
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state not in UNFINISHED_UPLOAD_JOB_STATES
+
+    @property
+    def progress_percentage(self) -> int:
+        if not self.total_rows:
+            return 100 if self.is_finished else 0
+        return round(100 * self.rows_processed / self.total_rows)
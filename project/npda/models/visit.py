@@ -536,6 +536,12 @@ class Visit(models.Model, HelpTextMixin):
         verbose_name = "Visit"
         verbose_name_plural = "Visits"
         ordering = ("-visit_date",)
+        indexes = [
+            # Latest visit per patient lookups in the KPI calculations
+            models.Index(
+                fields=["patient", "-visit_date"], name="npda_visit_patient_date_idx"
+            ),
+        ]
 
     def __str__(self) -> str:
         return f"Patient visit for {self.patient} on {self.visit_date}"
@@ -7,14 +7,21 @@ from django.contrib.auth.signals import (
     user_logged_out,
     user_login_failed,
 )
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 # third party imports
 from two_factor.signals import user_verified
 
 # RCPCH
-from .models import VisitActivity, NPDAUser
+from .models import VisitActivity, NPDAUser, Patient, Submission, Transfer, Visit
 from .general_functions.session import create_session_object
+from .kpi_class.kpi_cache import invalidate_cached_kpi_results
+from .kpi_class.patient_kpi_status import (
+    schedule_patient_kpi_status_update,
+    schedule_pdu_kpi_counts_drop,
+)
 
 # Logging setup
 logger = logging.getLogger(__name__)
@@ -92,6 +99,57 @@ def two_factor_auth_setup(request, user, device, **kwargs):
         )  # Two factor authentication set up
 
 
+# KPI status receivers
+@receiver(post_save, sender=Patient)
+def update_kpi_statuses_on_patient_save(sender, instance, raw=False, **kwargs):
+    """Patient attributes (e.g. date of birth, diagnosis) feed every KPI, so
+    recompute this patient's stored KPI statuses."""
+    if raw:
+        return
+    schedule_patient_kpi_status_update(instance.pk)
+
+
+@receiver(post_save, sender=Visit)
+@receiver(post_delete, sender=Visit)
+@receiver(post_save, sender=Transfer)
+@receiver(post_delete, sender=Transfer)
+def update_kpi_statuses_on_patient_record_change(
+    sender, instance, raw=False, **kwargs
+):
+    """Recompute the stored KPI statuses for the patient of a changed Visit or
+    Transfer. Deleting a Patient cascades to their statuses."""
+    if raw:
+        return
+    schedule_patient_kpi_status_update(instance.patient_id)
+
+
+@receiver(post_save, sender=Transfer)
+@receiver(post_delete, sender=Transfer)
+def drop_pdu_kpi_counts_on_transfer_change(sender, instance, raw=False, **kwargs):
+    """A patient joining or leaving a PDU (including by being deleted) changes
+    which patients its running KPI counts are made of, so they are rebuilt
+    rather than updated. Also invalidates its cached KPI results."""
+    if raw:
+        return
+    schedule_pdu_kpi_counts_drop(
+        pdu_pks=[instance.paediatric_diabetes_unit_id],
+        pz_codes=[instance.previous_pz_code] if instance.previous_pz_code else [],
+    )
+
+
+# KPI results cache receivers
+@receiver(post_save, sender=Submission)
+@receiver(post_delete, sender=Submission)
+def invalidate_cached_kpi_results_for_pdu(sender, instance, raw=False, **kwargs):
+    """A new (or deleted) Submission changes the patients counted for a PDU.
+    Other patient record changes invalidate the cache once their KPI statuses
+    are updated."""
+    if raw:
+        return
+    pz_code = instance.paediatric_diabetes_unit.pz_code
+    transaction.on_commit(lambda: invalidate_cached_kpi_results([pz_code]))
+
+
 # helper functions
 def get_client_ip(request):
     return request.META.get("REMOTE_ADDR")
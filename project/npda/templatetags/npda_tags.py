@@ -210,10 +210,14 @@ def active_navbar_tab(request, url_name):
 
 
 @register.filter
-def join_by_comma(queryset):
-    if len(queryset) == 0:
+def join_by_comma(patient_ids, patient_nhs_numbers):
+    """
+    Renders KPIResult patient_ids as comma separated NHS numbers, from a dict
+    of patient pk: nhs_number looked up once for the whole table.
+    """
+    if patient_ids is None or len(patient_ids) == 0:
         return "No patients"
-    return ", ".join(map(str, queryset.values_list("nhs_number", flat=True)))
+    return ", ".join(str(patient_nhs_numbers[pk]) for pk in patient_ids)
 
 
 @register.filter
@@ -0,0 +1,120 @@
+"""Bulk-inserted synthetic cohorts for the KPI benchmarks.
+
+Patients and visits have the same randomised fields as `create_varied_cohort`
+(see `test_kpi_dataframe_engine.py`) and are built with the factories, but
+are saved with `bulk_create` (in a handful of queries rather than several per
+patient). Model `save()` and signals are skipped, so `PatientKPIStatus` rows
+are not created.
+"""
+
+# Python imports
+import logging
+import random
+from datetime import date
+
+# Third party imports
+import nhs_number
+
+# NPDA Imports
+from project.npda.kpi_class.patient_kpi_status import (
+    deferred_patient_kpi_status_updates,
+)
+from project.npda.models import Patient, Transfer, Visit
+from project.npda.tests.factories.paediatrics_diabetes_unit_factory import (
+    PaediatricsDiabetesUnitFactory,
+)
+from project.npda.tests.factories.patient_factory import PatientFactory
+from project.npda.tests.factories.transfer_factory import TransferFactory
+from project.npda.tests.factories.visit_factory import VisitFactory
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    varied_patient_fields,
+    varied_visit_fields,
+)
+
+# Logging
+logger = logging.getLogger(__name__)
+
+BULK_CREATE_BATCH_SIZE = 5_000
+
+# Realistic clinic attendance: mostly quarterly, some more or less often
+VISITS_PER_PATIENT = (1, 8)
+
+
+def _unique_nhs_numbers(quantity: int) -> list[str]:
+    nhs_numbers = set()
+    while len(nhs_numbers) < quantity:
+        nhs_numbers.update(
+            nhs_number.generate(
+                quantity=quantity - len(nhs_numbers),
+                for_region=nhs_number.REGION_ENGLAND,
+            )
+        )
+    return sorted(nhs_numbers)
+
+
+def create_bulk_cohort(
+    audit_start_date: date,
+    n_patients: int,
+    pz_code: str = "PZ130",
+    seed: int = 42,
+) -> None:
+    """Bulk inserts `n_patients` (with a transfer into the PDU for `pz_code`
+    and 1 - 8 visits each). Seeded so the cohort is the same on every run."""
+
+    rng = random.Random(seed)
+    pdu = PaediatricsDiabetesUnitFactory(pz_code=pz_code)
+    nhs_numbers = _unique_nhs_numbers(n_patients)
+
+    # Built and inserted a batch at a time, so memory use doesn't grow with
+    # the size of the cohort
+    n_visits = 0
+    for batch_start in range(0, n_patients, BULK_CREATE_BATCH_SIZE):
+        patients = []
+        transfer_fields = []
+        for nhs_num in nhs_numbers[batch_start : batch_start + BULK_CREATE_BATCH_SIZE]:
+            fields = varied_patient_fields(rng, audit_start_date)
+            transfer_fields.append(
+                {"date_leaving_service": fields.pop("transfer__date_leaving_service")}
+            )
+            patients.append(
+                PatientFactory.build(
+                    nhs_number=nhs_num, transfer=None, visit=None, **fields
+                )
+            )
+        Patient.objects.bulk_create(patients)
+
+        transfers = []
+        visits = []
+        for patient, fields in zip(patients, transfer_fields):
+            transfers.append(
+                TransferFactory.build(
+                    patient=patient, paediatric_diabetes_unit=pdu, **fields
+                )
+            )
+            for _ in range(rng.randint(*VISITS_PER_PATIENT)):
+                visits.append(
+                    VisitFactory.build(
+                        patient=patient,
+                        **varied_visit_fields(
+                            rng, audit_start_date, patient.diagnosis_date
+                        ),
+                    )
+                )
+        Transfer.objects.bulk_create(transfers)
+        Visit.objects.bulk_create(visits, batch_size=BULK_CREATE_BATCH_SIZE)
+        n_visits += len(visits)
+
+    logger.info(f"Created {n_patients} patients with {n_visits} visits in {pz_code}")
+
+
+def delete_all_patients() -> None:
+    """Deletes every patient a batch at a time, as the cascade collects all
+    of their visits and KPI statuses (one per KPI per patient) in memory"""
+
+    # Otherwise each deleted patient's statuses are updated on its own
+    with deferred_patient_kpi_status_updates():
+        patient_pks = list(Patient.objects.values_list("pk", flat=True))
+        for batch_start in range(0, len(patient_pks), BULK_CREATE_BATCH_SIZE):
+            Patient.objects.filter(
+                pk__in=patient_pks[batch_start : batch_start + BULK_CREATE_BATCH_SIZE]
+            ).delete()
@@ -0,0 +1,151 @@
+"""Benchmarks for the KPI engines on bulk-inserted synthetic cohorts of 1k,
+10k and 50k patients.
+
+Not run by default (deselected in pytest.ini). To run:
+
+    pytest project/npda/tests/benchmarks -k benchmark
+
+Each benchmark times `calculate_kpis_for_pdus` end to end and for each KPI
+group (best of KPI_BENCHMARK_REPEATS runs, default 3), and logs a table of
+baseline / current / change against `baselines.json`. Anything more than
+KPI_BENCHMARK_TOLERANCE (default 0.5, i.e. 50%) and more than NOISE_SECONDS
+slower than its baseline fails the benchmark.
+
+Baselines are machine specific. Set KPI_BENCHMARK_UPDATE_BASELINES=1 to write
+the current times as the new baselines.
+"""
+
+import json
+import logging
+import os
+import time
+from datetime import date
+from pathlib import Path
+
+import pytest
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.tests.benchmarks.cohorts import (
+    create_bulk_cohort,
+    delete_all_patients,
+)
+
+# Logging
+logger = logging.getLogger(__name__)
+
+pytestmark = pytest.mark.benchmark
+
+# Day 2 of the first audit period, as the AUDIT_START_DATE fixture (which
+# can't be used by the module scoped cohort)
+AUDIT_START_DATE = date(year=2024, month=4, day=1)
+
+COHORT_SIZES = [1_000, 10_000, 50_000]
+
+KPI_GROUPS = {
+    "kpis_1_12": list(range(1, 13)),
+    "kpis_13_24": list(range(13, 25)),
+    "kpis_25_32": list(range(25, 32)) + [321, 322, 323],
+    "kpis_33_43": list(range(33, 44)),
+    "kpis_44_49": list(range(44, 50)),
+}
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+REPEATS = int(os.environ.get("KPI_BENCHMARK_REPEATS", 3))
+TOLERANCE = float(os.environ.get("KPI_BENCHMARK_TOLERANCE", 0.5))
+UPDATE_BASELINES = os.environ.get("KPI_BENCHMARK_UPDATE_BASELINES") == "1"
+# Timings of a few ms vary by more than the tolerance from run to run
+NOISE_SECONDS = 0.1
+
+
+@pytest.fixture(
+    scope="module", params=COHORT_SIZES, ids=[f"{n // 1_000}k" for n in COHORT_SIZES]
+)
+def benchmark_cohort(request, django_db_setup, django_db_blocker) -> int:
+    """Bulk inserts a cohort once for all of the benchmarks using it"""
+
+    n_patients = request.param
+
+    with django_db_blocker.unblock():
+        delete_all_patients()
+        create_bulk_cohort(AUDIT_START_DATE, n_patients)
+
+    yield n_patients
+
+    with django_db_blocker.unblock():
+        delete_all_patients()
+
+
+def time_calculation(engine: str, kpis: list[int] = None) -> float:
+    """Best of REPEATS `calculate_kpis_for_pdus` runs, in seconds"""
+
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        CalculateKPIS(
+            calculation_date=AUDIT_START_DATE, engine=engine, kpis=kpis
+        ).calculate_kpis_for_pdus(["PZ130"])
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def compare_with_baselines(
+    n_patients: int, engine: str, timings: dict[str, float]
+) -> list[str]:
+    """Logs the timings against their baselines (updating the baselines if
+    KPI_BENCHMARK_UPDATE_BASELINES=1). Returns the steps which regressed."""
+
+    baselines = (
+        json.loads(BASELINES_PATH.read_text()) if BASELINES_PATH.exists() else {}
+    )
+    engine_baselines = baselines.get(str(n_patients), {}).get(engine, {})
+
+    regressions = []
+    lines = [f"{'step':<12}  {'baseline s':>10}  {'current s':>10}  {'change':>8}"]
+    for step, seconds in timings.items():
+        baseline = engine_baselines.get(step)
+        if baseline is None:
+            change = "new"
+        else:
+            relative_change = (seconds - baseline) / baseline
+            change = f"{relative_change:+.0%}"
+            if relative_change > TOLERANCE and seconds - baseline > NOISE_SECONDS:
+                regressions.append(step)
+        lines.append(
+            f"{step:<12}  {baseline if baseline is not None else '-':>10}  "
+            f"{seconds:>10.4f}  {change:>8}"
+        )
+    logger.info(
+        f"KPI benchmark: {n_patients:,} patients, {engine} engine\n" + "\n".join(lines)
+    )
+
+    if UPDATE_BASELINES:
+        baselines.setdefault(str(n_patients), {})[engine] = {
+            step: round(seconds, 4) for step, seconds in timings.items()
+        }
+        BASELINES_PATH.write_text(json.dumps(baselines, indent=2) + "\n")
+        return []
+
+    return regressions
+
+
+@pytest.mark.parametrize("engine", CalculateKPIS.ENGINES)
+@pytest.mark.django_db
+def test_kpi_benchmark(benchmark_cohort, engine):
+    """Times each engine end to end and for each KPI group"""
+
+    if engine == "stored":
+        # Statuses are only calculated on first use, which isn't what's
+        # being benchmarked
+        CalculateKPIS(
+            calculation_date=AUDIT_START_DATE, engine=engine
+        ).calculate_kpis_for_pdus(["PZ130"])
+
+    timings = {"end_to_end": time_calculation(engine)}
+    for group, kpis in KPI_GROUPS.items():
+        timings[group] = time_calculation(engine, kpis=kpis)
+
+    regressions = compare_with_baselines(benchmark_cohort, engine, timings)
+    assert not regressions, (
+        f"{engine} engine with {benchmark_cohort:,} patients is more than "
+        f"{TOLERANCE:.0%} slower than its baseline for {', '.join(regressions)}"
+    )
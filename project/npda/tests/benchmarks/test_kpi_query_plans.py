@@ -0,0 +1,113 @@
+"""Checks the query plans of the KPI calculation for one PDU in a database
+holding many PDUs, so that no KPI query reads every visit or patient.
+
+Not run by default (deselected in pytest.ini). To run:
+
+    pytest project/npda/tests/benchmarks -k "benchmark and query_plans"
+
+Every SELECT run by `calculate_kpis_for_pdus` is EXPLAINed with sequential
+scans, hash joins and merge joins disabled. On a test sized database the
+planner rightly prefers hashing all of npda_visit, which it won't on the
+national dataset, so what fails the check is a plan which can only read a
+whole table (a Seq Scan, or an index scan with no index condition) e.g. a
+subquery over every patient's visits rather than the PDU's.
+"""
+
+import json
+import logging
+from datetime import date
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.tests.benchmarks.cohorts import (
+    create_bulk_cohort,
+    delete_all_patients,
+)
+
+# Logging
+logger = logging.getLogger(__name__)
+
+pytestmark = pytest.mark.benchmark
+
+# Day 2 of the first audit period, as the AUDIT_START_DATE fixture
+AUDIT_START_DATE = date(year=2024, month=4, day=1)
+
+# The PDU being calculated is one of many, as in the national dataset
+OTHER_PDUS = [f"PZ{i:03d}" for i in range(1, 21)]
+PATIENTS_PER_PDU = 500
+
+CHECKED_TABLES = {"npda_visit", "npda_patient"}
+
+# Leaves the planner with only the plans that look rows up by index
+PLANNER_SETTINGS_OFF = ["enable_seqscan", "enable_hashjoin", "enable_mergejoin"]
+
+
+@pytest.fixture(scope="module")
+def seeded_pdus(django_db_setup, django_db_blocker):
+    """Bulk inserts PATIENTS_PER_PDU patients into each of OTHER_PDUS and the
+    PDU being calculated"""
+
+    with django_db_blocker.unblock():
+        delete_all_patients()
+        for seed, pz_code in enumerate(OTHER_PDUS, start=1):
+            create_bulk_cohort(
+                AUDIT_START_DATE, PATIENTS_PER_PDU, pz_code=pz_code, seed=seed
+            )
+        create_bulk_cohort(AUDIT_START_DATE, PATIENTS_PER_PDU, pz_code="PZ130")
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    yield
+
+    with django_db_blocker.unblock():
+        delete_all_patients()
+
+
+def whole_table_reads(plan: dict) -> list[str]:
+    """The Seq Scans and unconditioned index scans of CHECKED_TABLES in a
+    JSON format plan"""
+
+    reads = []
+    if plan.get("Relation Name") in CHECKED_TABLES:
+        if plan["Node Type"] == "Seq Scan" or (
+            plan["Node Type"] in ("Index Scan", "Index Only Scan")
+            and "Index Cond" not in plan
+        ):
+            reads.append(f"{plan['Node Type']} on {plan['Relation Name']}")
+    for child in plan.get("Plans", []):
+        reads.extend(whole_table_reads(child))
+    return reads
+
+
+@pytest.mark.django_db
+def test_kpi_query_plans_have_no_whole_table_reads(seeded_pdus):
+    """No KPI query for one PDU reads all of the visits or patients"""
+
+    with CaptureQueriesContext(connection) as captured:
+        CalculateKPIS(calculation_date=AUDIT_START_DATE).calculate_kpis_for_pdus(
+            ["PZ130"]
+        )
+    selects = [
+        query["sql"]
+        for query in captured.captured_queries
+        if query["sql"].lstrip().upper().startswith("SELECT")
+    ]
+
+    failures = []
+    with connection.cursor() as cursor:
+        for setting in PLANNER_SETTINGS_OFF:
+            cursor.execute(f"SET LOCAL {setting} = off")
+        for sql in selects:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            reads = whole_table_reads(plan[0]["Plan"])
+            if reads:
+                failures.append(f"{', '.join(reads)}: {sql[:300]}")
+
+    logger.info(f"Checked the plans of {len(selects)} KPI queries")
+    assert not failures, "KPI queries reading a whole table:\n" + "\n".join(failures)
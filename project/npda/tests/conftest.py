@@ -10,6 +10,7 @@ from datetime import date
 from unittest.mock import patch
 
 import pytest
+from django.core.cache import caches
 from pytest_factoryboy import register
 
 # rcpch imports
@@ -39,6 +40,13 @@ def patch_imd_for_postcode():
         logger.debug("Patching imd_for_postcode")
         yield
 
+@pytest.fixture(autouse=True)
+def clear_kpi_results_cache():
+    """Cached KPI results are keyed by db ids, so must not leak between tests."""
+    caches["kpi_results"].clear()
+    yield
+
+
 @pytest.fixture
 def AUDIT_START_DATE():
     """AUDIT_START_DATE is Day 2 of the first audit period"""
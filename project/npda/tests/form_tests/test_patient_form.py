@@ -257,6 +257,35 @@ def test_error_validating_postcode():
     assert(len(form.errors.as_data()) == 0)
 
 
+@pytest.mark.django_db
+def test_postcodes_validated_in_bulk_are_not_looked_up_again():
+    with patch("project.npda.forms.patient_form.validate_postcode") as mock_validate_postcode:
+        form = PatientForm(VALID_FIELDS_WITH_GP_POSTCODE | {
+            "postcode": "W1A 1AA",
+            "gp_practice_postcode": GP_POSTCODE_NO_SPACES,
+        }, postcode_lookup={
+            "W1A1AA": {"normalised_postcode": "W1A 1AA"},
+            GP_POSTCODE_NO_SPACES: {"normalised_postcode": GP_POSTCODE_WITH_SPACES},
+        })
+
+        form.is_valid()
+
+        assert(len(mock_validate_postcode.call_args_list) == 0)
+        assert(form.cleaned_data["postcode"] == "W1A 1AA")
+        assert(form.cleaned_data["gp_practice_postcode"] == GP_POSTCODE_WITH_SPACES)
+
+
+@pytest.mark.django_db
+@patch("project.npda.forms.patient_form.validate_postcode", Mock(return_value={"normalised_postcode":"W1A 1AA"}))
+def test_invalid_postcode_from_bulk_validation():
+    form = PatientForm(VALID_FIELDS, postcode_lookup={
+        VALID_FIELDS["postcode"].upper().replace(" ", ""): None
+    })
+    form.is_valid()
+
+    assert("postcode" in form.errors.as_data())
+
+
 @pytest.mark.django_db
 @patch("project.npda.forms.patient_form.gp_ods_code_for_postcode", Mock(return_value=None))
 def test_invalid_gp_postcode():
@@ -0,0 +1,86 @@
+import pandas as pd
+import pytest
+
+from project.npda.general_functions.csv_prevalidate import prevalidate_visit_rows
+from project.npda.general_functions.csv_upload import VISIT_CSV_FIELDS, read_csv
+
+
+@pytest.fixture
+def dataframe(request):
+    return read_csv(
+        request.config.rootdir / "project" / "npda" / "dummy_sheets" / "dummy_sheet.csv"
+    ).head(3)
+
+
+def prevalidate(dataframe):
+    return prevalidate_visit_rows(
+        dataframe[list(VISIT_CSV_FIELDS.values())].set_axis(
+            list(VISIT_CSV_FIELDS), axis=1
+        ),
+        date_of_birth=dataframe["Date of Birth"],
+        diagnosis_date=dataframe["Date of Diabetes Diagnosis"],
+        death_date=dataframe["Death Date"],
+    )
+
+
+@pytest.mark.django_db
+def test_valid_visits_do_not_need_form(dataframe):
+    needs_form = prevalidate(dataframe)
+
+    assert list(needs_form.columns) == list(VISIT_CSV_FIELDS)
+    assert not needs_form.any(axis=None)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "column,value,field",
+    [
+        ("Diabetes Treatment at time of Hba1c measurement", 45, "treatment"),
+        ("Patient Height (cm)", 300, "height"),
+        ("Patient Height (cm)", 150.25, "height"),  # more than 1 decimal place
+        ("Patient Weight (kg)", 0.5, "weight"),
+        ("Systolic Blood Pressure", 120.5, "systolic_blood_pressure"),
+        ("Total Cholesterol Level (mmol/l)", 13, "total_cholesterol"),
+        (
+            "Visit/Appointment Date",
+            pd.Timestamp(2019, 1, 1),  # before date of birth
+            "visit_date",
+        ),
+        (
+            "Visit/Appointment Date",
+            pd.Timestamp.today().normalize() + pd.Timedelta(days=1),  # in the future
+            "visit_date",
+        ),
+        (
+            "Only complete if OTHER selected: Reason for admission (free text)",
+            " Broken arm ",
+            "hospital_admission_other",
+        ),
+    ],
+)
+def test_invalid_value_needs_form(dataframe, column, value, field):
+    # As read_csv would give a column with that value in
+    if isinstance(value, str):
+        dataframe[column] = dataframe[column].astype(object)
+    elif isinstance(value, float):
+        dataframe[column] = dataframe[column].astype(float)
+    dataframe.loc[0, column] = value
+
+    needs_form = prevalidate(dataframe)
+
+    assert needs_form.loc[0, field]
+    assert not needs_form.loc[0].drop(field).any()
+    assert not needs_form.drop(index=0).any(axis=None)
+
+
+@pytest.mark.django_db
+def test_visit_after_death_needs_form(dataframe):
+    dataframe["Death Date"] = pd.NaT
+    dataframe.loc[2, "Death Date"] = dataframe.loc[
+        2, "Visit/Appointment Date"
+    ] - pd.Timedelta(days=1)
+
+    needs_form = prevalidate(dataframe)
+
+    assert needs_form.loc[2, "visit_date"]
+    assert needs_form.any(axis=1).tolist() == [False, False, True]
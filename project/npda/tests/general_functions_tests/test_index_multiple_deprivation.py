@@ -0,0 +1,124 @@
+from io import StringIO
+from unittest.mock import Mock, patch
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from project.npda.general_functions.index_multiple_deprivation import (
+    cached_imd_for_postcode,
+    imd_for_postcode,
+)
+from project.npda.models import PostcodeDeprivation
+
+DECILE_COLUMN = (
+    "Index of Multiple Deprivation (IMD) Decile (where 1 is most deprived 10% of LSOAs)"
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_imd_cache():
+    cached_imd_for_postcode.cache_clear()
+    yield
+    cached_imd_for_postcode.cache_clear()
+
+
+def census_platform_response(status_code=200, data_quantile=None):
+    return Mock(
+        status_code=status_code,
+        json=Mock(return_value={"result": {"data_quantile": data_quantile}}),
+    )
+
+
+@pytest.mark.django_db
+def test_imd_for_postcode_from_reference_table():
+    PostcodeDeprivation.objects.create(
+        postcode="SW1A1AA", lsoa_code="E01004736", imd_quintile=3
+    )
+
+    with patch(
+        "project.npda.general_functions.index_multiple_deprivation.requests.get"
+    ) as mock_get:
+        assert imd_for_postcode("sw1a 1aa") == 3
+
+        # Cached, whatever the format
+        with CaptureQueriesContext(connection) as queries:
+            assert imd_for_postcode("SW1A1AA") == 3
+
+    assert len(queries) == 0
+    assert len(mock_get.call_args_list) == 0
+
+
+@pytest.mark.django_db
+def test_imd_for_postcode_falls_back_to_census_platform():
+    with patch(
+        "project.npda.general_functions.index_multiple_deprivation.requests.get",
+        Mock(return_value=census_platform_response(data_quantile=2)),
+    ) as mock_get:
+        assert imd_for_postcode("CF10 1AA") == 2
+        # Not cached, so the table is checked again once loaded
+        assert imd_for_postcode("CF10 1AA") == 2
+
+        PostcodeDeprivation.objects.create(
+            postcode="CF101AA", lsoa_code="W01001939", imd_quintile=4
+        )
+        assert imd_for_postcode("CF10 1AA") == 4
+
+    assert len(mock_get.call_args_list) == 2
+    assert cached_imd_for_postcode.cache_info().currsize == 1
+
+
+@pytest.mark.django_db
+def test_failed_census_platform_lookups_are_not_cached():
+    with patch(
+        "project.npda.general_functions.index_multiple_deprivation.requests.get",
+        Mock(return_value=census_platform_response(status_code=500)),
+    ):
+        assert imd_for_postcode("CF10 1AA") is None
+
+    with patch(
+        "project.npda.general_functions.index_multiple_deprivation.requests.get",
+        Mock(return_value=census_platform_response(data_quantile=2)),
+    ):
+        assert imd_for_postcode("CF10 1AA") == 2
+
+
+@pytest.mark.django_db
+def test_load_postcode_deprivation(tmp_path):
+    postcodes_csv = tmp_path / "postcodes.csv"
+    postcodes_csv.write_text(
+        "pcd7,pcd8,pcds,lsoa11cd,ladnm\n"
+        "SW1A1AA,SW1A 1AA,SW1A 1AA,E01004736,Westminster\n"
+        "SE135PJ,SE13 5PJ,SE13 5PJ,E01003189,Lewisham\n"
+        "CF101AA,CF10 1AA,CF10 1AA,W01001939,Caerdydd\n",
+        encoding="latin-1",
+    )
+
+    deprivation_csv = tmp_path / "deprivation.csv"
+    deprivation_csv.write_text(
+        f'LSOA code (2011),LSOA name (2011),"{DECILE_COLUMN}"\n'
+        "E01004736,Westminster 018C,6\n"
+        "E01003189,Lewisham 034D,1\n"
+    )
+
+    # Replaced
+    PostcodeDeprivation.objects.create(
+        postcode="N11AA", lsoa_code="E01000001", imd_quintile=1
+    )
+    cached_imd_for_postcode("N11AA")
+
+    call_command(
+        "load_postcode_deprivation",
+        str(postcodes_csv),
+        str(deprivation_csv),
+        stdout=StringIO(),
+    )
+
+    assert set(
+        PostcodeDeprivation.objects.values_list("postcode", "lsoa_code", "imd_quintile")
+    ) == {
+        ("SW1A1AA", "E01004736", 3),
+        ("SE135PJ", "E01003189", 1),
+    }
+    assert cached_imd_for_postcode.cache_info().currsize == 0
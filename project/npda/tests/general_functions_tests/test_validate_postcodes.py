@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, patch
+
+import pytest
+from requests import RequestException
+
+from project.npda.general_functions.csv_upload import csv_upload
+from project.npda.general_functions.validate_postcode import (
+    validate_postcode,
+    validate_postcodes,
+)
+from project.npda.models import Patient
+from project.npda.tests.test_csv_upload import (  # noqa: F401 (fixtures)
+    ALDER_HEY_PZ_CODE,
+    dummy_sheets_folder,
+    two_patients_first_with_two_visits_second_with_one,
+    test_user,
+)
+
+
+class PostcodesStandIn(BaseHTTPRequestHandler):
+    """
+    Stands in for the postcodes.io lookups, one at a time (GET /postcodes/<postcode>)
+    and in bulk (POST /postcodes), and the findthatpostcode lookup (GET
+    /postcodes/<postcode>.json). Postcodes starting INVALID aren't found, those
+    starting MALFORMED get a response in an unexpected format, and batches with a
+    postcode starting FAIL fail
+    """
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        postcode = self.path.removeprefix("/postcodes/")
+
+        if postcode.endswith(".json"):
+            postcode = postcode.removesuffix(".json")
+            found = {"data": {"id": postcode_result(postcode)["postcode"]}}
+        else:
+            found = {"status": 200, "result": postcode_result(postcode)}
+
+        if postcode.startswith("INVALID"):
+            self.send_json({"status": 404, "error": "Invalid postcode"}, status=404)
+        elif postcode.startswith("MALFORMED"):
+            self.send_json({"status": 200, "unexpected": postcode})
+        else:
+            self.send_json(found)
+
+    def do_POST(self):
+        postcodes = json.loads(self.rfile.read(int(self.headers["Content-Length"])))[
+            "postcodes"
+        ]
+
+        with self.server.lock:
+            self.server.batches.append(postcodes)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+
+        # Long enough for other lookups to overlap this one
+        time.sleep(0.05)
+
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+        if self.path != "/postcodes" or any(
+            postcode.startswith("FAIL") for postcode in postcodes
+        ):
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        if any(postcode.startswith("MALFORMED") for postcode in postcodes):
+            self.send_json({"status": 200, "result": {"postcodes": postcodes}})
+            return
+
+        self.send_json(
+            {
+                "status": 200,
+                "result": [
+                    {
+                        "query": postcode,
+                        "result": (
+                            None
+                            if postcode.startswith("INVALID")
+                            else postcode_result(postcode)
+                        ),
+                    }
+                    for postcode in postcodes
+                ],
+            }
+        )
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def postcode_result(postcode):
+    return {"postcode": f"{postcode[:-3]} {postcode[-3:]}"}
+
+
+@pytest.fixture
+def postcodes_server(settings):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PostcodesStandIn)
+    server.lock = threading.Lock()
+    server.batches = []
+    server.paths = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    settings.POSTCODES_IO_API_BASE_URL = f"http://127.0.0.1:{server.server_port}"
+    settings.POSTCODE_API_BASE_URL = None
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_each_distinct_postcode_is_looked_up_once(postcodes_server):
+    postcodes = [f"SW1A {index}AA" for index in range(7)]
+
+    lookup = validate_postcodes(
+        # Repeated, in different formats, and missing
+        postcodes + [postcode.lower() for postcode in postcodes] + ["SW1A-0AA", None],
+        batch_size=2,
+        max_concurrency=2,
+    )
+
+    assert lookup == {
+        f"SW1A{index}AA": {"normalised_postcode": f"SW1A {index}AA"}
+        for index in range(7)
+    }
+
+    assert len(postcodes_server.batches) == 4
+    assert sorted(sum(postcodes_server.batches, [])) == sorted(lookup)
+    assert postcodes_server.max_in_flight <= 2
+
+
+def test_postcodes_not_found_are_invalid(postcodes_server):
+    assert validate_postcodes(["SW1A 1AA", "INVALID1"]) == {
+        "SW1A1AA": {"normalised_postcode": "SW1A 1AA"},
+        "INVALID1": None,
+    }
+
+
+def test_postcodes_in_failed_lookups_are_left_out(postcodes_server):
+    lookup = validate_postcodes(["FAIL1", "SW1A 1AA", "W1A 1AA"], batch_size=2)
+
+    # FAIL1 and SW1A1AA were in the failed batch
+    assert lookup == {"W1A1AA": {"normalised_postcode": "W1A 1AA"}}
+
+
+def test_postcodes_in_lookups_with_unexpected_responses_are_left_out(
+    postcodes_server,
+):
+    lookup = validate_postcodes(["MALFORMED1", "SW1A 1AA", "W1A 1AA"], batch_size=2)
+
+    # MALFORMED1 and SW1A1AA were in the batch with the unexpected response
+    assert lookup == {"W1A1AA": {"normalised_postcode": "W1A 1AA"}}
+
+
+def test_postcodes_are_validated_one_at_a_time_with_the_bulk_lookup_provider(
+    postcodes_server,
+):
+    assert validate_postcode("SW1A1AA") == validate_postcodes(["SW1A1AA"])["SW1A1AA"]
+    assert validate_postcode("INVALID1") is None
+
+    with pytest.raises(RequestException):
+        validate_postcode("MALFORMED1")
+
+
+def test_postcodes_are_validated_one_at_a_time_with_a_configured_provider(
+    postcodes_server, settings
+):
+    # Deployments that set it before bulk lookups were added
+    settings.POSTCODE_API_BASE_URL = settings.POSTCODES_IO_API_BASE_URL
+
+    assert validate_postcode("SW1A1AA") == {"normalised_postcode": "SW1A 1AA"}
+    assert validate_postcode("INVALID1") is None
+
+    with pytest.raises(RequestException):
+        validate_postcode("MALFORMED1")
+
+    assert postcodes_server.paths == [
+        "/postcodes/SW1A1AA.json",
+        "/postcodes/INVALID1.json",
+        "/postcodes/MALFORMED1.json",
+    ]
+
+
+@pytest.mark.django_db
+def test_csv_upload_validates_postcodes_in_bulk(
+    postcodes_server, test_user, two_patients_first_with_two_visits_second_with_one
+):
+    df = two_patients_first_with_two_visits_second_with_one
+
+    with patch(
+        "project.npda.forms.patient_form.validate_postcode"
+    ) as mock_validate_postcode, patch(
+        "project.npda.forms.patient_form.gp_details_for_ods_code",
+        Mock(return_value=True),
+    ):
+        csv_upload(test_user, df, None, ALDER_HEY_PZ_CODE)
+
+    assert len(mock_validate_postcode.call_args_list) == 0
+
+    # Both patients' postcodes in a single lookup
+    assert len(postcodes_server.batches) == 1
+    assert sorted(postcodes_server.batches[0]) == sorted(
+        df["Postcode of usual address"].str.replace(" ", "").unique()
+    )
+
+    assert sorted(Patient.objects.values_list("postcode", flat=True)) == sorted(
+        df["Postcode of usual address"].unique()
+    )
@@ -4,13 +4,23 @@ Also contains utils / helper functions for testing the CalculateKPIS class.
 """
 
 import logging
+import re
 from datetime import date
+from unittest.mock import patch
 
 from project.npda.tests.factories.patient_factory import PatientFactory
+import numpy as np
 import pytest
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
 
+from project.npda.kpi_class.kpi_profiler import format_kpi_profile
 from project.npda.kpi_class.kpis import CalculateKPIS, KPIResult, kpi_registry
 from project.npda.models.patient import Patient
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    create_varied_cohort,
+)
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -101,6 +111,7 @@ def test_ensure_mocked_audit_date_range_is_correct(AUDIT_START_DATE):
     ), f"Mocked audit end date incorrect!"
 
 
+@pytest.mark.parametrize("engine", CalculateKPIS.ENGINES)
 @pytest.mark.parametrize(
     "calculation_method, calculation_args",
     [
@@ -112,6 +123,7 @@ def test_ensure_mocked_audit_date_range_is_correct(AUDIT_START_DATE):
 def test_kpi_calculations_dont_break_when_no_patients(
     calculation_method,
     calculation_args,
+    engine,
     AUDIT_START_DATE,
 ):
     """Tests none of the KPIs break when no patients are present.
@@ -123,7 +135,7 @@ def test_kpi_calculations_dont_break_when_no_patients(
     Patient.objects.all().delete()
 
     # The default pz_code is "PZ130" for PaediatricsDiabetesUnitFactory
-    kpi_calculator = CalculateKPIS(calculation_date=AUDIT_START_DATE)
+    kpi_calculator = CalculateKPIS(calculation_date=AUDIT_START_DATE, engine=engine)
 
     # Run each calculation method
     kpi_calculation_method = getattr(kpi_calculator, calculation_method)
@@ -209,3 +221,184 @@ def test_ensure_calculate_kpis_for_patient_returns_correct_kpi_subset(AUDIT_STAR
         assert (
             expected_kpi_key in kpi_results_obj
         ), f"Expected KPI {expected_kpi_key} in single patient subset, but not present in results"
+
+
+def test_kpi_registry_calculation_order_includes_dependencies():
+    """Tests the calculation order of a KPI subset is its transitive closure
+    over `depends_on`, with the base cohorts first."""
+
+    assert kpi_registry.get_calculation_order([25, 44]) == [1, 5, 25, 44]
+    assert kpi_registry.get_calculation_order([23]) == [1, 2, 23]
+    assert kpi_registry.get_calculation_order([43, 41]) == [7, 41, 43]
+    assert kpi_registry.get_calculation_order([]) == []
+
+    with pytest.raises(ValueError):
+        kpi_registry.get_calculation_order([50])
+
+
+@pytest.mark.parametrize("engine", CalculateKPIS.ENGINES)
+@pytest.mark.django_db
+def test_calculate_kpis_subset_matches_all_kpis(engine, AUDIT_START_DATE):
+    """Tests calculating a subset of KPIs only returns those KPIs, with the
+    same results as calculating all of them."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=20)
+
+    KPI_SUBSET = [23, 25, 28, 321, 41, 44]
+
+    all_kpis = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True, engine=engine
+    ).calculate_kpis_for_pdus(["PZ130"])
+    kpi_subset = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE,
+        return_pt_querysets=True,
+        engine=engine,
+        kpis=KPI_SUBSET,
+    ).calculate_kpis_for_pdus(["PZ130"])
+
+    assert list(kpi_subset["calculated_kpi_values"]) == [
+        kpi_registry.get_attribute_name(kpi_number)
+        for kpi_number in [23, 25, 28, 321, 41, 44]
+    ]
+    for kpi_name, kpi_result in kpi_subset["calculated_kpi_values"].items():
+        expected = all_kpis["calculated_kpi_values"][kpi_name]
+        for field in [
+            "total_eligible",
+            "total_ineligible",
+            "total_passed",
+            "total_failed",
+        ]:
+            assert kpi_result[field] == expected[field], f"{kpi_name} {field}"
+        for key, patient_ids in kpi_result["patient_ids"].items():
+            assert np.array_equal(patient_ids, expected["patient_ids"][key])
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_subset_only_runs_dependencies(AUDIT_START_DATE):
+    """Tests only the requested KPIs and the base cohorts they depend on are
+    calculated."""
+
+    with patch.object(
+        CalculateKPIS,
+        "calculate_kpi_3_total_t1dm",
+        side_effect=AssertionError("KPI 3 is not a dependency"),
+    ), patch.object(
+        CalculateKPIS,
+        "calculate_kpi_6_total_t1dm_complete_year_gte_12yo",
+        side_effect=AssertionError("KPI 6 is not a dependency"),
+    ):
+        kpi_calc_obj = CalculateKPIS(
+            calculation_date=AUDIT_START_DATE, kpis=[25, 44]
+        ).calculate_kpis_for_single_patient(PatientFactory())
+
+    assert list(kpi_calc_obj["calculated_kpi_values"]) == [
+        "kpi_25_hba1c",
+        "kpi_44_mean_hba1c",
+    ]
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_base_cohort_evaluated_once(AUDIT_START_DATE):
+    """Tests KPIs depending on KPI 1 filter on its materialised patients,
+    rather than each re-running KPI 1's query."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    with CaptureQueriesContext(connection) as captured_queries:
+        CalculateKPIS(
+            calculation_date=AUDIT_START_DATE, kpis=[13, 14, 15]
+        ).calculate_kpis_for_pdus(["PZ130"])
+
+    kpi_1_queries = [
+        query
+        for query in captured_queries
+        if '"nhs_number" IS NOT NULL' in query["sql"]
+    ]
+    assert len(kpi_1_queries) == 1
+    # The dependent KPIs filter on the fetched pks
+    assert (
+        len(
+            [
+                query
+                for query in captured_queries
+                if re.search(r'"npda_patient"\."id" IN \(\d', query["sql"])
+            ]
+        )
+        >= 3
+    )
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_profile_records_each_kpi_method(AUDIT_START_DATE):
+    """Tests profiling records every KPI method's queries, and that only the
+    initial patient count is outside them."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    with CaptureQueriesContext(connection) as captured_queries:
+        kpi_calc_obj = CalculateKPIS(
+            calculation_date=AUDIT_START_DATE, profile=True
+        ).calculate_kpis_for_pdus(["PZ130"])
+
+    profile = kpi_calc_obj["profile"]
+    assert list(profile) == list(kpi_calc_obj["calculated_kpi_values"])
+    assert sum(step["queries"] for step in profile.values()) == (
+        len(captured_queries) - 1
+    )
+    for step in profile.values():
+        assert step["wall_time"] >= step["db_time"] >= 0
+
+    table = format_kpi_profile(profile)
+    slowest_kpi_name = max(profile, key=lambda name: profile[name]["wall_time"])
+    assert table.splitlines()[1].startswith(slowest_kpi_name)
+
+
+@pytest.mark.parametrize("engine", CalculateKPIS.ENGINES)
+@pytest.mark.django_db
+def test_kpi_table_renders_patient_ids_without_queries(
+    engine, AUDIT_START_DATE, django_assert_num_queries
+):
+    """Tests patient ids are materialised during the calculation (as sorted
+    arrays), so rendering every KPI's patients in the KPI table doesn't
+    query the db."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    patients = PatientFactory.create_batch(3)
+
+    kpi_calculator = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True, engine=engine
+    )
+    kpi_calc_obj = kpi_calculator.calculate_kpis_for_pdus(["PZ130"])
+
+    kpi_1_patient_ids = kpi_calc_obj["calculated_kpi_values"]["kpi_1_total_eligible"][
+        "patient_ids"
+    ]
+    assert list(
+        np.union1d(kpi_1_patient_ids["eligible"], kpi_1_patient_ids["ineligible"])
+    ) == sorted(patient.pk for patient in patients)
+
+    patient_nhs_numbers = dict(
+        kpi_calculator.patients.values_list("pk", "nhs_number")
+    )
+    with django_assert_num_queries(0):
+        rendered = render_to_string(
+            "partials/kpi_table.html",
+            {
+                "kpi_results": kpi_calc_obj,
+                "patient_nhs_numbers": patient_nhs_numbers,
+            },
+        )
+
+    for patient in patients:
+        assert str(patient.nhs_number) in rendered
@@ -0,0 +1,72 @@
+"""Tests for `CalculateKPIS.calculate_kpis_by_pdu`."""
+
+import pytest
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient, Transfer
+from project.npda.tests.factories.paediatrics_diabetes_unit_factory import (
+    PaediatricsDiabetesUnitFactory,
+)
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+)
+
+PZ_CODES = ["PZ130", "PZ001"]
+
+
+@pytest.mark.parametrize("return_pt_querysets", [False, True])
+@pytest.mark.django_db
+def test_calculate_kpis_by_pdu_matches_calculate_kpis_for_pdus(
+    AUDIT_START_DATE, return_pt_querysets
+):
+    """Tests each PDU's results from the single grouped pass are the same as
+    calculating that PDU on its own, including a patient in both PDUs."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=40)
+
+    # Move half the patients to a second PDU, and add one to both
+    other_pdu = PaediatricsDiabetesUnitFactory(pz_code="PZ001")
+    patient_pks = list(Patient.objects.order_by("pk").values_list("pk", flat=True))
+    Transfer.objects.filter(patient_id__in=patient_pks[::2]).update(
+        paediatric_diabetes_unit=other_pdu
+    )
+    Transfer.objects.create(patient_id=patient_pks[1], paediatric_diabetes_unit=other_pdu)
+
+    kpi_calculations_by_pdu = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE,
+        return_pt_querysets=return_pt_querysets,
+    ).calculate_kpis_by_pdu(pz_codes=PZ_CODES + ["PZ999"])
+
+    assert set(kpi_calculations_by_pdu) == set(PZ_CODES + ["PZ999"])
+
+    for pz_code in PZ_CODES:
+        assert_kpi_calculations_equal(
+            CalculateKPIS(
+                calculation_date=AUDIT_START_DATE,
+                return_pt_querysets=return_pt_querysets,
+            ).calculate_kpis_for_pdus([pz_code]),
+            kpi_calculations_by_pdu[pz_code],
+        )
+
+    # No patients
+    assert kpi_calculations_by_pdu["PZ999"]["total_patients_count"] == 0
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_by_pdu_query_count(
+    AUDIT_START_DATE, django_assert_max_num_queries
+):
+    """Tests the number of queries doesn't grow with the number of PDUs."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=20)
+
+    # Transfers, then the DataFrameKPIEngine's patients, visits and transfers
+    with django_assert_max_num_queries(4):
+        CalculateKPIS(calculation_date=AUDIT_START_DATE).calculate_kpis_by_pdu()
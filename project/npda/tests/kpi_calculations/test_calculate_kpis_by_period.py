@@ -0,0 +1,70 @@
+"""Tests for `CalculateKPIS.calculate_kpis_by_period`."""
+
+from datetime import date
+
+import pytest
+from dateutil.relativedelta import relativedelta
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+)
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_by_period_matches_each_audit_period(
+    AUDIT_START_DATE, django_assert_num_queries
+):
+    """Tests each audit period's results match calculating that period on its
+    own, from a single load of the patients."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    next_audit_start_date = AUDIT_START_DATE + relativedelta(years=1)
+    # Patients with dates around both audit periods' boundaries
+    create_varied_cohort(AUDIT_START_DATE, n_patients=30)
+    create_varied_cohort(next_audit_start_date, n_patients=30, seed=7)
+
+    kpi_calculator = CalculateKPIS(
+        calculation_date=next_audit_start_date, return_pt_querysets=True
+    )
+    # Patient count, then patients, visits and transfers
+    with django_assert_num_queries(4):
+        kpi_calculations_by_period = kpi_calculator.calculate_kpis_by_period(
+            ["PZ130"],
+            calculation_dates=[
+                next_audit_start_date,
+                AUDIT_START_DATE,
+                # Same period as AUDIT_START_DATE
+                AUDIT_START_DATE + relativedelta(months=6),
+            ],
+        )
+
+    assert list(kpi_calculations_by_period) == [
+        AUDIT_START_DATE,
+        next_audit_start_date,
+    ]
+
+    for audit_start_date, kpi_calculations in kpi_calculations_by_period.items():
+        expected = CalculateKPIS(
+            calculation_date=audit_start_date, return_pt_querysets=True
+        ).calculate_kpis_for_pdus(["PZ130"])
+
+        assert kpi_calculations["audit_start_date"] == audit_start_date
+        assert kpi_calculations["audit_end_date"] == expected["audit_end_date"]
+        assert_kpi_calculations_equal(expected, kpi_calculations)
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_by_period_with_no_periods():
+    """Tests no audit periods gives no results, without loading anything."""
+
+    assert (
+        CalculateKPIS(calculation_date=date(2024, 4, 1)).calculate_kpis_by_period(
+            ["PZ130"], calculation_dates=[]
+        )
+        == {}
+    )
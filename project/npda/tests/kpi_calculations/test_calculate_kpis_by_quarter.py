@@ -0,0 +1,67 @@
+"""Tests for `CalculateKPIS.calculate_kpis_by_quarter`."""
+
+import pytest
+
+from project.npda.general_functions import get_quarter_end_dates
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+)
+
+
+def calculate_kpis_to(audit_start_date, audit_end_date):
+    """Calculates KPIs with the SQL engine for an audit period ending on
+    `audit_end_date`"""
+
+    kpi_calculator = CalculateKPIS(
+        calculation_date=audit_start_date, return_pt_querysets=True
+    )
+    kpi_calculator.audit_end_date = audit_end_date
+    kpi_calculator.AUDIT_DATE_RANGE = (audit_start_date, audit_end_date)
+    return kpi_calculator.calculate_kpis_for_pdus(["PZ130"])
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_by_quarter_matches_each_cumulative_period(
+    AUDIT_START_DATE, django_assert_num_queries
+):
+    """Tests each quarter's results match the SQL engine for an audit period
+    ending on that quarter's last day, from a single load of the patients."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE)
+
+    kpi_calculator = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True
+    )
+    # Patient count, then patients, visits and transfers
+    with django_assert_num_queries(4):
+        kpi_calculations_by_quarter = kpi_calculator.calculate_kpis_by_quarter(
+            ["PZ130"]
+        )
+
+    quarter_end_dates = get_quarter_end_dates(kpi_calculator.audit_start_date)
+    assert list(kpi_calculations_by_quarter) == [1, 2, 3, 4]
+    assert quarter_end_dates[-1] == kpi_calculator.audit_end_date
+
+    for quarter, quarter_end_date in zip([1, 2, 3, 4], quarter_end_dates):
+        kpi_calculations = kpi_calculations_by_quarter[quarter]
+        assert kpi_calculations["audit_end_date"] == quarter_end_date
+        assert_kpi_calculations_equal(
+            calculate_kpis_to(kpi_calculator.audit_start_date, quarter_end_date),
+            kpi_calculations,
+        )
+
+    # More patients have a visit in the audit period as it goes on
+    kpi_1_eligible = [
+        kpi_calculations_by_quarter[quarter]["calculated_kpi_values"][
+            "kpi_1_total_eligible"
+        ]["total_eligible"]
+        for quarter in [1, 2, 3, 4]
+    ]
+    assert kpi_1_eligible == sorted(kpi_1_eligible)
+    assert kpi_1_eligible[0] < kpi_1_eligible[-1]
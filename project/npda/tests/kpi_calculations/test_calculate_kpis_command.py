@@ -0,0 +1,157 @@
+"""Tests for the `calculate_kpis` management command."""
+
+import csv
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    create_varied_cohort,
+)
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_command_writes_results_and_resumes(AUDIT_START_DATE, tmp_path):
+    """Tests results are written as JSON and CSV, and that a second run only
+    calculates PDUs without a checkpoint."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    call_command(
+        "calculate_kpis",
+        pz_codes=["PZ130"],
+        date=AUDIT_START_DATE,
+        output_dir=str(tmp_path),
+    )
+
+    (run_dir,) = tmp_path.iterdir()
+    assert (run_dir / "pdus" / "PZ130.json").exists()
+
+    expected = CalculateKPIS(calculation_date=AUDIT_START_DATE).calculate_kpis_for_pdus(
+        ["PZ130"]
+    )
+    results = json.loads((run_dir / "kpis.json").read_text())
+    assert results["PZ130"]["total_patients_count"] == expected["total_patients_count"]
+    for kpi_name, kpi_result in expected["calculated_kpi_values"].items():
+        assert (
+            results["PZ130"]["calculated_kpi_values"][kpi_name]["total_eligible"]
+            == kpi_result["total_eligible"]
+        )
+
+    with open(run_dir / "kpis.csv") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert len(rows) == len(expected["calculated_kpi_values"])
+    assert {row["pz_code"] for row in rows} == {"PZ130"}
+
+    # Checkpointed PDUs are not recalculated, unless restarting
+    with patch.object(CalculateKPIS, "calculate_kpis_by_pdu") as mock_calculate:
+        call_command(
+            "calculate_kpis",
+            pz_codes=["PZ130"],
+            date=AUDIT_START_DATE,
+            output_dir=str(tmp_path),
+        )
+    mock_calculate.assert_not_called()
+
+    call_command(
+        "calculate_kpis",
+        pz_codes=["PZ130"],
+        date=AUDIT_START_DATE,
+        output_dir=str(tmp_path),
+        format=["json"],
+        restart=True,
+    )
+    restarted_results = json.loads((run_dir / "kpis.json").read_text())
+    assert (
+        restarted_results["PZ130"]["calculated_kpi_values"]
+        == results["PZ130"]["calculated_kpi_values"]
+    )
+    assert (
+        restarted_results["PZ130"]["calculation_datetime"]
+        != results["PZ130"]["calculation_datetime"]
+    )
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_command_only_resumes_the_same_run(AUDIT_START_DATE, tmp_path):
+    """Tests checkpoints are only resumed by a run with the same options,
+    recorded in the run's manifest."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=5)
+
+    options = {
+        "pz_codes": ["PZ130"],
+        "date": AUDIT_START_DATE,
+        "output_dir": str(tmp_path),
+        "format": ["json"],
+        "stdout": StringIO(),
+    }
+    call_command("calculate_kpis", **options)
+
+    (run_dir,) = tmp_path.iterdir()
+    assert json.loads((run_dir / "manifest.json").read_text()) == {
+        "calculation_date": AUDIT_START_DATE.isoformat(),
+        "engine": None,
+        "snapshot": False,
+    }
+
+    for changed_options in [
+        {"engine": "sql"},
+        {"snapshot": True},
+        # Another date in the same audit period
+        {"date": AUDIT_START_DATE + timedelta(days=1)},
+    ]:
+        with pytest.raises(CommandError, match="use --restart"):
+            call_command("calculate_kpis", **{**options, **changed_options})
+
+    call_command("calculate_kpis", **options, engine="sql", restart=True)
+    assert json.loads((run_dir / "manifest.json").read_text())["engine"] == "sql"
+
+    # Checkpoints from before manifests were written
+    (run_dir / "manifest.json").unlink()
+    with pytest.raises(CommandError, match="use --restart"):
+        call_command("calculate_kpis", **options, engine="sql")
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_command_profile(AUDIT_START_DATE, tmp_path):
+    """Tests --profile prints each KPI method's timings when calculating with
+    the sql engine."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=5)
+
+    stdout = StringIO()
+    call_command(
+        "calculate_kpis",
+        pz_codes=["PZ130"],
+        date=AUDIT_START_DATE,
+        output_dir=str(tmp_path),
+        engine="sql",
+        profile=True,
+        stdout=stdout,
+    )
+
+    output = stdout.getvalue()
+    assert "profile of 1 calculated PDUs" in output
+    assert "kpi_25_hba1c" in output
+
+    # The profile isn't saved with the results
+    (run_dir,) = tmp_path.iterdir()
+    results = json.loads((run_dir / "kpis.json").read_text())
+    assert "profile" not in results["PZ130"]
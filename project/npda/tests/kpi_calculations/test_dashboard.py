@@ -0,0 +1,111 @@
+"""Tests for the streamed KPI dashboard."""
+
+import re
+from unittest.mock import patch
+
+import pytest
+from django.urls import reverse
+from django.utils.html import escape
+
+from project.constants.user import RCPCH_AUDIT_TEAM
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.factories.npda_user_factory import NPDAUserFactory
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    create_varied_cohort,
+)
+from project.npda.tests.utils import login_and_verify_user
+from project.npda.views.home import DASHBOARD_KPI_GROUPS
+
+
+@pytest.fixture
+def dashboard_client(client, settings):
+    # Full pages link static files, which needn't be collected to test them
+    settings.STORAGES = {
+        **settings.STORAGES,
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    }
+    client = login_and_verify_user(client, NPDAUserFactory(role=RCPCH_AUDIT_TEAM))
+    session = client.session
+    session["pz_code"] = "PZ130"
+    session.save()
+    return client
+
+
+@pytest.mark.django_db
+def test_dashboard_streams_shell_then_each_kpi_group(
+    AUDIT_START_DATE, dashboard_client, django_assert_num_queries
+):
+    """Tests the page shell is sent before any KPI is calculated, followed by
+    the rows of each KPI group in order, covering every KPI."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    response = dashboard_client.get(reverse("dashboard"))
+    assert response.streaming
+
+    chunks = iter(response.streaming_content)
+    with django_assert_num_queries(0):
+        shell = next(chunks).decode()
+    assert "Dashboard" in shell
+    assert "kpi-group-" not in shell
+
+    page = shell + b"".join(chunks).decode()
+    assert re.findall(r'id="kpi-group-([\d-]+)"', page) == [
+        f"{first}-{last}" for first, last in DASHBOARD_KPI_GROUPS
+    ]
+    assert page.rstrip().endswith("</html>")
+
+    expected = CalculateKPIS(calculation_date=AUDIT_START_DATE).calculate_kpis_for_pdus(
+        ["PZ130"]
+    )
+    for kpi_result in expected["calculated_kpi_values"].values():
+        assert escape(kpi_result["kpi_label"]) in page
+
+
+@pytest.mark.django_db
+def test_dashboard_calculates_kpis_once(AUDIT_START_DATE, dashboard_client):
+    """Tests the KPI groups are rendered from a single calculation, rather
+    than one (and one PDU lock and cache entry) per group."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    with patch.object(
+        CalculateKPIS,
+        "calculate_kpis_for_pdus",
+        autospec=True,
+        side_effect=CalculateKPIS.calculate_kpis_for_pdus,
+    ) as mock_calculate:
+        response = dashboard_client.get(reverse("dashboard"))
+        b"".join(response.streaming_content)
+
+    assert mock_calculate.call_count == 1
+    assert mock_calculate.call_args.args[0].kpis is None
+
+
+@pytest.mark.django_db
+def test_dashboard_htmx_request_returns_whole_kpi_table(
+    AUDIT_START_DATE, dashboard_client
+):
+    """Tests HTMX refreshes of the dashboard get the KPI table in one piece."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    response = dashboard_client.get(reverse("dashboard"), HTTP_HX_REQUEST="true")
+    assert not response.streaming
+
+    content = response.content.decode()
+    assert "<html" not in content
+    assert content.count("<tbody") == 1
+    assert "kpi_1_total_eligible" not in content
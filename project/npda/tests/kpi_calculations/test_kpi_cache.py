@@ -0,0 +1,139 @@
+"""Tests for the versioned KPI results cache."""
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from django.core.cache import caches
+from django.utils import timezone
+
+from project.constants.hba1c_format import HBA1C_FORMATS
+from project.constants.user import RCPCH_AUDIT_TEAM
+from project.npda.kpi_class.kpi_cache import invalidate_cached_kpi_results
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient, Submission
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
+from project.npda.tests.factories.npda_user_factory import NPDAUserFactory
+from project.npda.tests.factories.visit_factory import VisitFactory
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+)
+
+
+def calculate(audit_start_date, use_cache=True):
+    return CalculateKPIS(
+        calculation_date=audit_start_date,
+        return_pt_querysets=True,
+        engine="fused",
+    ).calculate_kpis_for_pdus(["PZ130"], use_cache=use_cache)
+
+
+@pytest.mark.django_db
+def test_cached_kpi_results_match_uncached(
+    AUDIT_START_DATE, django_assert_max_num_queries
+):
+    """Tests a repeat calculation is served from the cache, only looking up
+    the active submission, and gives the same results and patient ids."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=20)
+
+    uncached_results = calculate(AUDIT_START_DATE, use_cache=False)
+    calculate(AUDIT_START_DATE)
+
+    with django_assert_max_num_queries(1):
+        cached_results = calculate(AUDIT_START_DATE)
+
+    assert_kpi_calculations_equal(uncached_results, cached_results)
+
+
+@pytest.mark.django_db
+def test_cached_kpi_results_invalidated_on_visit_save(
+    AUDIT_START_DATE, django_capture_on_commit_callbacks
+):
+    """Tests adding a visit to a patient invalidates their PDU's results."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=20)
+    calculate(AUDIT_START_DATE)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        for patient in Patient.objects.all():
+            VisitFactory(
+                patient=patient,
+                visit_date=AUDIT_START_DATE + relativedelta(days=10),
+                hba1c=60,
+                hba1c_format=HBA1C_FORMATS[0][0],
+                hba1c_date=AUDIT_START_DATE + relativedelta(days=10),
+            )
+
+    assert_kpi_calculations_equal(
+        calculate(AUDIT_START_DATE, use_cache=False), calculate(AUDIT_START_DATE)
+    )
+
+
+@pytest.mark.django_db
+def test_cached_kpi_results_invalidated_on_new_submission(
+    AUDIT_START_DATE, django_capture_on_commit_callbacks
+):
+    """Tests a new submission for the PDU gives a new cache entry."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    def kpi_1_total_eligible(results):
+        return results["calculated_kpi_values"]["kpi_1_total_eligible"][
+            "total_eligible"
+        ]
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=5)
+    total_eligible = kpi_1_total_eligible(calculate(AUDIT_START_DATE))
+    assert total_eligible > 0
+
+    # Change the data behind the cache's back (no signals)
+    Patient.objects.update(date_of_birth=AUDIT_START_DATE - relativedelta(years=30))
+    assert kpi_1_total_eligible(calculate(AUDIT_START_DATE)) == total_eligible
+
+    with django_capture_on_commit_callbacks(execute=True):
+        Submission.objects.create(
+            paediatric_diabetes_unit=PaediatricDiabetesUnit.objects.get(
+                pz_code="PZ130"
+            ),
+            audit_year=AUDIT_START_DATE.year,
+            submission_date=timezone.now(),
+            submission_by=NPDAUserFactory(role=RCPCH_AUDIT_TEAM),
+            submission_active=True,
+        )
+
+    results = calculate(AUDIT_START_DATE)
+    assert_kpi_calculations_equal(calculate(AUDIT_START_DATE, use_cache=False), results)
+    # Nobody is under 25 any more
+    assert kpi_1_total_eligible(results) == 0
+
+
+@pytest.mark.django_db
+def test_kpi_data_version_is_kept_in_the_database(AUDIT_START_DATE):
+    """Tests invalidating bumps the PDU's data version in the database, so it
+    can't be culled from the cache (bringing back stale results) and is seen
+    by every host."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=5)
+    calculate(AUDIT_START_DATE)
+
+    # Change the data behind the cache's back, then invalidate it
+    Patient.objects.update(date_of_birth=AUDIT_START_DATE - relativedelta(years=30))
+    invalidate_cached_kpi_results(["PZ130"])
+
+    # The stale results are still cached, under the old version
+    results = calculate(AUDIT_START_DATE)
+    assert_kpi_calculations_equal(calculate(AUDIT_START_DATE, use_cache=False), results)
+
+    # Culling (or clearing) the cache leaves the version as it was
+    caches["kpi_results"].clear()
+    assert PaediatricDiabetesUnit.objects.get(pz_code="PZ130").kpi_data_version == 1
@@ -0,0 +1,214 @@
+"""Tests for the in-memory (dataframe) KPI engine.
+
+The dataframe engine must give identical results to the SQL engine, so these
+tests build a varied, seeded cohort and compare both engines' outputs.
+"""
+
+import random
+from datetime import date
+
+import numpy as np
+import pytest
+from dateutil.relativedelta import relativedelta
+
+from project.constants.albuminuria_stage import ALBUMINURIA_STAGES
+from project.constants.closed_loop_types import CLOSED_LOOP_TYPES
+from project.constants.diabetes_treatment import TREATMENT_TYPES
+from project.constants.diabetes_types import DIABETES_TYPES
+from project.constants.glucose_monitoring_types import GLUCOSE_MONITORING_TYPES
+from project.constants.hospital_admission_reasons import (
+    HOSPITAL_ADMISSION_REASONS,
+)
+from project.constants.retinal_screening_results import (
+    RETINAL_SCREENING_RESULTS,
+)
+from project.constants.smoking_status import SMOKING_STATUS
+from project.constants.thyroid_treatment_status import THYROID_TREATMENT_STATUS
+from project.constants.yes_no_unknown import YES_NO_UNKNOWN
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.factories.patient_factory import PatientFactory
+from project.npda.tests.factories.visit_factory import VisitFactory
+
+
+def _choice_values(choices) -> list:
+    return [choice[0] for choice in choices] + [None]
+
+
+def varied_patient_fields(rng: random.Random, audit_start_date: date) -> dict:
+    """Randomised PatientFactory fields: a spread of ages, diagnosis dates,
+    deaths and transfers, with dates either side of the audit period
+    boundaries."""
+
+    def random_date(start_offset_days: int, end_offset_days: int):
+        return audit_start_date + relativedelta(
+            days=rng.randint(start_offset_days, end_offset_days)
+        )
+
+    def maybe(value, probability: float = 0.6):
+        return value if rng.random() < probability else None
+
+    # Spread of ages 2 - 27 years old at audit start
+    date_of_birth = audit_start_date - relativedelta(days=rng.randint(730, 10_000))
+    # Diagnoses before and during the audit period
+    diagnosis_date = random_date(-1_000, 300)
+
+    return dict(
+        date_of_birth=date_of_birth,
+        diagnosis_date=diagnosis_date,
+        diabetes_type=rng.choice([DIABETES_TYPES[0][0]] * 4 + [DIABETES_TYPES[1][0]]),
+        death_date=maybe(random_date(-30, 400), probability=0.1),
+        transfer__date_leaving_service=maybe(random_date(-30, 400), probability=0.15),
+    )
+
+
+def varied_visit_fields(
+    rng: random.Random, audit_start_date: date, diagnosis_date: date
+) -> dict:
+    """Randomised VisitFactory fields, with observations either side of the
+    audit period boundaries."""
+
+    def random_date(start_offset_days: int, end_offset_days: int):
+        return audit_start_date + relativedelta(
+            days=rng.randint(start_offset_days, end_offset_days)
+        )
+
+    def maybe(value, probability: float = 0.6):
+        return value if rng.random() < probability else None
+
+    return dict(
+        visit_date=maybe(random_date(-60, 400), probability=0.95),
+        height=maybe(rng.randint(100, 190)),
+        weight=maybe(rng.randint(20, 90)),
+        height_weight_observation_date=maybe(random_date(-30, 380)),
+        hba1c=maybe(rng.randint(40, 90), probability=0.8),
+        hba1c_date=maybe(random_date(-30, 380), probability=0.8),
+        treatment=rng.choice(_choice_values(TREATMENT_TYPES)),
+        closed_loop_system=rng.choice(_choice_values(CLOSED_LOOP_TYPES)),
+        glucose_monitoring=rng.choice(
+            _choice_values(GLUCOSE_MONITORING_TYPES)
+        ),
+        systolic_blood_pressure=maybe(rng.randint(80, 140)),
+        blood_pressure_observation_date=maybe(random_date(-30, 380)),
+        foot_examination_observation_date=maybe(random_date(-30, 380)),
+        retinal_screening_observation_date=maybe(random_date(-30, 380)),
+        retinal_screening_result=rng.choice(
+            _choice_values(RETINAL_SCREENING_RESULTS)
+        ),
+        albumin_creatinine_ratio=maybe(rng.randint(1, 10)),
+        albumin_creatinine_ratio_date=maybe(random_date(-30, 380)),
+        albuminuria_stage=rng.choice(_choice_values(ALBUMINURIA_STAGES)),
+        thyroid_function_date=maybe(random_date(-400, 380)),
+        thyroid_treatment_status=rng.choice(
+            _choice_values(THYROID_TREATMENT_STATUS)
+        ),
+        coeliac_screen_date=maybe(random_date(-400, 380)),
+        gluten_free_diet=rng.choice(_choice_values(YES_NO_UNKNOWN)),
+        psychological_screening_assessment_date=maybe(random_date(-30, 380)),
+        psychological_additional_support_status=rng.choice(
+            _choice_values(YES_NO_UNKNOWN)
+        ),
+        smoking_status=rng.choice(_choice_values(SMOKING_STATUS)),
+        smoking_cessation_referral_date=maybe(random_date(-30, 380)),
+        carbohydrate_counting_level_three_education_date=maybe(
+            diagnosis_date + relativedelta(days=rng.randint(-10, 20))
+        ),
+        dietician_additional_appointment_offered=rng.choice(
+            _choice_values(YES_NO_UNKNOWN)
+        ),
+        dietician_additional_appointment_date=maybe(random_date(-30, 380)),
+        flu_immunisation_recommended_date=maybe(random_date(-30, 380)),
+        ketone_meter_training=rng.choice(_choice_values(YES_NO_UNKNOWN)),
+        sick_day_rules_training_date=maybe(random_date(-30, 380)),
+        hospital_admission_date=maybe(random_date(-30, 380), probability=0.3),
+        hospital_discharge_date=maybe(random_date(-30, 380), probability=0.3),
+        hospital_admission_reason=rng.choice(
+            _choice_values(HOSPITAL_ADMISSION_REASONS)
+        ),
+    )
+
+
+def create_varied_cohort(
+    audit_start_date: date, n_patients: int = 60, seed: int = 42
+) -> None:
+    """Creates `n_patients` with a spread of ages, diagnosis dates, deaths,
+    transfers and 1 - 5 visits each, with dates either side of the audit
+    period boundaries. Seeded so the cohort is the same on every run."""
+
+    rng = random.Random(seed)
+
+    for _ in range(n_patients):
+        patient = PatientFactory(
+            **varied_patient_fields(rng, audit_start_date),
+            visit=None,
+        )
+
+        for _ in range(rng.randint(1, 5)):
+            VisitFactory(
+                patient=patient,
+                **varied_visit_fields(rng, audit_start_date, patient.diagnosis_date),
+            )
+
+
+def assert_kpi_calculations_equal(expected: dict, actual: dict) -> None:
+    """Asserts two KPICalculationsObjects (from different engines) have the
+    same totals and patient ids for every KPI."""
+
+    assert actual["total_patients_count"] == expected["total_patients_count"]
+
+    for kpi_name, expected_result in expected["calculated_kpi_values"].items():
+        actual_result = actual["calculated_kpi_values"][kpi_name]
+
+        for key in ["total_eligible", "total_ineligible", "total_failed"]:
+            assert actual_result[key] == expected_result[key], (
+                f"{kpi_name} {key}: expected {expected_result[key]}, "
+                f"got {actual_result[key]}"
+            )
+
+        # KPIs 44 and 45 store HbA1c values in total_passed
+        if expected_result["total_passed"] is None:
+            assert actual_result["total_passed"] is None, kpi_name
+        else:
+            assert float(actual_result["total_passed"]) == pytest.approx(
+                float(expected_result["total_passed"])
+            ), kpi_name
+
+        if expected_result["patient_ids"] is None:
+            assert actual_result["patient_ids"] is None, kpi_name
+            continue
+
+        for key, expected_ids in expected_result["patient_ids"].items():
+            assert np.array_equal(
+                actual_result["patient_ids"][key], expected_ids
+            ), f"{kpi_name} patient_ids[{key}]"
+
+
+@pytest.mark.django_db
+def test_invalid_engine_raises(AUDIT_START_DATE):
+    """Tests an unknown engine is rejected at init."""
+
+    with pytest.raises(ValueError):
+        CalculateKPIS(calculation_date=AUDIT_START_DATE, engine="spark")
+
+
+@pytest.mark.parametrize("seed", [1, 42])
+@pytest.mark.django_db
+def test_dataframe_engine_matches_sql_engine(AUDIT_START_DATE, seed):
+    """Tests the dataframe engine gives the same totals and patient ids
+    as the SQL engine for every KPI."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, seed=seed)
+
+    sql_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True
+    ).calculate_kpis_for_pdus(["PZ130"])
+    dataframe_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE,
+        return_pt_querysets=True,
+        engine="dataframe",
+    ).calculate_kpis_for_pdus(["PZ130"])
+
+    assert_kpi_calculations_equal(sql_results, dataframe_results)
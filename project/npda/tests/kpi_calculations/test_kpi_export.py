@@ -0,0 +1,105 @@
+"""Tests for the Parquet / Arrow export of KPI results."""
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from django.core.management import call_command
+
+from project.npda.kpi_class.dataframe_engine import COUNT_ONLY_KPI_NUMBERS
+from project.npda.kpi_class.kpi_export import write_kpi_export
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    create_varied_cohort,
+)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_kpi_export_matches_kpi_calculations(AUDIT_START_DATE, tmp_path, file_format):
+    """Tests the exported totals and per-patient flags match the KPI
+    calculations, with dictionary encoded PZ code and KPI columns."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=20)
+    kpi_calculations_by_pdu = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True
+    ).calculate_kpis_by_pdu(["PZ130"])
+
+    kpis_path, patients_path = write_kpi_export(
+        kpi_calculations_by_pdu, str(tmp_path), file_format=file_format
+    )
+    if file_format == "parquet":
+        kpis, patients = pq.read_table(kpis_path), pq.read_table(patients_path)
+    else:
+        kpis = pa.ipc.open_file(kpis_path).read_all()
+        patients = pa.ipc.open_file(patients_path).read_all()
+
+    for table in [kpis, patients]:
+        assert pa.types.is_dictionary(table.schema.field("pz_code").type)
+        assert pa.types.is_dictionary(table.schema.field("kpi_name").type)
+
+    calculated_kpi_values = kpi_calculations_by_pdu["PZ130"]["calculated_kpi_values"]
+    assert kpis.num_rows == len(calculated_kpi_values)
+
+    kpi_totals = kpis.to_pandas().set_index("kpi_name")
+    flags = patients.to_pandas()
+    for kpi_name, kpi_result in calculated_kpi_values.items():
+        assert (
+            kpi_totals.loc[kpi_name, "total_eligible"] == kpi_result["total_eligible"]
+        )
+
+        kpi_flags = flags[flags["kpi_name"] == kpi_name]
+        patient_ids = kpi_result["patient_ids"]
+        assert kpi_flags["pz_code"].eq("PZ130").all()
+        assert set(kpi_flags["patient_id"]) == set(patient_ids["eligible"]) | set(
+            patient_ids["ineligible"]
+        )
+        assert set(kpi_flags.loc[kpi_flags["eligible"], "patient_id"]) == set(
+            patient_ids["eligible"]
+        )
+
+        kpi_number = kpi_flags["kpi_number"].iloc[0] if len(kpi_flags) else None
+        if kpi_number in COUNT_ONLY_KPI_NUMBERS:
+            assert kpi_flags["passed"].isna().all()
+        elif kpi_number is not None:
+            assert set(kpi_flags.loc[kpi_flags["passed"] == True, "patient_id"]) == set(
+                patient_ids["passed"]
+            )
+            # Ineligible patients neither pass nor fail
+            assert kpi_flags.loc[~kpi_flags["eligible"], "passed"].isna().all()
+
+
+@pytest.mark.django_db
+def test_calculate_kpis_command_writes_parquet(AUDIT_START_DATE, tmp_path):
+    """Tests `calculate_kpis --format parquet` writes the KPI totals and
+    patients of each PDU."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    call_command(
+        "calculate_kpis",
+        pz_codes=["PZ130"],
+        date=AUDIT_START_DATE,
+        output_dir=str(tmp_path),
+        format=["parquet"],
+    )
+
+    (run_dir,) = tmp_path.iterdir()
+    kpis = pq.read_table(run_dir / "kpis.parquet")
+    patients = pq.read_table(run_dir / "patients.parquet")
+
+    expected = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True
+    ).calculate_kpis_for_pdus(["PZ130"])
+    assert kpis.num_rows == len(expected["calculated_kpi_values"])
+    assert patients.num_rows == sum(
+        len(set(kpi_result["patient_ids"]["eligible"]))
+        + len(set(kpi_result["patient_ids"]["ineligible"]))
+        for kpi_result in expected["calculated_kpi_values"].values()
+    )
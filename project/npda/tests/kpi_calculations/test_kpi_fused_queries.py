@@ -0,0 +1,65 @@
+"""Tests for the fused (single conditional aggregation) KPI queries."""
+
+import pytest
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+)
+
+
+@pytest.mark.parametrize("seed", [1, 42])
+@pytest.mark.django_db
+def test_fused_queries_match_sql_engine(AUDIT_START_DATE, seed):
+    """Tests the fused queries give the same totals and patient ids
+    as the SQL engine for every KPI."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, seed=seed)
+
+    sql_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True
+    ).calculate_kpis_for_pdus(["PZ130"])
+    fused_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE,
+        return_pt_querysets=True,
+        engine="fused",
+    ).calculate_kpis_for_pdus(["PZ130"])
+
+    assert_kpi_calculations_equal(sql_results, fused_results)
+
+
+@pytest.mark.parametrize(
+    "return_pt_querysets, max_num_queries", [(False, 5), (True, 9)]
+)
+@pytest.mark.django_db
+def test_fused_queries_query_count(
+    AUDIT_START_DATE,
+    return_pt_querysets,
+    max_num_queries,
+    django_assert_max_num_queries,
+):
+    """Tests all KPIs are calculated in a handful of queries, regardless of
+    the number of KPIs or patients.
+
+    1 patients count, 1 fused aggregate for count-style KPIs, and the KPI 1
+    count plus an aggregate each for KPIs 44 and 45. Patient ids add 1 query
+    for all count-style KPIs, plus the cohort and the eligible patients of
+    KPIs 44 and 45.
+    """
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=20)
+
+    with django_assert_max_num_queries(max_num_queries):
+        CalculateKPIS(
+            calculation_date=AUDIT_START_DATE,
+            return_pt_querysets=return_pt_querysets,
+            engine="fused",
+        ).calculate_kpis_for_pdus(["PZ130"])
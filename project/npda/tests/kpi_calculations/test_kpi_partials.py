@@ -0,0 +1,99 @@
+"""Tests for network, trust and national KPI rollups from mergeable PDU
+partials (`CalculateKPIS.calculate_kpis_by_rollup`)."""
+
+import pytest
+
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import Patient, Transfer
+from project.npda.models.paediatric_diabetes_unit import PaediatricDiabetesUnit
+from project.npda.tests.factories.paediatrics_diabetes_unit_factory import (
+    PaediatricsDiabetesUnitFactory,
+)
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+)
+
+PZ_CODES = ["PZ130", "PZ001"]
+
+
+def create_network_of_two_pdus(audit_start_date):
+    """Splits a cohort between PZ130 (trust RQM) and PZ001 (trust RYJ), both
+    in network PN01."""
+
+    create_varied_cohort(audit_start_date, n_patients=40)
+
+    other_pdu = PaediatricsDiabetesUnitFactory(pz_code="PZ001")
+    patient_pks = list(Patient.objects.order_by("pk").values_list("pk", flat=True))
+    Transfer.objects.filter(patient_id__in=patient_pks[::2]).update(
+        paediatric_diabetes_unit=other_pdu
+    )
+
+    PaediatricDiabetesUnit.objects.filter(pz_code__in=PZ_CODES).update(
+        paediatric_diabetes_network_code="PN01"
+    )
+    PaediatricDiabetesUnit.objects.filter(pz_code="PZ130").update(parent_ods_code="RQM")
+    PaediatricDiabetesUnit.objects.filter(pz_code="PZ001").update(parent_ods_code="RYJ")
+
+
+@pytest.mark.django_db
+def test_kpi_rollups_match_calculate_kpis_for_pdus(AUDIT_START_DATE):
+    """Tests merging PDU partials gives the same results as calculating the
+    network's and each trust's PDUs together, including the mean and median
+    HbA1c."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_network_of_two_pdus(AUDIT_START_DATE)
+
+    kpi_calculations = CalculateKPIS(calculation_date=AUDIT_START_DATE)
+    network_kpis = kpi_calculations.calculate_kpis_by_rollup("network")
+    trust_kpis = kpi_calculations.calculate_kpis_by_rollup("trust")
+    national_kpis = kpi_calculations.calculate_kpis_by_rollup("national")
+
+    assert set(network_kpis) == {"PN01"}
+    assert set(trust_kpis) == {"RQM", "RYJ"}
+
+    def calculate_for_pdus(pz_codes):
+        return CalculateKPIS(calculation_date=AUDIT_START_DATE).calculate_kpis_for_pdus(
+            pz_codes
+        )
+
+    assert_kpi_calculations_equal(calculate_for_pdus(PZ_CODES), network_kpis["PN01"])
+    assert_kpi_calculations_equal(
+        calculate_for_pdus(PZ_CODES), national_kpis["national"]
+    )
+    assert_kpi_calculations_equal(calculate_for_pdus(["PZ130"]), trust_kpis["RQM"])
+    assert_kpi_calculations_equal(calculate_for_pdus(["PZ001"]), trust_kpis["RYJ"])
+
+
+@pytest.mark.django_db
+def test_kpi_rollup_from_cached_partials_does_not_load_visits(
+    AUDIT_START_DATE, django_assert_max_num_queries
+):
+    """Tests a repeat rollup only looks up the PDUs, their versions and their
+    network codes, and gives the same results."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_network_of_two_pdus(AUDIT_START_DATE)
+
+    kpi_calculations = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, kpis=[1, 25, 45]
+    )
+    uncached_network_kpis = kpi_calculations.calculate_kpis_by_rollup("network")
+
+    # PZ codes, active submissions, network codes
+    with django_assert_max_num_queries(3):
+        cached_network_kpis = kpi_calculations.calculate_kpis_by_rollup("network")
+
+    assert set(cached_network_kpis["PN01"]["calculated_kpi_values"]) == {
+        "kpi_1_total_eligible",
+        "kpi_25_hba1c",
+        "kpi_45_median_hba1c",
+    }
+    assert_kpi_calculations_equal(
+        uncached_network_kpis["PN01"], cached_network_kpis["PN01"]
+    )
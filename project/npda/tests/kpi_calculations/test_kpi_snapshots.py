@@ -0,0 +1,137 @@
+"""Tests for the KPI snapshot history and trend."""
+
+import datetime
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from project.constants.user import RCPCH_AUDIT_TEAM
+from project.npda.kpi_class.kpi_snapshots import get_kpi_trend, save_kpi_snapshots
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.models import KPISnapshot, Patient
+from project.npda.tests.factories.npda_user_factory import NPDAUserFactory
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    create_varied_cohort,
+)
+from project.npda.tests.utils import login_and_verify_user
+
+
+def at(kpi_calculations, calculation_datetime, years_earlier=0):
+    """The same results, as if calculated at `calculation_datetime` for the
+    audit period `years_earlier`"""
+
+    return {
+        **kpi_calculations,
+        "calculation_datetime": calculation_datetime,
+        "audit_start_date": kpi_calculations["audit_start_date"]
+        - relativedelta(years=years_earlier),
+        "audit_end_date": kpi_calculations["audit_end_date"]
+        - relativedelta(years=years_earlier),
+    }
+
+
+@pytest.mark.django_db
+def test_kpi_trend_reads_latest_snapshot_of_each_period(AUDIT_START_DATE):
+    """Tests the trend has the latest snapshot of each audit year, or of each
+    quarter of an audit year, and that saving a snapshot again is a no-op."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+    kpi_calculations = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE
+    ).calculate_kpis_for_pdus(["PZ130"])
+    n_kpis = len(kpi_calculations["calculated_kpi_values"])
+
+    def moment(month, day):
+        return timezone.make_aware(datetime.datetime(2024, month, day, 12))
+
+    previous_year = at(kpi_calculations, moment(3, 1), years_earlier=1)
+    first_quarter = at(kpi_calculations, moment(4, 10))
+    first_quarter_latest = at(kpi_calculations, moment(6, 20))
+    first_quarter_latest["calculated_kpi_values"] = {
+        kpi_name: {**kpi_result, "total_eligible": kpi_result["total_eligible"] + 1}
+        for kpi_name, kpi_result in kpi_calculations["calculated_kpi_values"].items()
+    }
+    second_quarter = at(kpi_calculations, moment(8, 1))
+
+    for snapshot in [previous_year, first_quarter, first_quarter_latest]:
+        save_kpi_snapshots({"PZ130": snapshot})
+    assert save_kpi_snapshots({"PZ130": second_quarter}) == n_kpis
+    save_kpi_snapshots({"PZ130": second_quarter})
+    assert KPISnapshot.objects.count() == 4 * n_kpis
+
+    kpi_1 = kpi_calculations["calculated_kpi_values"]["kpi_1_total_eligible"]
+
+    yearly = get_kpi_trend("PZ130", kpi_numbers=[1])
+    assert list(yearly) == [1]
+    assert [point["audit_start_date"] for point in yearly[1]] == [
+        previous_year["audit_start_date"],
+        kpi_calculations["audit_start_date"],
+    ]
+    assert (
+        yearly[1][-1]["calculation_datetime"] == second_quarter["calculation_datetime"]
+    )
+
+    quarterly = get_kpi_trend("PZ130", kpi_numbers=[1, 321], interval="quarter")
+    assert set(quarterly) == {1, 321}
+    assert [point["quarter"] for point in quarterly[1]] == [
+        datetime.date(2024, 1, 1),
+        datetime.date(2024, 4, 1),
+        datetime.date(2024, 7, 1),
+    ]
+    # The latest snapshot of the quarter
+    assert quarterly[1][1]["total_eligible"] == kpi_1["total_eligible"] + 1
+
+
+@pytest.mark.django_db
+def test_kpi_snapshots_written_by_command_and_read_by_trend_view(
+    AUDIT_START_DATE, tmp_path, client
+):
+    """Tests `calculate_kpis --snapshot` saves a snapshot of each KPI, which
+    the trend view returns for the session's PDU."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    call_command(
+        "calculate_kpis",
+        pz_codes=["PZ130"],
+        date=AUDIT_START_DATE,
+        output_dir=str(tmp_path),
+        snapshot=True,
+    )
+
+    expected = CalculateKPIS(calculation_date=AUDIT_START_DATE).calculate_kpis_for_pdus(
+        ["PZ130"]
+    )
+    assert KPISnapshot.objects.filter(pz_code="PZ130").count() == len(
+        expected["calculated_kpi_values"]
+    )
+
+    client = login_and_verify_user(client, NPDAUserFactory(role=RCPCH_AUDIT_TEAM))
+    session = client.session
+    session["pz_code"] = "PZ130"
+    session.save()
+
+    response = client.get(reverse("kpi_trend"), {"kpi": ["1", "44"]})
+    assert response.status_code == 200
+
+    trend = response.json()
+    assert trend["pz_code"] == "PZ130"
+    assert set(trend["kpis"]) == {"1", "44"}
+    (kpi_1,) = trend["kpis"]["1"]
+    assert (
+        kpi_1["total_eligible"]
+        == expected["calculated_kpi_values"]["kpi_1_total_eligible"]["total_eligible"]
+    )
+    assert kpi_1["audit_start_date"] == str(expected["audit_start_date"])
+
+    response = client.get(reverse("kpi_trend"), {"interval": "month"})
+    assert response.status_code == 400
@@ -1,10 +1,14 @@
 """Tests for the Outcomes KPIs."""
 
 import logging
+from datetime import timedelta
 from typing import List
 
 import pytest
 from dateutil.relativedelta import relativedelta
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery
+from django.test.utils import CaptureQueriesContext
 
 from project.constants.albuminuria_stage import ALBUMINURIA_STAGES
 from project.constants.diabetes_types import DIABETES_TYPES
@@ -12,17 +16,51 @@ from project.constants.hospital_admission_reasons import \
     HOSPITAL_ADMISSION_REASONS
 from project.constants.smoking_status import SMOKING_STATUS
 from project.constants.yes_no_unknown import YES_NO_UNKNOWN
+from project.npda.kpi_class.aggregates import Median
 from project.npda.kpi_class.kpis import CalculateKPIS, KPIResult
-from project.npda.models import Patient
+from project.npda.models import Patient, Visit
 from project.npda.tests.factories.patient_factory import PatientFactory
 from project.npda.tests.factories.visit_factory import VisitFactory
 from project.npda.tests.kpi_calculations.test_calculate_kpis import \
     assert_kpi_result_equal
+from project.npda.tests.kpi_calculations.test_kpi_partials import \
+    create_network_of_two_pdus
 
 # Logging
 logger = logging.getLogger(__name__)
 
 
+def correlated_subquery_median_hba1cs(calc_kpis: CalculateKPIS) -> List[float]:
+    """Each eligible patient's median HbA1c, sorted, calculated as KPIs 44 and
+    45 did before the single grouped query: a correlated subquery per patient.
+    NOTE: grouped by patient, as intended. The old subquery took `.values("hba1c")`
+    first, so grouped by HbA1c and returned the patient's first measurement."""
+
+    eligible_patients, _ = (
+        calc_kpis._get_total_kpi_1_eligible_pts_base_query_set_and_total_count()
+    )
+    valid_hba1c_subquery = (
+        Visit.objects.filter(
+            visit_date__range=calc_kpis.AUDIT_DATE_RANGE,
+            hba1c_date__gte=F("patient__diagnosis_date") + timedelta(days=90),
+            patient=OuterRef("pk"),
+        )
+        .order_by()
+        .values("patient")
+        .annotate(median_hba1c=Median("hba1c"))
+        .values("median_hba1c")
+    )
+    median_hba1cs = eligible_patients.annotate(
+        median_hba1c=Subquery(valid_hba1c_subquery[:1])
+    ).values_list("median_hba1c", flat=True)
+
+    return sorted(
+        float(median_hba1c)
+        for median_hba1c in median_hba1cs
+        if median_hba1c is not None
+    )
+
+
 @pytest.mark.django_db
 def test_kpi_calculation_44(AUDIT_START_DATE):
     """Tests that KPI44 is calculated correctly.
@@ -43,6 +81,7 @@ def test_kpi_calculation_44(AUDIT_START_DATE):
     eligible_criteria = {
         "visit__visit_date": AUDIT_START_DATE + relativedelta(days=2),
         "date_of_birth": AUDIT_START_DATE - relativedelta(days=365 * 10),
+        "diagnosis_date": DIAGNOSIS_DATE,
     }
 
     # Create passing pts
@@ -67,7 +106,7 @@ def test_kpi_calculation_44(AUDIT_START_DATE):
         patient=passing_pt_1_median_46,
         visit_date=AUDIT_START_DATE + relativedelta(months=6),
         # HbA1c measurements within the audit period and after 90 days of diagnosis
-        hba1c_date=DIAGNOSIS_DATE + relativedelta(days=6),
+        hba1c_date=DIAGNOSIS_DATE + relativedelta(months=6),
         hba1c=pt_1_hba1cs[2],
     )
 
@@ -143,6 +182,8 @@ def test_kpi_calculation_44(AUDIT_START_DATE):
         expected=EXPECTED_KPIRESULT,
         actual=calc_kpis.calculate_kpi_44_mean_hba1c(),
     )
+    # Same per patient medians as the correlated subquery KPIs 44 and 45 used
+    assert correlated_subquery_median_hba1cs(calc_kpis) == sorted(medians)
 
 
 @pytest.mark.django_db
@@ -166,6 +207,7 @@ def test_kpi_calculation_45(AUDIT_START_DATE):
     eligible_criteria = {
         "visit__visit_date": AUDIT_START_DATE + relativedelta(days=2),
         "date_of_birth": AUDIT_START_DATE - relativedelta(days=365 * 10),
+        "diagnosis_date": DIAGNOSIS_DATE,
     }
 
     # Create passing pts
@@ -190,7 +232,7 @@ def test_kpi_calculation_45(AUDIT_START_DATE):
         patient=passing_pt_1_median_46,
         visit_date=AUDIT_START_DATE + relativedelta(months=6),
         # HbA1c measurements within the audit period and after 90 days of diagnosis
-        hba1c_date=DIAGNOSIS_DATE + relativedelta(days=6),
+        hba1c_date=DIAGNOSIS_DATE + relativedelta(months=6),
         hba1c=pt_1_hba1cs[2],
     )
 
@@ -266,6 +308,86 @@ def test_kpi_calculation_45(AUDIT_START_DATE):
         expected=EXPECTED_KPIRESULT,
         actual=calc_kpis.calculate_kpi_45_median_hba1c(),
     )
+    # Same per patient medians as the correlated subquery KPIs 44 and 45 used
+    assert correlated_subquery_median_hba1cs(calc_kpis) == sorted(medians)
+
+
+@pytest.mark.django_db
+def test_kpi_calculation_44_45_share_per_patient_medians(AUDIT_START_DATE):
+    """Tests that KPIs 44 and 45 are the mean and median of the same per
+    patient medians, which are all calculated in a single query."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    DIAGNOSIS_DATE = AUDIT_START_DATE - relativedelta(days=90)
+    eligible_criteria = {
+        "visit__visit_date": AUDIT_START_DATE + relativedelta(days=2),
+        "date_of_birth": AUDIT_START_DATE - relativedelta(days=365 * 10),
+        "diagnosis_date": DIAGNOSIS_DATE,
+    }
+
+    # Skewed so that the mean and median of the medians differ, with an even
+    # number of measurements for one patient
+    pts_hba1cs = [[40, 41], [50, 52, 51], [90]]
+    for pt_hba1cs in pts_hba1cs:
+        patient = PatientFactory(**eligible_criteria)
+        for months, hba1c in enumerate(pt_hba1cs, start=1):
+            VisitFactory(
+                patient=patient,
+                visit_date=AUDIT_START_DATE + relativedelta(months=months),
+                hba1c_date=AUDIT_START_DATE + relativedelta(months=months),
+                hba1c=hba1c,
+            )
+    # Eligible, but without a valid HbA1c so not in either aggregate
+    PatientFactory(**eligible_criteria)
+
+    calc_kpis = CalculateKPIS(calculation_date=AUDIT_START_DATE)
+    # Need to be mocked as not using public `calculate_kpis_for_*` methods
+    calc_kpis.patients = Patient.objects.all()
+    calc_kpis.total_patients_count = Patient.objects.count()
+
+    with CaptureQueriesContext(connection) as ctx:
+        kpi_44 = calc_kpis.calculate_kpi_44_mean_hba1c()
+        kpi_45 = calc_kpis.calculate_kpi_45_median_hba1c()
+
+    medians = list(map(calculate_median, pts_hba1cs))
+    assert kpi_44.total_eligible == kpi_45.total_eligible == 4
+    assert kpi_44.total_passed == pytest.approx(sum(medians) / len(medians))
+    assert kpi_45.total_passed == pytest.approx(calculate_median(medians))
+    assert correlated_subquery_median_hba1cs(calc_kpis) == pytest.approx(
+        sorted(medians)
+    )
+    assert (
+        len([query for query in ctx.captured_queries if "percentile_cont" in query["sql"]])
+        == 1
+    )
+
+
+@pytest.mark.django_db
+def test_kpi_calculation_44_45_not_reused_across_calculations(AUDIT_START_DATE):
+    """Tests the per patient medians shared by KPIs 44 and 45 are calculated
+    again when the same `CalculateKPIS` is used for other PDUs."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_network_of_two_pdus(AUDIT_START_DATE)
+
+    reused_calc_kpis = CalculateKPIS(calculation_date=AUDIT_START_DATE, kpis=[44, 45])
+
+    kpi_values = {}
+    for pz_code in ["PZ130", "PZ001"]:
+        kpi_values[pz_code] = reused_calc_kpis.calculate_kpis_for_pdus([pz_code])[
+            "calculated_kpi_values"
+        ]
+        assert (
+            kpi_values[pz_code]
+            == CalculateKPIS(calculation_date=AUDIT_START_DATE, kpis=[44, 45])
+            .calculate_kpis_for_pdus([pz_code])["calculated_kpi_values"]
+        )
+
+    assert kpi_values["PZ130"] != kpi_values["PZ001"]
 
 
 @pytest.mark.django_db
@@ -0,0 +1,306 @@
+"""Tests for the stored per-patient KPI statuses (PatientKPIStatus)."""
+
+import random
+from unittest.mock import patch
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from project.constants.hba1c_format import HBA1C_FORMATS
+from project.npda.kpi_class.dataframe_engine import KPI_NUMBERS
+from project.npda.kpi_class.kpis import CalculateKPIS
+from project.npda.kpi_class.patient_kpi_status import (
+    COUNTED_KPI_NUMBERS,
+    deferred_patient_kpi_status_updates,
+    drop_pdu_kpi_counts,
+    get_pdu_kpi_counts,
+    update_patient_kpi_statuses,
+)
+from project.npda.models import Patient, PatientKPIStatus, PDUKPICount, Visit
+from project.npda.tests.factories.patient_factory import PatientFactory
+from project.npda.tests.factories.visit_factory import VisitFactory
+from project.npda.tests.kpi_calculations.test_kpi_dataframe_engine import (
+    assert_kpi_calculations_equal,
+    create_varied_cohort,
+    varied_visit_fields,
+)
+
+
+@pytest.fixture
+def AUDIT_PERIOD(AUDIT_START_DATE, AUDIT_END_DATE):
+    return [(AUDIT_START_DATE, AUDIT_END_DATE)]
+
+
+@pytest.mark.parametrize("seed", [1, 42])
+@pytest.mark.django_db
+def test_stored_engine_matches_sql_engine(AUDIT_START_DATE, seed):
+    """Tests KPIs aggregated from the stored statuses give the same totals and
+    patient ids as the SQL engine. Statuses are not stored upfront, so
+    this also tests missing statuses are calculated on the fly."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, seed=seed)
+    assert not PatientKPIStatus.objects.exists()
+
+    sql_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, return_pt_querysets=True
+    ).calculate_kpis_for_pdus(["PZ130"])
+    stored_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE,
+        return_pt_querysets=True,
+        engine="stored",
+    ).calculate_kpis_for_pdus(["PZ130"])
+
+    assert_kpi_calculations_equal(sql_results, stored_results)
+    assert PatientKPIStatus.objects.count() == Patient.objects.count() * len(
+        KPI_NUMBERS
+    )
+
+
+@pytest.mark.django_db
+def test_visit_save_and_delete_update_stored_statuses(
+    AUDIT_START_DATE, AUDIT_PERIOD, django_capture_on_commit_callbacks
+):
+    """Tests saving and deleting a visit recomputes the stored statuses of
+    only that visit's patient."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    # KPI 5 eligible patients without an HbA1c (KPI 25)
+    kpi_5_eligible = {
+        "visit__visit_date": AUDIT_START_DATE + relativedelta(days=2),
+        "date_of_birth": AUDIT_START_DATE - relativedelta(years=10),
+        "diagnosis_date": AUDIT_START_DATE - relativedelta(days=2),
+    }
+    patient = PatientFactory(**kpi_5_eligible)
+    other_patient = PatientFactory(**kpi_5_eligible)
+    update_patient_kpi_statuses(
+        [patient.pk, other_patient.pk], audit_periods=AUDIT_PERIOD
+    )
+
+    def kpi_25_passed(patient):
+        return PatientKPIStatus.objects.get(
+            patient=patient, audit_start_date=AUDIT_START_DATE, kpi_number=25
+        ).passed
+
+    assert kpi_25_passed(patient) is False
+
+    with django_capture_on_commit_callbacks(execute=True):
+        visit = VisitFactory(
+            patient=patient,
+            visit_date=AUDIT_START_DATE + relativedelta(days=10),
+            hba1c=60,
+            hba1c_format=HBA1C_FORMATS[0][0],
+            hba1c_date=AUDIT_START_DATE + relativedelta(days=10),
+        )
+
+    assert kpi_25_passed(patient) is True
+    assert kpi_25_passed(other_patient) is False
+
+    with django_capture_on_commit_callbacks(execute=True):
+        visit.delete()
+
+    assert kpi_25_passed(patient) is False
+
+
+@pytest.mark.django_db
+def test_patient_delete_removes_stored_statuses(
+    AUDIT_START_DATE, AUDIT_PERIOD, django_capture_on_commit_callbacks
+):
+    """Tests deleting a patient (and so their visits) leaves no statuses."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    patient = PatientFactory(
+        visit__visit_date=AUDIT_START_DATE + relativedelta(days=2),
+    )
+    update_patient_kpi_statuses([patient.pk], audit_periods=AUDIT_PERIOD)
+    assert PatientKPIStatus.objects.filter(patient=patient).exists()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        patient.delete()
+
+    assert not PatientKPIStatus.objects.exists()
+
+
+@pytest.mark.django_db
+def test_deferred_updates_recompute_once_per_batch(
+    AUDIT_START_DATE, django_capture_on_commit_callbacks
+):
+    """Tests saves within `deferred_patient_kpi_status_updates` (as used by
+    csv_upload) trigger a single update for all touched patients."""
+
+    with patch(
+        "project.npda.kpi_class.patient_kpi_status.update_patient_kpi_statuses"
+    ) as mock_update:
+        with django_capture_on_commit_callbacks(execute=True):
+            with deferred_patient_kpi_status_updates():
+                patients = [PatientFactory(), PatientFactory()]
+
+    mock_update.assert_called_once_with({patient.pk for patient in patients})
+
+
+@pytest.mark.django_db
+def test_deferred_deletes_recompute_once_per_batch(
+    AUDIT_START_DATE, django_capture_on_commit_callbacks
+):
+    """Tests deleting patients within `deferred_patient_kpi_status_updates`
+    schedules a single update, not one for each of their visits and
+    transfers."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=5)
+    assert Visit.objects.count() > 5
+
+    with patch(
+        "project.npda.kpi_class.patient_kpi_status.update_patient_kpi_statuses"
+    ) as mock_update, patch(
+        "project.npda.kpi_class.patient_kpi_status.drop_pdu_kpi_counts"
+    ) as mock_drop:
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            with deferred_patient_kpi_status_updates():
+                Patient.objects.all().delete()
+
+    assert len(callbacks) == 1
+    mock_update.assert_called_once()
+    mock_drop.assert_called_once_with({"PZ130"})
+
+
+@pytest.mark.django_db
+def test_patients_locked_before_statuses_are_calculated(AUDIT_START_DATE, AUDIT_PERIOD):
+    """Tests the patients are locked before their records are read, so
+    concurrent updates calculate from the latest records in turn."""
+
+    patient = PatientFactory(
+        visit__visit_date=AUDIT_START_DATE + relativedelta(days=2),
+    )
+
+    with CaptureQueriesContext(connection) as queries:
+        update_patient_kpi_statuses([patient.pk], audit_periods=AUDIT_PERIOD)
+
+    sql = [query["sql"] for query in queries.captured_queries]
+    patient_lock = next(
+        index
+        for index, query in enumerate(sql)
+        if query.startswith('SELECT "npda_patient"."id" FROM "npda_patient"')
+        and "FOR UPDATE" in query
+    )
+    first_visit_read = next(
+        index for index, query in enumerate(sql) if 'FROM "npda_visit"' in query
+    )
+    assert patient_lock < first_visit_read
+
+
+@pytest.mark.django_db
+def test_rebuild_patient_kpi_statuses_command(AUDIT_START_DATE):
+    """Tests the management command rebuilds statuses for every patient."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    call_command("rebuild_patient_kpi_statuses", date=AUDIT_START_DATE)
+
+    assert PatientKPIStatus.objects.filter(
+        audit_start_date=AUDIT_START_DATE
+    ).count() == 10 * len(KPI_NUMBERS)
+
+
+def pdu_kpi_count_totals(pz_code, audit_start_date, audit_end_date) -> dict:
+    return {
+        kpi_number: (
+            pdu_kpi_count.total_eligible,
+            pdu_kpi_count.total_passed,
+            pdu_kpi_count.value_sum,
+        )
+        for kpi_number, pdu_kpi_count in get_pdu_kpi_counts(
+            pz_code, audit_start_date, audit_end_date
+        ).items()
+    }
+
+
+@pytest.mark.django_db
+def test_visit_edits_update_pdu_kpi_counts(
+    AUDIT_START_DATE, AUDIT_END_DATE, django_capture_on_commit_callbacks
+):
+    """Tests editing and deleting visits updates the PDU's KPI counts by each
+    patient's change, giving the same counts as rebuilding them and the same
+    results as the SQL engine."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=30)
+    CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, engine="stored"
+    ).calculate_kpis_for_pdus(["PZ130"])
+    assert PDUKPICount.objects.filter(pz_code="PZ130").count() == len(
+        COUNTED_KPI_NUMBERS
+    )
+
+    rng = random.Random(7)
+    visits = rng.sample(list(Visit.objects.select_related("patient")), 12)
+    with django_capture_on_commit_callbacks(execute=True):
+        for visit in visits[:10]:
+            for field, value in varied_visit_fields(
+                rng, AUDIT_START_DATE, visit.patient.diagnosis_date
+            ).items():
+                setattr(visit, field, value)
+            visit.save()
+        for visit in visits[10:]:
+            visit.delete()
+
+    updated_totals = pdu_kpi_count_totals("PZ130", AUDIT_START_DATE, AUDIT_END_DATE)
+    drop_pdu_kpi_counts(["PZ130"])
+    assert updated_totals == pdu_kpi_count_totals(
+        "PZ130", AUDIT_START_DATE, AUDIT_END_DATE
+    )
+
+    sql_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE
+    ).calculate_kpis_for_pdus(["PZ130"])
+    stored_results = CalculateKPIS(
+        calculation_date=AUDIT_START_DATE, engine="stored"
+    ).calculate_kpis_for_pdus(["PZ130"])
+    assert_kpi_calculations_equal(sql_results, stored_results)
+
+
+@pytest.mark.django_db
+def test_patient_joining_or_leaving_pdu_drops_pdu_kpi_counts(
+    AUDIT_START_DATE, django_capture_on_commit_callbacks
+):
+    """Tests the PDU's KPI counts are dropped (to be rebuilt) when a patient
+    is added to or deleted from it, rather than updated."""
+
+    # Ensure starting with clean pts in test db
+    Patient.objects.all().delete()
+
+    create_varied_cohort(AUDIT_START_DATE, n_patients=10)
+
+    def calculate_with_counts():
+        CalculateKPIS(
+            calculation_date=AUDIT_START_DATE, engine="stored"
+        ).calculate_kpis_for_pdus(["PZ130"])
+        assert PDUKPICount.objects.filter(pz_code="PZ130").exists()
+
+    calculate_with_counts()
+    with django_capture_on_commit_callbacks(execute=True):
+        new_patient = PatientFactory(
+            visit__visit_date=AUDIT_START_DATE + relativedelta(days=2)
+        )
+    assert not PDUKPICount.objects.filter(pz_code="PZ130").exists()
+
+    calculate_with_counts()
+    with django_capture_on_commit_callbacks(execute=True):
+        new_patient.delete()
+    assert not PDUKPICount.objects.filter(pz_code="PZ130").exists()
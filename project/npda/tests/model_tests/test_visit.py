@@ -176,7 +176,7 @@ Suggested tests for the Visit model:
 - A visit can be created if a valid hospital_admission_discharge_date is supplied and is different to the visit date.
 - A visit can be created if a valid dka_additional_therapies is supplied (correct key) and a value of 2 ('DKA') for hospital_admission_reason has been supplied.
 - A visit cannot be created if an invalid dka_additional_therapies is supplied (incorrect key) and a value of 2 ('DKA') for hospital_admission_reason has been supplied.
-- A visit cannot be created if a valid dka_additional_therapies is supplied (correct key) and a value of 2 ('DKA') for hospital_admission_reason has not been supplied if an error is NOT stored in the errors field. 
+- A visit cannot be created if a valid dka_additional_therapies is supplied (correct key) and a value of 2 ('DKA') for hospital_admission_reason has not been supplied if an error is NOT stored in the errors field.
 - A visit can be created if a a valid dka_additional_therapies is supplied (correct key) and a value of 2 ('DKA') for hospital_admission_reason has not been supplied if an error is stored in the errors field.
 - A visit can be created if a valid hospital_admission_other is supplied and a value of 6 ('Other causes') for hospital_admission_reason has been supplied.
 - A visit cannot be created if a valid hospital_admission_other is supplied and a value of 6 ('Other causes') for hospital_admission_reason has not been supplied if an error is NOT stored in the errors field.
@@ -186,3 +186,33 @@ Suggested tests for the Visit model:
 - A visit can be created if a patient has multiple visits.
 - A visit cannot be created if it is associated with more than one patient.
 """
+
+import pytest
+from django.db import connection
+
+from project.npda.models import Visit
+from project.npda.tests.factories.patient_factory import PatientFactory
+
+
+@pytest.mark.django_db
+def test_visit_latest_visit_lookup_uses_patient_date_index():
+    """The KPI calculations' latest visit per patient subqueries can be
+    answered from the (patient, -visit_date) index without a sort.
+
+    Sequential scans and sorts are disabled, as for a handful of rows the
+    planner would (correctly) consider them as cheap."""
+
+    patient = PatientFactory()
+
+    latest_visit = (
+        Visit.objects.filter(patient=patient, treatment__in=[3, 6])
+        .order_by("-visit_date")
+        .values("pk")[:1]
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("SET LOCAL enable_sort = off")
+    plan = latest_visit.explain()
+
+    assert "npda_visit_patient_date_idx" in plan
+    assert "Sort" not in plan
@@ -1,3 +1,5 @@
+import math
+from datetime import date
 from functools import partial
 from unittest.mock import Mock, patch
 
@@ -7,10 +9,13 @@ import pytest
 from dateutil.relativedelta import relativedelta
 from django.apps import apps
 from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
 from requests import RequestException
 
-from project.npda.general_functions.csv_upload import csv_upload, read_csv
-from project.npda.models import NPDAUser, Patient, Visit
+from project.npda.general_functions.csv_upload import (VISIT_CSV_FIELDS,
+                                                       csv_upload, read_csv)
+from project.npda.models import NPDAUser, Patient, Submission, Transfer, Visit
 from project.npda.tests.factories.patient_factory import (
     INDEX_OF_MULTIPLE_DEPRIVATION_QUINTILE, TODAY, VALID_FIELDS)
 
@@ -18,11 +23,12 @@ from project.npda.tests.factories.patient_factory import (
 # We don't want to call remote services in unit tests
 @pytest.fixture(autouse=True)
 def mock_remote_calls():
-    with patch("project.npda.forms.patient_form.validate_postcode", Mock(return_value={"normalised_postcode": VALID_FIELDS["postcode"]})):
-        with patch("project.npda.forms.patient_form.gp_ods_code_for_postcode", Mock(return_value = "G85023")):
-            with patch("project.npda.forms.patient_form.gp_details_for_ods_code", Mock(return_value = True)):
-                with patch("project.npda.models.patient.imd_for_postcode", Mock(return_value = INDEX_OF_MULTIPLE_DEPRIVATION_QUINTILE)):
-                    yield None
+    with patch("project.npda.general_functions.csv_upload.validate_postcodes", Mock(return_value={})):
+        with patch("project.npda.forms.patient_form.validate_postcode", Mock(return_value={"normalised_postcode": VALID_FIELDS["postcode"]})):
+            with patch("project.npda.forms.patient_form.gp_ods_code_for_postcode", Mock(return_value = "G85023")):
+                with patch("project.npda.forms.patient_form.gp_details_for_ods_code", Mock(return_value = True)):
+                    with patch("project.npda.models.patient.imd_for_postcode", Mock(return_value = INDEX_OF_MULTIPLE_DEPRIVATION_QUINTILE)):
+                        yield None
 
 
 ALDER_HEY_PZ_CODE = "PZ074"
@@ -380,6 +386,25 @@ def test_death_date_before_date_of_birth(test_user, single_row_valid_df):
     assert(error_message == "&#x27;Death Date&#x27; cannot be before &#x27;Date of Birth&#x27;")
 
 
+@pytest.mark.django_db
+def test_future_visit_date(test_user, single_row_valid_df):
+    visit_date = date.today() + relativedelta(days=1)
+
+    single_row_valid_df["Visit/Appointment Date"] = pd.to_datetime(visit_date)
+
+    with pytest.raises(ValidationError) as e_info:
+        csv_upload(test_user, single_row_valid_df, None, ALDER_HEY_PZ_CODE)
+
+    visit = Visit.objects.first()
+
+    assert(visit.visit_date == visit_date)
+    assert("visit_date" in visit.errors)
+
+    error_message = visit.errors["visit_date"][0]['message']
+    # TODO MRB: why does this have entity encoding issues?
+    assert(error_message == "&#x27;Visit/Appointment Date&#x27; cannot be in the future.")
+
+
 @pytest.mark.django_db
 @patch("project.npda.forms.patient_form.validate_postcode", Mock(return_value=None))
 def test_invalid_postcode(test_user, single_row_valid_df):
@@ -445,3 +470,81 @@ def test_error_looking_up_index_of_multiple_deprivation(test_user, single_row_va
 
     patient = Patient.objects.first()
     assert(patient.index_of_multiple_deprivation_quintile is None)
+
+
+@pytest.mark.django_db
+def test_patients_and_visits_are_bulk_inserted(test_user, two_patients_first_with_two_visits_second_with_one):
+    df = two_patients_first_with_two_visits_second_with_one
+
+    with CaptureQueriesContext(connection) as queries:
+        csv_upload(test_user, df, None, ALDER_HEY_PZ_CODE, batch_size=2)
+
+    visit_inserts = [query for query in queries.captured_queries if query["sql"].startswith('INSERT INTO "npda_visit"')]
+
+    assert(Visit.objects.count() == len(df))
+    assert(len(visit_inserts) == math.ceil(len(df) / 2))
+
+    submission = Submission.objects.get(submission_active=True)
+    assert(submission.patients.count() == Patient.objects.count())
+    assert(Transfer.objects.filter(paediatric_diabetes_unit__pz_code=ALDER_HEY_PZ_CODE).count() == Patient.objects.count())
+
+
+@pytest.mark.django_db
+def test_failed_upload_leaves_previous_submission_active(test_user, two_patients_first_with_two_visits_second_with_one, single_row_valid_df):
+    csv_upload(test_user, two_patients_first_with_two_visits_second_with_one, None, ALDER_HEY_PZ_CODE)
+
+    original_submission = Submission.objects.get(submission_active=True)
+    patient_count = Patient.objects.count()
+    visit_count = Visit.objects.count()
+
+    with patch.object(Visit.objects, "bulk_create", Mock(side_effect=DatabaseError("oopsie!"))):
+        with pytest.raises(DatabaseError):
+            csv_upload(test_user, single_row_valid_df, None, ALDER_HEY_PZ_CODE)
+
+    assert(Submission.objects.get(submission_active=True) == original_submission)
+    assert(Patient.objects.count() == patient_count)
+    assert(Visit.objects.count() == visit_count)
+
+
+@pytest.mark.django_db
+def test_reupload_updates_kpi_statuses_once(test_user, two_patients_first_with_two_visits_second_with_one, django_capture_on_commit_callbacks):
+    df = two_patients_first_with_two_visits_second_with_one
+    csv_upload(test_user, df, None, ALDER_HEY_PZ_CODE)
+    previous_patient_pks = set(Patient.objects.values_list("pk", flat=True))
+
+    # Deleting the previous patients' visits and transfers, and creating the new
+    # ones, is one update once the upload commits
+    with patch("project.npda.kpi_class.patient_kpi_status.update_patient_kpi_statuses") as mock_update:
+        with patch("project.npda.kpi_class.patient_kpi_status.drop_pdu_kpi_counts") as mock_drop:
+            with django_capture_on_commit_callbacks(execute=True):
+                csv_upload(test_user, df, None, ALDER_HEY_PZ_CODE)
+
+    new_patient_pks = set(Patient.objects.values_list("pk", flat=True))
+
+    mock_update.assert_called_once_with(previous_patient_pks | new_patient_pks)
+    mock_drop.assert_called_once_with({ALDER_HEY_PZ_CODE})
+
+
+@pytest.mark.django_db
+def test_prevalidated_visits_match_visits_validated_by_form(test_user, two_patients_first_with_two_visits_second_with_one):
+    df = two_patients_first_with_two_visits_second_with_one
+    df.loc[0, 'Diabetes Treatment at time of Hba1c measurement'] = 45
+
+    def uploaded_visits():
+        with pytest.raises(ValidationError) as e_info:
+            csv_upload(test_user, df, None, ALDER_HEY_PZ_CODE)
+
+        return list(Visit.objects.order_by('visit_date', 'pk').values(*VISIT_CSV_FIELDS, 'is_valid', 'errors'))
+
+    # Only the first visit has an invalid value, so only it is validated with VisitForm
+    prevalidated_visits = uploaded_visits()
+
+    def every_visit_needs_form(visit_fields, **patient_dates):
+        return pd.DataFrame(True, index=visit_fields.index, columns=visit_fields.columns)
+
+    with patch("project.npda.general_functions.csv_upload.prevalidate_visit_rows", every_visit_needs_form):
+        visits_validated_by_form = uploaded_visits()
+
+    assert(len(prevalidated_visits) == 3)
+    assert(prevalidated_visits == visits_validated_by_form)
+    assert(sorted(visit['is_valid'] for visit in prevalidated_visits) == [False, True, True])
@@ -0,0 +1,272 @@
+"""Tests for queued csv uploads (`UploadJob`) and the process_upload_jobs worker."""
+
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import Mock, patch
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from project.constants import (
+    UPLOAD_JOB_COMPLETE,
+    UPLOAD_JOB_COMPLETE_WITH_ERRORS,
+    UPLOAD_JOB_FAILED,
+    UPLOAD_JOB_QUEUED,
+    UPLOAD_JOB_RUNNING,
+)
+from project.npda.general_functions.csv_upload import read_csv
+from project.npda.general_functions.upload_jobs import (
+    UPLOAD_JOB_STALE_AFTER,
+    enqueue_upload_job,
+    fail_stale_upload_jobs,
+)
+from project.npda.models import Patient, Submission, UploadJob
+from project.npda.tests.test_csv_upload import (  # noqa: F401 (fixtures)
+    ALDER_HEY_PZ_CODE,
+    dummy_sheets_folder,
+    mock_remote_calls,
+    test_user,
+)
+from project.npda.tests.utils import login_and_verify_user
+
+
+@pytest.fixture(autouse=True)
+def media_storage(settings, tmp_path):
+    settings.STORAGES = {
+        **settings.STORAGES,
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": str(tmp_path)},
+        },
+        # Full pages link static files, which needn't be collected to test them
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    }
+
+
+@pytest.fixture
+def dataframe(dummy_sheets_folder):
+    # Two patients, the first with two visits
+    return read_csv(dummy_sheets_folder / "dummy_sheet.csv").head(3)
+
+
+def csv_file(dataframe):
+    return SimpleUploadedFile(
+        "upload.csv",
+        dataframe.to_csv(index=False, date_format="%d/%m/%Y").encode(),
+        content_type="text/csv",
+    )
+
+
+def process_upload_jobs():
+    call_command("process_upload_jobs", once=True, stdout=StringIO())
+
+
+@pytest.fixture
+def upload_client(client, test_user):
+    client = login_and_verify_user(client, test_user)
+    session = client.session
+    session["pz_code"] = ALDER_HEY_PZ_CODE
+    session.save()
+    return client
+
+
+@pytest.mark.django_db
+def test_upload_is_queued_not_processed(upload_client, dataframe):
+    response = upload_client.post(reverse("home"), {"csv_upload": csv_file(dataframe)})
+
+    assert response.status_code == 302
+    assert response.url == reverse("submissions")
+
+    job = UploadJob.objects.get()
+    assert job.state == UPLOAD_JOB_QUEUED
+    assert job.paediatric_diabetes_unit.pz_code == ALDER_HEY_PZ_CODE
+    assert job.csv_file
+
+    assert not Submission.objects.exists()
+    assert not Patient.objects.exists()
+
+
+@pytest.mark.django_db
+def test_worker_processes_queued_upload(test_user, dataframe):
+    job = enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    # Save progress after every patient
+    with patch(
+        "project.npda.general_functions.upload_jobs.UPLOAD_JOB_PROGRESS_INTERVAL", 0
+    ):
+        with CaptureQueriesContext(connection) as queries:
+            process_upload_jobs()
+
+    progress_updates = [
+        query
+        for query in queries.captured_queries
+        if query["sql"].startswith('UPDATE "npda_uploadjob" SET "rows_processed"')
+    ]
+    assert len(progress_updates) == 2
+
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_COMPLETE
+    assert job.total_rows == 3
+    assert job.rows_processed == 3
+    assert job.error_count == 0
+    assert job.errors == []
+    assert job.started_at <= job.finished_at
+    # The submission keeps its own copy
+    assert not job.csv_file
+
+    submission = Submission.objects.get(submission_active=True)
+    assert submission.csv_file
+    assert submission.patients.count() == 2
+
+
+@pytest.mark.django_db
+def test_worker_records_upload_errors(test_user, dataframe):
+    dataframe.loc[0, "Diabetes Treatment at time of Hba1c measurement"] = 45
+    job = enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    process_upload_jobs()
+
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_COMPLETE_WITH_ERRORS
+    assert job.rows_processed == 3
+    assert job.error_count == 1
+    assert job.errors[0]["field"] == "treatment"
+    assert job.errors[0]["original_row_index"] == 0
+
+    # Rows without errors are saved either way
+    assert Patient.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_failed_upload_job_keeps_its_file(test_user, dataframe):
+    job = enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    with patch(
+        "project.npda.general_functions.upload_jobs.csv_upload",
+        Mock(side_effect=DatabaseError("oopsie!")),
+    ):
+        process_upload_jobs()
+
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_FAILED
+    assert job.errors[-1]["message"] == "oopsie!"
+    assert job.csv_file
+
+    # Jobs are only run once
+    process_upload_jobs()
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_FAILED
+
+
+@pytest.mark.django_db
+def test_submission_errors_fail_upload_job(test_user, dataframe):
+    job = enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    with patch.object(
+        Submission.objects, "create", Mock(side_effect=DatabaseError("oopsie!"))
+    ):
+        process_upload_jobs()
+
+    job.refresh_from_db()
+    # Nothing was saved, so the file is kept to be queued again
+    assert job.state == UPLOAD_JOB_FAILED
+    assert job.errors[0]["field"] == "csv_upload"
+    assert job.csv_file
+    assert not Patient.objects.exists()
+
+
+@pytest.mark.django_db
+def test_stale_running_upload_job_is_failed(upload_client, test_user, dataframe):
+    job = enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    # Claimed by a worker which then stopped
+    with patch(
+        "project.npda.management.commands.process_upload_jobs.process_upload_job"
+    ):
+        process_upload_jobs()
+
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_RUNNING
+
+    # Still running as far as the page knows
+    response = upload_client.get(reverse("upload_job_progress"), HTTP_HX_REQUEST="true")
+    assert 'hx-trigger="every 2s"' in response.content.decode()
+
+    UploadJob.objects.filter(pk=job.pk).update(
+        heartbeat_at=job.heartbeat_at - UPLOAD_JOB_STALE_AFTER - timedelta(seconds=1)
+    )
+
+    response = upload_client.get(reverse("upload_job_progress"), HTTP_HX_REQUEST="true")
+    assert 'hx-trigger="every 2s"' not in response.content.decode()
+
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_FAILED
+    assert job.csv_file
+
+
+@pytest.mark.django_db
+def test_slow_upload_job_steps_keep_it_running(test_user, dataframe):
+    job = enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    now = timezone.now()
+    states = []
+
+    def slow_step(*args, **kwargs):
+        # Each step takes 20 minutes, then the submissions page is loaded
+        nonlocal now
+        now += timedelta(minutes=20)
+        fail_stale_upload_jobs()
+        states.append(UploadJob.objects.get(pk=job.pk).state)
+        return {"normalised_postcode": "W1A 1AA"}
+
+    with patch(
+        "project.npda.general_functions.upload_jobs.timezone.now",
+        Mock(side_effect=lambda: now),
+    ), patch(
+        # Only heartbeats are saved
+        "project.npda.general_functions.upload_jobs.UPLOAD_JOB_PROGRESS_INTERVAL",
+        3600,
+    ), patch(
+        # PatientForm validation, for each patient
+        "project.npda.forms.patient_form.validate_postcode",
+        Mock(side_effect=slow_step),
+    ), patch(
+        "project.npda.general_functions.upload_jobs.snapshot_kpis_for_pdu",
+        Mock(side_effect=slow_step),
+    ):
+        process_upload_jobs()
+
+    # Longer than UPLOAD_JOB_STALE_AFTER in all
+    assert len(states) == 3
+    assert states == [UPLOAD_JOB_RUNNING] * 3
+
+    job.refresh_from_db()
+    assert job.state == UPLOAD_JOB_COMPLETE
+
+
+@pytest.mark.django_db
+def test_upload_progress_polls_until_finished(upload_client, test_user, dataframe):
+    enqueue_upload_job(test_user, csv_file(dataframe), ALDER_HEY_PZ_CODE)
+
+    submissions_page = upload_client.get(reverse("submissions"))
+    assert 'hx-trigger="every 2s"' in submissions_page.content.decode()
+
+    response = upload_client.get(reverse("upload_job_progress"), HTTP_HX_REQUEST="true")
+    assert 'hx-trigger="every 2s"' in response.content.decode()
+    assert "Queued" in response.content.decode()
+    assert "HX-Trigger" not in response
+
+    process_upload_jobs()
+
+    response = upload_client.get(reverse("upload_job_progress"), HTTP_HX_REQUEST="true")
+    assert 'hx-trigger="every 2s"' not in response.content.decode()
+    assert "Complete" in response.content.decode()
+    # Polling stops, and the submissions table is reloaded
+    assert "submissions" in response["HX-Trigger"]
@@ -24,6 +24,11 @@ urlpatterns = [
         view=SubmissionsListView.as_view(),
         name="submissions",
     ),
+    path(
+        "submissions/upload-progress",
+        view=upload_job_progress,
+        name="upload_job_progress",
+    ),
     # Patient views
     path(
         "patients",
@@ -102,5 +107,10 @@ urlpatterns = [
         view=dashboard,
         name="dashboard",
     ),
+    path(
+        "dashboard/kpi-trend",
+        view=kpi_trend,
+        name="kpi_trend",
+    ),
     path("csrf_fail/", csrf_fail, name="csrf_fail"),
 ]
@@ -5,8 +5,9 @@ import logging
 # Django imports
 from django.apps import apps
 from django.contrib import messages
-from django.core.exceptions import ValidationError
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
 from django.urls import reverse
 
 
@@ -15,32 +16,36 @@ from django_htmx.http import trigger_client_event
 
 from ..forms.upload import UploadFileForm
 from ..general_functions.csv_summarize import csv_summarize
-from ..general_functions.csv_upload import csv_upload, read_csv
 from ..general_functions.session import get_new_session_fields
+from ..general_functions.upload_jobs import enqueue_upload_job
 from ..general_functions.view_preference import get_or_update_view_preference
+from ..kpi_class.kpi_snapshots import (
+    AUDIT_YEAR,
+    TREND_INTERVALS,
+    get_kpi_trend,
+)
 from ..kpi_class.kpis import CalculateKPIS
 
 # RCPCH imports
 from .decorators import login_and_otp_required
+from ..templatetags.npda_tags import extract_digits
 
 # Logging
 logger = logging.getLogger(__name__)
 
+# Rows of the dashboard's KPI table, rendered and streamed in turn (first, last KPI)
+DASHBOARD_KPI_GROUPS = [
+    (1, 12),
+    (13, 20),
+    (21, 24),
+    (25, 32),
+    (33, 40),
+    (41, 43),
+    (44, 49),
+]
 
-def error_list(wrapper_error: ValidationError):
-    ret = []
-
-    for field, errors in wrapper_error.error_dict.items():
-        for error in errors:
-            ret.append(
-                {
-                    "field": field,
-                    "message": error.message,
-                    "original_row_index": error.original_row_index,
-                }
-            )
-
-    return ret
+# Where the KPI groups go in the streamed dashboard (see kpi_table.html)
+KPI_GROUPS_MARKER = "<!-- kpi groups -->"
 
 
 @login_and_otp_required()
@@ -56,39 +61,23 @@ def home(request):
 
         # summary = csv_summarize(csv_file=file)
 
-        # You can't read the same file twice without resetting it
-        file.seek(0)
-        errors = []
+        # The file is processed in the background by the process_upload_jobs
+        # command, and its progress shown on the submissions page
+        enqueue_upload_job(user=request.user, csv_file=file, pdu_pz_code=pz_code)
+        messages.success(
+            request=request,
+            message="File uploaded successfully. It is being processed - see its progress below.",
+        )
 
+        VisitActivity = apps.get_model("npda", "VisitActivity")
         try:
-            csv_upload(
-                user=request.user,
-                dataframe=read_csv(file),
-                csv_file=file,
-                pdu_pz_code=pz_code,
-            )
-            messages.success(
-                request=request,
-                message="File uploaded successfully. There are no errors,",
-            )
-
-            VisitActivity = apps.get_model("npda", "VisitActivity")
-            try:
-                VisitActivity.objects.create(
-                    activity=8,
-                    ip_address=request.META.get("REMOTE_ADDR"),
-                    npdauser=request.user,
-                )  # uploaded csv - activity 8
-            except Exception as e:
-                logger.error(f"Failed to log user activity: {e}")
-        except ValidationError as error:
-            errors = error_list(error)
-            for error in errors:
-                messages.error(
-                    request=request,
-                    message=f"CSV has been uploaded, but errors have been found. These include error in row {error['original_row_index']}: {error['message']}",
-                )
-            pass
+            VisitActivity.objects.create(
+                activity=8,
+                ip_address=request.META.get("REMOTE_ADDR"),
+                npdauser=request.user,
+            )  # uploaded csv - activity 8
+        except Exception as e:
+            logger.error(f"Failed to log user activity: {e}")
 
         return redirect("submissions")
     else:
@@ -167,6 +156,11 @@ def view_preference(request):
 def dashboard(request):
     """
     Dashboard view for the KPIs.
+
+    The page is streamed: the page shell is sent straight away, then the rows
+    of each of DASHBOARD_KPI_GROUPS once the KPIs are calculated.
+    HTMX requests (refreshing the dashboard) get the whole KPI table at once,
+    as HTMX only swaps in complete responses.
     """
     template = "dashboard.html"
     pz_code = request.session.get("pz_code")
@@ -184,16 +178,102 @@ def dashboard(request):
         )
         return render(request, "dashboard.html")
 
+    context = {
+        "pdu": pdu,
+        "aggregation_level": "Paediatric Diabetes Unit",
+    }
+
+    if not request.htmx:
+        shell = render_to_string(
+            template, context={**context, "stream_kpi_groups": True}, request=request
+        )
+        head, tail = shell.split(KPI_GROUPS_MARKER, 1)
+        return StreamingHttpResponse(
+            _stream_dashboard(head, tail, pz_code),
+            content_type="text/html; charset=utf-8",
+        )
+
     calculate_kpis = CalculateKPIS(
-        calculation_date=datetime.date.today(), return_pt_querysets=True
+        calculation_date=datetime.date.today(),
+        return_pt_querysets=True,
+        engine="stored",
     )
 
-    kpi_calculations_object = calculate_kpis.calculate_kpis_for_pdus(pz_codes=[pz_code])
+    kpi_calculations_object = calculate_kpis.calculate_kpis_for_pdus(
+        pz_codes=[pz_code], use_cache=True
+    )
 
     context = {
-        "pdu": pdu,
+        **context,
         "kpi_results": kpi_calculations_object,
-        "aggregation_level": "Paediatric Diabetes Unit",
+        # Used to render each KPI's patient_ids, so looked up once
+        "patient_nhs_numbers": dict(
+            calculate_kpis.patients.values_list("pk", "nhs_number")
+        ),
     }
 
     return render(request, template_name=template, context=context)
+
+
+def _stream_dashboard(head: str, tail: str, pz_code: str):
+    """Yields the dashboard page shell, then the rows of each KPI group, then
+    the rest of the page. The KPIs are calculated once (sharing the cache entry
+    of HTMX refreshes) after the shell is sent, and only the rendering of the
+    groups is split up"""
+
+    yield head
+
+    calculate_kpis = CalculateKPIS(
+        calculation_date=datetime.date.today(),
+        return_pt_querysets=True,
+        engine="stored",
+    )
+    kpi_values = calculate_kpis.calculate_kpis_for_pdus(
+        pz_codes=[pz_code], use_cache=True
+    )["calculated_kpi_values"]
+
+    # Used to render each KPI's patient_ids, so looked up once
+    patient_nhs_numbers = dict(calculate_kpis.patients.values_list("pk", "nhs_number"))
+
+    for first, last in DASHBOARD_KPI_GROUPS:
+        yield render_to_string(
+            "partials/kpi_rows.html",
+            context={
+                "kpi_group": f"{first}-{last}",
+                # KPI 32's sub KPIs (kpi_32_1_...) are in KPI 32's group
+                "kpi_values": {
+                    kpi_key: kpi_value
+                    for kpi_key, kpi_value in kpi_values.items()
+                    if first <= extract_digits(kpi_key) <= last
+                },
+                "patient_nhs_numbers": patient_nhs_numbers,
+            },
+        )
+
+    yield tail
+
+
+@login_and_otp_required()
+def kpi_trend(request):
+    """
+    JSON of the KPI snapshots of the session's PDU over time, for year on
+    year (?interval=audit_year, the default) or quarter on quarter
+    (?interval=quarter) comparisons. Restrict to some KPIs with ?kpi=1&kpi=2.
+    """
+    pz_code = request.session.get("pz_code")
+    interval = request.GET.get("interval", AUDIT_YEAR)
+
+    if interval not in TREND_INTERVALS:
+        return JsonResponse(
+            {"error": f"interval must be one of {', '.join(TREND_INTERVALS)}"},
+            status=400,
+        )
+
+    try:
+        kpi_numbers = [int(kpi) for kpi in request.GET.getlist("kpi")] or None
+    except ValueError:
+        return JsonResponse({"error": "kpi must be a KPI number"}, status=400)
+
+    trend = get_kpi_trend(pz_code, kpi_numbers=kpi_numbers, interval=interval)
+
+    return JsonResponse({"pz_code": pz_code, "interval": interval, "kpis": trend})
@@ -28,6 +28,7 @@ from project.npda.models import NPDAUser
 # RCPCH imports
 from ..models import Patient
 from ..forms.patient_form import PatientForm
+from ..kpi_class.patient_kpi_status import deferred_patient_kpi_status_updates
 from .mixins import CheckPDUInstanceMixin, CheckPDUListMixin, LoginAndOTPRequiredMixin
 
 logger = logging.getLogger(__name__)
@@ -305,3 +306,9 @@ class PatientDeleteView(
     model = Patient
     success_message = "Child removed from database"
     success_url = reverse_lazy("patients")
+
+    def form_valid(self, form):
+        # Deleting the patient deletes each of their visits and transfers,
+        # whose KPI status updates are done once at the end
+        with deferred_patient_kpi_status_updates():
+            return super().form_valid(form)
@@ -9,12 +9,19 @@ from django.db.models import Count, Case, When, F, Value
 from django.db.models.functions import Concat
 from django.http import HttpResponse
 from django.shortcuts import render
+from django.urls import reverse
 from django.views.generic import ListView
 
+# HTMX imports
+from django_htmx.http import trigger_client_event
+
 # RCPCH imports
+from .decorators import login_and_otp_required
 from .mixins import LoginAndOTPRequiredMixin
 from ..models import Submission
 from ..general_functions import download_csv, csv_summarize
+from ..general_functions.upload_jobs import recent_upload_jobs
+from ..kpi_class.patient_kpi_status import deferred_patient_kpi_status_updates
 
 
 class SubmissionsListView(LoginAndOTPRequiredMixin, ListView):
@@ -67,6 +74,9 @@ class SubmissionsListView(LoginAndOTPRequiredMixin, ListView):
         """
         context = super().get_context_data(**kwargs)
         context["pz_code"] = self.request.session.get("pz_code")
+        context["upload_jobs"], context["upload_jobs_running"] = recent_upload_jobs(
+            context["pz_code"]
+        )
         Patient = apps.get_model("npda", "Patient")
         context["data"] = None  # data stores csv summary data if a submission exists
         latest_active_submission = self.object_list.filter(
@@ -125,10 +135,12 @@ class SubmissionsListView(LoginAndOTPRequiredMixin, ListView):
                 )
                 return render(request, self.template_name, context=context)
 
-            # delete the patients associated with the submission
-            submission.patients.all().delete()
-            # then delete the submission itself
-            submission.delete()
+            # delete the patients associated with the submission, then the
+            # submission itself. The KPI status updates for each of their
+            # visits and transfers are done once at the end
+            with deferred_patient_kpi_status_updates():
+                submission.patients.all().delete()
+                submission.delete()
 
             # set the submission_active flag to True for the most recent submission
             if Submission.objects.count() > 0:
@@ -157,3 +169,33 @@ class SubmissionsListView(LoginAndOTPRequiredMixin, ListView):
         :return: The response
         """
         return super().render_to_response(context)
+
+
+@login_and_otp_required()
+def upload_job_progress(request):
+    """
+    HTMX partial of the session PDU's recent csv uploads and their progress.
+    Polled by the submissions page while any upload is queued or running.
+    """
+    upload_jobs, upload_jobs_running = recent_upload_jobs(
+        request.session.get("pz_code")
+    )
+
+    response = render(
+        request,
+        template_name="partials/upload_jobs.html",
+        context={
+            "upload_jobs": upload_jobs,
+            "upload_jobs_running": upload_jobs_running,
+        },
+    )
+
+    if not upload_jobs_running:
+        # Polling stops here, so show the new submission
+        trigger_client_event(
+            response=response,
+            name="submissions",
+            params={"method": "GET", "url": reverse("submissions")},
+        )  # reloads the submissions table
+
+    return response
@@ -15,6 +15,7 @@ from django.views.generic.edit import CreateView, DeleteView, UpdateView
 from ..forms.visit_form import VisitForm
 from ..general_functions import get_visit_categories
 from ..kpi_class.kpis import CalculateKPIS
+from ..kpi_class.patient_kpi_status import deferred_patient_kpi_status_updates
 from ..models import Patient, Transfer, Visit
 from .mixins import CheckPDUInstanceMixin, CheckPDUListMixin, LoginAndOTPRequiredMixin
 
@@ -54,10 +55,13 @@ class PatientVisitsListView(
         # if this happened during the audit period. This is TODO
 
         calculate_kpis = CalculateKPIS(
-            calculation_date=datetime.date.today(), return_pt_querysets=False
+            calculation_date=datetime.date.today(),
+            return_pt_querysets=False,
+            engine="fused",
         )
         # Calculate the KPIs for this patient, returning only subset relevant
-        # for a single patient's calculation
+        # for a single patient's calculation (KPIs 13 onwards, as displayed).
+        # Of KPIs 1 - 12, only the denominators those depend on are calculated.
         kpi_calculations_object = calculate_kpis.calculate_kpis_for_single_patient(patient)
 
         context["kpi_results"] = kpi_calculations_object
@@ -183,10 +187,13 @@ class VisitUpdateView(
         return initial
 
     def form_valid(self, form: BaseModelForm) -> HttpResponse:
-        visit = form.save(commit=True)
-        visit.errors = None
-        visit.is_valid = True
-        visit.save(update_fields=["errors", "is_valid"])
+        # Both saves update the patient's stored KPI statuses (and so their
+        # PDUs' KPI counts), which is done once at the end
+        with deferred_patient_kpi_status_updates():
+            visit = form.save(commit=True)
+            visit.errors = None
+            visit.is_valid = True
+            visit.save(update_fields=["errors", "is_valid"])
         context = {"patient_id": self.kwargs["patient_id"]}
         messages.add_message(
             self.request, messages.SUCCESS, "Visit edited successfully"
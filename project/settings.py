@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 import logging
 
 from dotenv import load_dotenv
@@ -63,6 +64,14 @@ RCPCH_NHS_ORGANISATIONS_API_URL = "https://rcpch-nhs-organisations.azurewebsites
 # jargon for a GP practice
 NHS_SPINE_SERVICES_URL = os.getenv("NHS_SPINE_SERVICES_URL")
 
+# Postcode lookups (postcodes.io), one at a time (e.g. a patient's postcode) or in
+# bulk, to validate all the postcodes of a csv upload together
+POSTCODES_IO_API_BASE_URL = os.getenv(
+    "POSTCODES_IO_API_BASE_URL", "https://api.postcodes.io"
+)
+
+# Deployments that set this (findthatpostcode) keep validating postcodes one at a
+# time with it. Bulk lookups always use postcodes.io
 POSTCODE_API_BASE_URL = os.getenv("POSTCODE_API_BASE_URL")
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -175,6 +184,29 @@ else:
 
 DATABASES = {"default": database_config}
 
+# Caches
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# KPI results are cached per PDU (see project/npda/kpi_class/kpi_cache.py).
+# The file based cache is shared between worker processes on the same host.
+# Which results are current is versioned in the database, so invalidations
+# reach every host, and culled entries are just recalculated.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "kpi_results": {
+        "BACKEND": os.getenv(
+            "KPI_RESULTS_CACHE_BACKEND",
+            "django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": os.getenv(
+            "KPI_RESULTS_CACHE_LOCATION",
+            os.path.join(tempfile.gettempdir(), "npda_kpi_results"),
+        ),
+        "TIMEOUT": 60 * 60 * 24,  # 1 day
+    },
+}
+
 AUTHENTICATION_BACKENDS = (
     "django.contrib.auth.backends.ModelBackend",  # this is default
 )